@@ -1,6 +1,13 @@
 import os
+import time
+import tempfile
+import random
+import asyncio
+import hmac
+import hashlib
 import aiohttp
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram.utils import executor
 from aiogram.dispatcher import FSMContext
@@ -8,7 +15,10 @@ from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 import json
 import logging
+from collections import deque
 from dotenv import load_dotenv
+from fsm_storage import SqliteStorage, FSM_SHARDS
+from updates import release_order
 
 # Загрузка переменных окружения из .env файла
 load_dotenv()
@@ -20,14 +30,61 @@ logger = logging.getLogger(__name__)
 # Константы
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SERVER_URL = os.getenv("SERVER_URL")
+# Адрес Bot API: локальный сервер telegram-bot-api или заглушка для бенчмарков
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 DEFAULT_PLAYLIST = "Любимое"
 TIMEOUT = 30
+UPLOAD_TIMEOUT = 600
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_CONCURRENT_TRANSFERS = int(os.getenv("MAX_CONCURRENT_TRANSFERS", 4))
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+HTTP_KEEPALIVE_TIMEOUT = int(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60))
+INLINE_SEARCH_LIMIT = 20
+INLINE_CACHE_TIME = 30
+# Доля ответов сервера, чье содержимое пишется в лог на уровне DEBUG
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+# Аудио, пришедшие с паузой меньше окна, собираются в одну пачку
+AUDIO_BATCH_WINDOW = float(os.getenv("AUDIO_BATCH_WINDOW", 1.0))
+AUDIO_BATCH_MAX = 50
+# Неотправленные замеры времени запросов к серверу: сколько хранить и сколько передавать в одном запросе
+SERVER_RTT_BACKLOG = 256
+SERVER_RTT_PER_REQUEST = 16
+# Хранилище состояний FSM: sqlite (переживает перезапуск, общее для воркеров вебхука) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_DIR = os.getenv("FSM_DIR", "fsm")
+FSM_SHARD_COUNT = int(os.getenv("FSM_SHARDS", FSM_SHARDS))
+# Ключ запросов бота к серверу (Server/auth.py: bot_auth_key), сам токен на сервер не передается
+SERVER_AUTH_HEADERS = {
+    "X-Bot-Auth": hmac.new((BOT_TOKEN or "").encode(), b"music-player-server", hashlib.sha256).hexdigest()
+}
 
 
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+bot = Bot(token=BOT_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
+storage = SqliteStorage(FSM_DIR, FSM_SHARD_COUNT) if FSM_STORAGE == "sqlite" else MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
+# Ограничение одновременных передач файлов Telegram -> сервер
+transfer_semaphore = asyncio.Semaphore(MAX_CONCURRENT_TRANSFERS)
+# Общий пул соединений на всё время жизни бота
+http_session = None
+# Замеры завершенных запросов к серверу; каждый уходит серверу один раз со следующим запросом для /metrics
+pending_server_rtts = deque(maxlen=SERVER_RTT_BACKLOG)
+
+# Копящиеся пачки аудио по (user_id, плейлист) и задачи их загрузки
+audio_batches = {}
+background_tasks = set()
+
+class AudioBatch:
+    """Аудио одного пользователя в один плейлист, пришедшие подряд."""
+
+    __slots__ = ("messages", "state", "done", "timer")
+
+    def __init__(self, state: FSMContext):
+        self.messages = []
+        self.state = state
+        self.done = asyncio.get_running_loop().create_future()
+        self.timer = None
 
 # Состояния для создания и удаления плейлиста
 class PlaylistStates(StatesGroup):
@@ -37,58 +94,178 @@ class PlaylistStates(StatesGroup):
     waiting_for_delete_confirmation = State()
 
 
+def debug_sample(message: str, *args) -> None:
+    """Пишет содержимое ответа в DEBUG-лог для доли LOG_SAMPLE_RATE запросов."""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        logger.debug(message, *args)
+
+def is_server_request(url) -> bool:
+    return bool(SERVER_URL) and str(url).startswith(SERVER_URL)
+
+async def on_request_start(session, context, params) -> None:
+    # Время замеряется в контексте трассировки своего запроса, параллельные запросы друг другу не мешают
+    context.started = time.perf_counter()
+    if pending_server_rtts and is_server_request(params.url):
+        samples = [pending_server_rtts.popleft() for _ in range(min(len(pending_server_rtts), SERVER_RTT_PER_REQUEST))]
+        params.headers["X-Bot-RTT"] = ", ".join(f"{path};{seconds:.4f}" for path, seconds in samples)
+
+async def on_request_end(session, context, params) -> None:
+    if is_server_request(params.url):
+        # До получения заголовков ответа; для /add_track сюда входит и выгрузка файла
+        pending_server_rtts.append((params.url.path, time.perf_counter() - context.started))
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общую сессию aiohttp с keep-alive пулом соединений."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        http_session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=TIMEOUT), trace_configs=[trace_config]
+        )
+    return http_session
+
+def default_playlists() -> dict:
+    return {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}
+
+def playlist_names(playlists) -> dict:
+    """Оставляет от списка плейлистов только названия: боту нужны лишь они, а кэш FSM хранится в базе."""
+    return {"playlists": [{"name": playlist["name"]} for playlist in playlists or []]}
+
 # Получение плейлистов с сервера с обработкой ошибок
-async def fetch_playlists(user_id: int) -> dict:
-    """Получает плейлисты пользователя с сервера."""
+async def fetch_playlists(user_id: int, state: FSMContext = None) -> dict:
+    """Получает плейлисты пользователя с сервера.
+
+    Если передан state, ответ кэшируется в FSM и перепроверяется по ETag:
+    при неизменных данных сервер отвечает 304 и используется кэш.
+    """
+    cached, headers = None, dict(SERVER_AUTH_HEADERS)
+    if state is not None:
+        data = await state.get_data()
+        cached = data.get("playlists")
+        if cached and data.get("playlists_etag"):
+            headers["If-None-Match"] = data["playlists_etag"]
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{SERVER_URL}/playlists",
-                json={"user_id": user_id},
-                timeout=TIMEOUT
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    logger.info(f"Получены плейлисты для user_{user_id}: {data}")
-                    return data
-                logger.error(f"Ошибка получения плейлистов: {response.status} - {await response.text()}")
-                return {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}  # Возвращаем дефолтный плейлист при ошибке
+        async with get_http_session().post(
+            f"{SERVER_URL}/playlists",
+            json={"user_id": user_id},
+            headers=headers
+        ) as response:
+            if response.status == 304:
+                return cached
+            if response.status == 200:
+                data = await response.json()
+                debug_sample("Получены плейлисты для user_%s: %s", user_id, data)
+                if state is not None:
+                    await state.update_data(playlists=playlist_names(data.get("playlists")),
+                                            playlists_etag=response.headers.get("ETag"))
+                return data
+            logger.error(f"Ошибка получения плейлистов: {response.status} - {await response.text()}")
     except Exception as e:
         logger.error(f"Ошибка при запросе плейлистов: {e}")
-        return {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}  # Возвращаем дефолтный плейлист при сбое
+    return cached or default_playlists()  # Возвращаем кэш или дефолтный плейлист при сбое
+
+async def get_playlists(user_id: int, state: FSMContext, revalidate: bool = False) -> list:
+    """Возвращает список плейлистов из кэша FSM, запрашивая сервер при промахе или перепроверке."""
+    data = await state.get_data()
+    playlists_data = data.get("playlists")
+    if revalidate or not playlists_data:
+        playlists_data = await fetch_playlists(user_id, state)
+    if not playlists_data or not playlists_data.get("playlists"):
+        playlists_data = default_playlists()
+    return playlists_data.get("playlists", [])
+
+def library_etag(user_id: int, version: int) -> str:
+    """ETag ответа /playlists для версии библиотеки (Server/server.py: get_playlists)."""
+    return f'"{user_id}-{version}"'
+
+async def remember_playlists(state: FSMContext, user_id: int, playlists, version=None) -> None:
+    """Обновляет кэш FSM списком плейлистов из ответа на изменение.
+
+    Ответ на изменение несет версию библиотеки, из нее собирается ETag,
+    и следующая перепроверка обходится ответом 304.
+    """
+    etag = library_etag(user_id, version) if version is not None else None
+    await state.update_data(playlists=playlist_names(playlists), playlists_etag=etag)
+
+async def remember_added(state: FSMContext, user_id: int, playlist_name: str, version=None) -> list:
+    """Обновляет кэш после добавления треков без запроса плейлистов и возвращает список плейлистов.
+
+    Добавление увеличивает версию на единицу, поэтому кэш предыдущей версии
+    достаточно дополнить плейлистом, если его еще не было. Иначе (кэш
+    устарел или версия неизвестна) список перепроверяется на сервере.
+    """
+    data = await state.get_data()
+    cached = (data.get("playlists") or {}).get("playlists")
+    if version is None or not cached or data.get("playlists_etag") != library_etag(user_id, version - 1):
+        return await get_playlists(user_id, state, revalidate=True)
+    if not any(playlist["name"] == playlist_name for playlist in cached):
+        cached = cached + [{"name": playlist_name}]
+    await remember_playlists(state, user_id, cached, version)
+    return cached
 
 # Создание плейлиста на сервере
-async def create_playlist(user_id: int, playlist_name: str) -> bool:
-    """Создает новый плейлист на сервере."""
+async def create_playlist(user_id: int, playlist_name: str):
+    """Создает новый плейлист на сервере и возвращает ответ ({"playlists", "version"}) или None."""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{SERVER_URL}/create_playlist",
-                json={
-                    "user_id": user_id,
-                    "playlist": {"name": playlist_name, "tracks": []}
-                },
-                timeout=TIMEOUT
-            ) as response:
-                return response.status == 200
+        async with get_http_session().post(
+            f"{SERVER_URL}/create_playlist",
+            json={
+                "user_id": user_id,
+                "playlist": {"name": playlist_name, "tracks": []}
+            },
+            headers=SERVER_AUTH_HEADERS
+        ) as response:
+            if response.status != 200:
+                return None
+            return await response.json()
     except Exception as e:
         logger.error(f"Ошибка при создании плейлиста: {e}")
-        return False
+        return None
 
 # Удаление плейлиста на сервере
-async def delete_playlist(user_id: int, playlist_name: str) -> bool:
-    """Удаляет плейлист на сервере."""
+async def delete_playlist(user_id: int, playlist_name: str):
+    """Удаляет плейлист на сервере и возвращает ответ ({"playlists", "version"}) или None."""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{SERVER_URL}/delete_playlist",
-                json={"user_id": user_id, "playlist_name": playlist_name},
-                timeout=TIMEOUT
-            ) as response:
-                return response.status == 200
+        async with get_http_session().post(
+            f"{SERVER_URL}/delete_playlist",
+            json={"user_id": user_id, "playlist_name": playlist_name},
+            headers=SERVER_AUTH_HEADERS
+        ) as response:
+            if response.status != 200:
+                return None
+            return await response.json()
     except Exception as e:
         logger.error(f"Ошибка при удалении плейлиста: {e}")
-        return False
+        return None
+
+# Поиск треков пользователя на сервере
+async def search_tracks(user_id: int, query: str) -> list:
+    """Возвращает найденные треки пользователя или пустой список при ошибке."""
+    try:
+        async with get_http_session().post(
+            f"{SERVER_URL}/search",
+            json={"user_id": user_id, "query": query, "limit": INLINE_SEARCH_LIMIT},
+            headers=SERVER_AUTH_HEADERS
+        ) as response:
+            if response.status != 200:
+                logger.error(f"Ошибка поиска: {response.status} - {await response.text()}")
+                return []
+            return (await response.json()).get("tracks", [])
+    except Exception as e:
+        logger.error(f"Ошибка при поиске треков: {e}")
+        return []
+
+# Потоковая передача тела ответа кусками ограниченного размера
+async def iter_response_chunks(response: aiohttp.ClientResponse):
+    async for chunk in response.content.iter_chunked(UPLOAD_CHUNK_SIZE):
+        yield chunk
 
 # Обновление клавиатуры
 def update_keyboard(playlists, current_playlist=None):
@@ -105,8 +282,28 @@ def update_keyboard(playlists, current_playlist=None):
 async def on_startup(_):
     logger.info("Бот запущен")
 
+async def on_shutdown(_):
+    if http_session is not None:
+        await http_session.close()
+    logger.info("Бот остановлен")
+
 
 
+# Поиск по своей библиотеке в inline-режиме: @бот название или исполнитель
+@dp.inline_handler()
+async def inline_search(inline_query: types.InlineQuery):
+    query = inline_query.query.strip()
+    tracks = await search_tracks(inline_query.from_user.id, query) if query else []
+    results = []
+    for track in tracks:
+        # Папка трека — track_<file_id> из Telegram, поэтому трек можно отправить без загрузки
+        file_id = track["id"][len("track_"):]
+        results.append(types.InlineQueryResultCachedAudio(
+            id=hashlib.md5(track["id"].encode()).hexdigest(),
+            audio_file_id=file_id
+        ))
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
 # Команда /start
 @dp.message_handler(commands=['start'])
 async def start(message: types.Message, state: FSMContext):
@@ -114,54 +311,100 @@ async def start(message: types.Message, state: FSMContext):
     await state.reset_state()
     user_id = message.from_user.id
     
-    playlists_data = await fetch_playlists(user_id)
-    if not playlists_data or not playlists_data.get("playlists"):
-        playlists_data = {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}
-    
-    await state.update_data(playlists=playlists_data, user_id=user_id, current_playlist=DEFAULT_PLAYLIST)
-    playlists = playlists_data.get("playlists", [])
+    await state.update_data(user_id=user_id, current_playlist=DEFAULT_PLAYLIST)
+    playlists = await get_playlists(user_id, state, revalidate=True)
     keyboard = update_keyboard(playlists, DEFAULT_PLAYLIST)
     await message.reply("🎵 Выберите плейлист или отправьте аудиофайл в 'Любимое':", reply_markup=keyboard)
 
-# Обработчик аудиофайлов
+# Обработчик аудиофайлов: аудио, пришедшие подряд (альбом, пересылка пачкой), загружаются одной пачкой
 @dp.message_handler(content_types=['audio'], state='*')
 async def handle_audio(message: types.Message, state: FSMContext):
     logger.info(f"Получен аудиофайл от user_{message.from_user.id}")
     try:
-        audio = message.audio
         data = await state.get_data()
         user_id = data.get('user_id')
         if not user_id:
             user_id = message.from_user.id
             await state.update_data(user_id=user_id)
         current_playlist = data.get("current_playlist", DEFAULT_PLAYLIST)
+    except Exception as e:
+        logger.error(f"Ошибка обработки аудио: {e}")
+        await message.reply(f"❌ Ошибка: {e}", reply_markup=await get_current_keyboard(message, state))
+        return
 
-        track_data = {
-            "user_id": user_id,
-            "file_id": audio.file_id,
-            "title": audio.title or "Без названия",
-            "artist": audio.performer or "Неизвестный исполнитель",
-            "playlist_name": current_playlist
-        }
-        
-        file = await bot.get_file(audio.file_id)
-        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file.file_path}"
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file_url) as file_response:
-                if file_response.status != 200:
-                    await message.reply("❌ Не удалось скачать аудиофайл", reply_markup=await get_current_keyboard(message, state))
-                    return
-                file_bytes = await file_response.read()
+    key = (user_id, current_playlist)
+    batch = audio_batches.get(key)
+    if batch is None:
+        batch = audio_batches[key] = AudioBatch(state)
+    batch.messages.append(message)
+    if batch.timer is not None:
+        batch.timer.cancel()
+    if len(batch.messages) >= AUDIO_BATCH_MAX:
+        flush_audio_batch(key)
+    else:
+        # Окно продлевается с каждым новым аудио, пачка уходит после паузы
+        batch.timer = asyncio.get_running_loop().call_later(AUDIO_BATCH_WINDOW, flush_audio_batch, key)
+    # Следующие аудио пользователя должны попасть в эту же пачку, не дожидаясь ее загрузки
+    release_order()
+    # Обработчик завершается вместе со своей пачкой
+    await asyncio.shield(batch.done)
+
+def flush_audio_batch(key) -> None:
+    batch = audio_batches.pop(key, None)
+    if batch is None:
+        return
+    task = asyncio.create_task(process_audio_batch(key[0], key[1], batch))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def process_audio_batch(user_id: int, playlist_name: str, batch: AudioBatch) -> None:
+    last_message = batch.messages[-1]
+    try:
+        if len(batch.messages) == 1:
+            await upload_audio(last_message, batch.state, user_id, playlist_name)
+        else:
+            await upload_audio_batch(batch.messages, batch.state, user_id, playlist_name)
+    except Exception as e:
+        logger.error(f"Ошибка обработки аудио: {e}")
+        try:
+            await last_message.reply(f"❌ Ошибка: {e}", reply_markup=await get_current_keyboard(last_message, batch.state))
+        except Exception as reply_error:
+            logger.error(f"Не удалось ответить пользователю: {reply_error}")
+    finally:
+        batch.done.set_result(None)
+
+def track_metadata(audio: types.Audio) -> dict:
+    return {
+        "file_id": audio.file_id,
+        "title": audio.title or "Без названия",
+        "artist": audio.performer or "Неизвестный исполнитель"
+    }
+
+async def upload_audio(message: types.Message, state: FSMContext, user_id: int, current_playlist: str):
+    """Загружает одно аудио: поток из Telegram сразу уходит на сервер без буферизации."""
+    audio = message.audio
+    track_data = {"user_id": user_id, **track_metadata(audio), "playlist_name": current_playlist}
+    
+    file = await bot.get_file(audio.file_id)
+    file_url = bot.server.file_url(BOT_TOKEN, file.file_path)
+    
+    # Файл не буферизуется целиком: загрузка с Telegram сразу уходит на сервер chunked-потоком
+    session = get_http_session()
+    async with transfer_semaphore:
+        async with session.get(file_url, timeout=aiohttp.ClientTimeout(total=UPLOAD_TIMEOUT)) as file_response:
+            if file_response.status != 200:
+                await message.reply("❌ Не удалось скачать аудиофайл", reply_markup=await get_current_keyboard(message, state))
+                return
 
             form_data = aiohttp.FormData()
             form_data.add_field("track_data", json.dumps(track_data), content_type="application/json")
-            form_data.add_field("file", file_bytes, filename=audio.file_name or "track.mp3", content_type="audio/mpeg")
+            form_data.add_field("file", iter_response_chunks(file_response), filename=audio.file_name or "track.mp3", content_type="audio/mpeg")
 
             async with session.post(
                 f"{SERVER_URL}/add_track",
                 data=form_data,
-                timeout=TIMEOUT
+                headers=SERVER_AUTH_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=UPLOAD_TIMEOUT)
             ) as response:
                 if response.status != 200:
                     error_text = await response.text()
@@ -172,22 +415,79 @@ async def handle_audio(message: types.Message, state: FSMContext):
                 if response_json.get("status") != "success":
                     await message.reply("❌ Ошибка при добавлении трека", reply_markup=await get_current_keyboard(message, state))
                     return
-                # Обновляем плейлисты после добавления трека
-                playlists_data = await fetch_playlists(user_id)
-                if not playlists_data or not playlists_data.get("playlists"):
-                    playlists_data = {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}
-                await state.update_data(playlists=playlists_data)
-                await message.reply(
-                    f"✅ Трек '{track_data['title']}' добавлен в '{current_playlist}'!",
-                    reply_markup=update_keyboard(playlists_data.get("playlists", []), current_playlist)
-                )
-    except Exception as e:
-        logger.error(f"Ошибка обработки аудио: {e}")
-        playlists_data = await fetch_playlists(user_id)
-        if not playlists_data or not playlists_data.get("playlists"):
-            playlists_data = {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}
-        await state.update_data(playlists=playlists_data)
-        await message.reply(f"❌ Ошибка: {e}", reply_markup=update_keyboard(playlists_data.get("playlists", []), current_playlist))
+
+    playlists = await remember_added(state, user_id, current_playlist, response_json.get("version"))
+    await message.reply(
+        f"✅ Трек '{track_data['title']}' добавлен в '{current_playlist}'!",
+        reply_markup=update_keyboard(playlists, current_playlist)
+    )
+
+async def download_audio(audio: types.Audio):
+    """Скачивает аудио из Telegram во временный файл; одновременных скачиваний не больше MAX_CONCURRENT_TRANSFERS."""
+    async with transfer_semaphore:
+        file = await bot.get_file(audio.file_id)
+        async with get_http_session().get(
+            bot.server.file_url(BOT_TOKEN, file.file_path), timeout=aiohttp.ClientTimeout(total=UPLOAD_TIMEOUT)
+        ) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Telegram ответил {response.status}")
+            tmp_file = tempfile.TemporaryFile()
+            try:
+                async for chunk in iter_response_chunks(response):
+                    tmp_file.write(chunk)
+            except BaseException:
+                tmp_file.close()
+                raise
+    tmp_file.seek(0)
+    return tmp_file
+
+async def upload_audio_batch(messages: list, state: FSMContext, user_id: int, playlist_name: str):
+    """Скачивает пачку аудио параллельно и загружает ее одним запросом /add_tracks, отвечая одной сводкой."""
+    downloads = await asyncio.gather(*(download_audio(message.audio) for message in messages), return_exceptions=True)
+    added, failed, version = 0, [], None
+    try:
+        tracks, files = [], []
+        for message, download in zip(messages, downloads):
+            metadata = track_metadata(message.audio)
+            if isinstance(download, BaseException):
+                logger.error(f"Не удалось скачать аудио {metadata['file_id']}: {download}")
+                failed.append(metadata["title"])
+                continue
+            tracks.append(metadata)
+            files.append((message.audio, download))
+
+        if tracks:
+            form_data = aiohttp.FormData()
+            form_data.add_field("batch_data", json.dumps({
+                "user_id": user_id, "playlist_name": playlist_name, "tracks": tracks
+            }), content_type="application/json")
+            for audio, tmp_file in files:
+                form_data.add_field("file", tmp_file, filename=audio.file_name or "track.mp3", content_type="audio/mpeg")
+            async with get_http_session().post(
+                f"{SERVER_URL}/add_tracks",
+                data=form_data,
+                headers=SERVER_AUTH_HEADERS,
+                timeout=aiohttp.ClientTimeout(total=UPLOAD_TIMEOUT)
+            ) as response:
+                if response.status == 200:
+                    result = await response.json()
+                    added = len(result.get("added", []))
+                    version = result.get("version")
+                    failed.extend(item.get("title") or item.get("file_id") for item in result.get("failed", []))
+                else:
+                    logger.error(f"Ошибка добавления пачки треков: {response.status} - {await response.text()}")
+                    failed.extend(track["title"] for track in tracks)
+    finally:
+        for download in downloads:
+            if not isinstance(download, BaseException):
+                download.close()
+
+    logger.info(f"Пачка аудио от user_{user_id}: добавлено {added} из {len(messages)}")
+    playlists = await remember_added(state, user_id, playlist_name, version) if added else await get_playlists(user_id, state)
+    text = f"{'✅' if added else '❌'} Добавлено треков в '{playlist_name}': {added} из {len(messages)}"
+    if failed:
+        text += "\nНе удалось добавить: " + ", ".join(failed)
+    await messages[-1].reply(text, reply_markup=update_keyboard(playlists, playlist_name))
 
 # Выбор плейлиста
 @dp.message_handler(lambda message: message.text.startswith("Выбрать "))
@@ -195,11 +495,7 @@ async def select_playlist(message: types.Message, state: FSMContext):
     logger.info(f"Выбор плейлиста от user_{message.from_user.id}")
     playlist_name = message.text.replace("Выбрать ", "").replace("✓ ", "")
     await state.update_data(current_playlist=playlist_name, user_id=message.from_user.id)
-    playlists_data = await fetch_playlists(message.from_user.id)
-    if not playlists_data or not playlists_data.get("playlists"):
-        playlists_data = {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}
-    await state.update_data(playlists=playlists_data)
-    playlists = playlists_data.get("playlists", [])
+    playlists = await get_playlists(message.from_user.id, state)
     await message.reply(
         f"✅ Выбран плейлист '{playlist_name}'. Теперь отправьте аудиофайл для добавления!",
         reply_markup=update_keyboard(playlists, playlist_name)
@@ -222,13 +518,11 @@ async def handle_playlist_name(message: types.Message, state: FSMContext):
         return
 
     user_id = message.from_user.id
-    success = await create_playlist(user_id, name)
-    if success:
-        playlists_data = await fetch_playlists(user_id)
-        if not playlists_data or not playlists_data.get("playlists"):
-            playlists_data = {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}
-        playlists = playlists_data.get("playlists", [])
-        await state.update_data(current_playlist=name, playlists=playlists_data)
+    result = await create_playlist(user_id, name)
+    if result is not None:
+        playlists = result.get("playlists", [])
+        await remember_playlists(state, user_id, playlists, result.get("version"))
+        await state.update_data(current_playlist=name)
         await message.reply(
             f"✅ Плейлист '{name}' создан! Теперь выберите его и отправьте аудиофайл:",
             reply_markup=update_keyboard(playlists, name)
@@ -236,7 +530,8 @@ async def handle_playlist_name(message: types.Message, state: FSMContext):
     else:
         await message.reply("❌ Ошибка создания плейлиста", reply_markup=ReplyKeyboardRemove())
     
-    await state.finish()
+    # Данные (текущий плейлист и кэш) сохраняются, сбрасывается только состояние
+    await state.reset_state(with_data=False)
 
 # Удаление плейлиста
 @dp.message_handler(lambda message: message.text == "Удалить плейлист")
@@ -266,14 +561,12 @@ async def confirm_delete_playlist(message: types.Message, state: FSMContext):
     current_playlist = data.get("current_playlist", DEFAULT_PLAYLIST)
     user_id = data.get("user_id")
 
-    success = await delete_playlist(user_id, current_playlist)
-    if success:
-        playlists_data = await fetch_playlists(user_id)
-        if not playlists_data or not playlists_data.get("playlists"):
-            playlists_data = {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}
-        playlists = playlists_data.get("playlists", [])
+    result = await delete_playlist(user_id, current_playlist)
+    if result is not None:
+        playlists = result.get("playlists", [])
+        await remember_playlists(state, user_id, playlists, result.get("version"))
         new_current = playlists[0]["name"] if playlists else DEFAULT_PLAYLIST
-        await state.update_data(current_playlist=new_current, playlists=playlists_data)
+        await state.update_data(current_playlist=new_current)
         await message.reply(
             f"✅ Плейлист '{current_playlist}' удален! Выбран новый плейлист: '{new_current}'. Отправьте аудиофайл!",
             reply_markup=update_keyboard(playlists, new_current)
@@ -281,26 +574,22 @@ async def confirm_delete_playlist(message: types.Message, state: FSMContext):
     else:
         await message.reply("❌ Ошибка при удалении плейлиста", reply_markup=await get_current_keyboard(message, state))
     
-    await state.finish()
+    await state.reset_state(with_data=False)
 
 # Отмена удаления плейлиста
 @dp.message_handler(lambda message: message.text == "Нет", state=PlaylistStates.waiting_for_delete_confirmation)
 async def cancel_delete_playlist(message: types.Message, state: FSMContext):
     await message.reply("❌ Удаление отменено", reply_markup=await get_current_keyboard(message, state))
-    await state.finish()
+    await state.reset_state(with_data=False)
 
 # Получение текущей клавиатуры
 async def get_current_keyboard(message, state):
     data = await state.get_data()
     user_id = data.get('user_id', message.from_user.id)
-    playlists_data = await fetch_playlists(user_id)
-    if not playlists_data or not playlists_data.get("playlists"):
-        playlists_data = {"playlists": [{"name": DEFAULT_PLAYLIST, "tracks": []}]}
-    await state.update_data(playlists=playlists_data)
-    playlists = playlists_data.get("playlists", [])
+    playlists = await get_playlists(user_id, state)
     current_playlist = data.get("current_playlist", DEFAULT_PLAYLIST)
     return update_keyboard(playlists, current_playlist)
 
 # Запуск бота
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
\ No newline at end of file
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""Хранилище состояний FSM aiogram во встроенной SQLite с разбиением по пользователям.
+
+Состояние и данные (текущий плейлист, кэш списка плейлистов) переживают
+перезапуск бота. Пользователи распределены по shards файлам базы по
+user_id % shards, а вебхук раздает пользователей воркерам по
+user_id % workers. Если число воркеров делит shards, каждый воркер пишет
+только в свои файлы; иначе файл делят несколько воркеров, и их записи
+разводит блокировка SQLite с повтором (см. SqliteStorage).
+"""
+import os
+import json
+import asyncio
+import sqlite3
+import threading
+from typing import Dict, Optional
+from aiogram.dispatcher.storage import BaseStorage
+
+FSM_SHARDS = 8
+# Ожидание блокировки внутри SQLite короткое: дальше запрос повторяется через asyncio.sleep, не останавливая цикл
+BUSY_TIMEOUT = 0.01
+RETRY_DELAY = 0.01
+RETRY_MAX_DELAY = 0.1
+RETRY_LIMIT = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    chat TEXT NOT NULL,
+    user TEXT NOT NULL,
+    state TEXT,
+    data TEXT,
+    bucket TEXT,
+    PRIMARY KEY (chat, user)
+) WITHOUT ROWID;
+"""
+
+SQL_SELECT = "SELECT state, data, bucket FROM fsm WHERE chat = ? AND user = ?"
+SQL_SET_STATE = (
+    "INSERT INTO fsm (chat, user, state) VALUES (?, ?, ?) "
+    "ON CONFLICT (chat, user) DO UPDATE SET state = excluded.state"
+)
+SQL_SET_DATA = (
+    "INSERT INTO fsm (chat, user, data) VALUES (?, ?, ?) "
+    "ON CONFLICT (chat, user) DO UPDATE SET data = excluded.data"
+)
+SQL_SET_BUCKET = (
+    "INSERT INTO fsm (chat, user, bucket) VALUES (?, ?, ?) "
+    "ON CONFLICT (chat, user) DO UPDATE SET bucket = excluded.bucket"
+)
+SQL_DELETE_EMPTY = "DELETE FROM fsm WHERE chat = ? AND user = ? AND state IS NULL AND data IS NULL AND bucket IS NULL"
+
+
+class SqliteStorage(BaseStorage):
+    """FSM-хранилище aiogram в shards файлах SQLite (WAL).
+
+    Запросы — поиск по первичному ключу в локальном файле, поэтому они
+    выполняются прямо в цикле событий, без пула потоков. Чтобы чужая
+    транзакция в том же файле не останавливала цикл, SQLite ждет блокировку
+    не дольше BUSY_TIMEOUT, а затем запрос повторяется после asyncio.sleep.
+    Соединения свои у каждого потока, как в хранилище сервера.
+    """
+
+    def __init__(self, directory: str, shards: int = FSM_SHARDS):
+        self._directory = directory
+        self._shards = shards
+        self._local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+        for shard in range(shards):
+            self._conn(shard).executescript(SCHEMA)
+
+    def _conn(self, shard: int) -> sqlite3.Connection:
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        conn = conns.get(shard)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self._directory, f"fsm-{shard}.sqlite3"), timeout=BUSY_TIMEOUT,
+                                   isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conns[shard] = conn
+        return conn
+
+    def _address(self, chat, user) -> tuple:
+        chat, user = self.check_address(chat=chat, user=user)
+        # Шард по пользователю: все чаты одного пользователя в одном файле
+        try:
+            shard = int(user) % self._shards
+        except (TypeError, ValueError):
+            shard = sum(str(user).encode()) % self._shards
+        return self._conn(shard), str(chat), str(user)
+
+    def _select(self, chat, user) -> tuple:
+        conn, chat, user = self._address(chat, user)
+        row = conn.execute(SQL_SELECT, (chat, user)).fetchone()
+        return row if row else (None, None, None)
+
+    def _write(self, sql: str, chat, user, value) -> None:
+        conn, chat, user = self._address(chat, user)
+        conn.execute(sql, (chat, user, value))
+        if value is None:
+            # Пользователь без состояния и данных не занимает строку
+            conn.execute(SQL_DELETE_EMPTY, (chat, user))
+
+    @staticmethod
+    async def _retry(operation, *args):
+        """Выполняет operation, повторяя ее, пока файл занят другим процессом."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + RETRY_LIMIT
+        delay = RETRY_DELAY
+        while True:
+            try:
+                return operation(*args)
+            except sqlite3.OperationalError as e:
+                message = str(e)
+                if ("locked" not in message and "busy" not in message) or loop.time() > deadline:
+                    raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+    def _update(self, column: int, sql: str, chat, user, changes: dict) -> None:
+        """Читает и дописывает JSON-колонку одной транзакцией: параллельные обновления других полей не теряются."""
+        conn, chat_key, user_key = self._address(chat, user)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(SQL_SELECT, (chat_key, user_key)).fetchone()
+            current = json.loads(row[column]) if row and row[column] else {}
+            current.update(changes)
+            conn.execute(sql, (chat_key, user_key, json.dumps(current, ensure_ascii=False)))
+            conn.execute("COMMIT")
+        except BaseException:
+            # COMMIT, упавший на "database is locked", оставляет транзакцию открытой:
+            # без отката повтор из _retry споткнется о BEGIN внутри транзакции
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    async def close(self):
+        for conn in getattr(self._local, "conns", {}).values():
+            conn.close()
+        self._local.conns = {}
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default: Optional[str] = None) -> Optional[str]:
+        state = (await self._retry(self._select, chat, user))[0]
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default: Optional[Dict] = None) -> Dict:
+        data = (await self._retry(self._select, chat, user))[1]
+        return json.loads(data) if data else dict(default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await self._retry(self._write, SQL_SET_STATE, chat, user, self.resolve_state(state))
+
+    async def set_data(self, *, chat=None, user=None, data: Dict = None):
+        await self._retry(self._write, SQL_SET_DATA, chat, user, json.dumps(data, ensure_ascii=False) if data else None)
+
+    async def update_data(self, *, chat=None, user=None, data: Dict = None, **kwargs):
+        await self._retry(self._update, 1, SQL_SET_DATA, chat, user, {**(data or {}), **kwargs})
+
+    async def reset_state(self, *, chat=None, user=None, with_data: bool = True):
+        await self.set_state(chat=chat, user=user, state=None)
+        if with_data:
+            await self.set_data(chat=chat, user=user, data={})
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default: Optional[dict] = None) -> Dict:
+        bucket = (await self._retry(self._select, chat, user))[2]
+        return json.loads(bucket) if bucket else dict(default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket: Dict = None):
+        await self._retry(self._write, SQL_SET_BUCKET, chat, user,
+                          json.dumps(bucket, ensure_ascii=False) if bucket else None)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket: Dict = None, **kwargs):
+        await self._retry(self._update, 2, SQL_SET_BUCKET, chat, user, {**(bucket or {}), **kwargs})
@@ -0,0 +1,78 @@
+"""Параллельная обработка апдейтов Telegram с сохранением порядка для каждого пользователя."""
+import asyncio
+import logging
+import contextvars
+
+logger = logging.getLogger(__name__)
+
+# Событие "очередь пользователя свободна" для обработчика, который сейчас выполняется
+_release = contextvars.ContextVar("release_order", default=None)
+
+
+def update_user_id(update: dict):
+    """Возвращает id пользователя (или чата), к которому относится апдейт, или None."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            sender = value.get(field)
+            if isinstance(sender, dict) and isinstance(sender.get("id"), int):
+                return sender["id"]
+    return None
+
+
+def release_order() -> None:
+    """Разрешает начать следующий апдейт того же пользователя, не дожидаясь конца текущего обработчика.
+
+    Нужен обработчикам, которые копят сообщения (пачки аудио) и ждут
+    следующих апдейтов. Вне OrderedProcessor ничего не делает.
+    """
+    released = _release.get()
+    if released is not None:
+        released.set()
+
+
+class OrderedProcessor:
+    """Апдейты разных пользователей обрабатываются параллельно (не больше limit сразу),
+    апдейты одного пользователя — строго по очереди поступления.
+
+    Каждый апдейт ждет событие предыдущего апдейта того же ключа, которое
+    выставляется по завершении обработчика или через release_order().
+    """
+
+    def __init__(self, handler, limit: int = 256):
+        self._handler = handler
+        self._limit = asyncio.Semaphore(limit)
+        self._tails = {}
+        self._tasks = set()
+
+    def submit(self, key, update) -> None:
+        previous = self._tails.get(key)
+        released = asyncio.Event()
+        self._tails[key] = released
+        task = asyncio.create_task(self._run(key, previous, released, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, previous, released: asyncio.Event, update) -> None:
+        try:
+            if previous is not None:
+                await previous.wait()
+            async with self._limit:
+                _release.set(released)
+                await self._handler(update)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта пользователя {key}: {e}")
+        finally:
+            released.set()
+            if self._tails.get(key) is released:
+                del self._tails[key]
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self) -> None:
+        """Дожидается всех принятых апдейтов."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
@@ -0,0 +1,389 @@
+"""Вебхук бота с несколькими процессами-воркерами за одним портом: python webhook.py --workers 4
+
+Принимающий процесс слушает порт вебхука, проверяет секрет и по user_id
+отправляет тело апдейта одному из воркеров через unix-сокет. Один
+пользователь всегда попадает к одному воркеру, а воркер обрабатывает
+апдейты разных пользователей параллельно, одного — по порядку
+(updates.OrderedProcessor). Состояния FSM лежат в общем SQLite-хранилище
+(fsm_storage), поэтому переживают перезапуск и смену числа воркеров.
+
+Telegram получает 200 только после записи апдейта в журнал (UpdateSpool).
+Воркер подтверждает каждый обработанный апдейт, подтвержденные удаляются
+из журнала, а неподтвержденные заново отправляются перезапущенному
+воркеру — упавший воркер не теряет принятые апдейты (доставка "хотя бы
+один раз").
+"""
+import os
+import json
+import hmac
+import signal
+import struct
+import asyncio
+import sqlite3
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from aiohttp import web
+from dotenv import load_dotenv
+from updates import OrderedProcessor, update_user_id
+from fsm_storage import FSM_SHARDS
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Публичный адрес без пути; если задан, при старте вызывается setWebhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Секрет, который Telegram присылает в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", os.cpu_count() or 1))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 256))
+# Журнал принятых, но еще не обработанных апдейтов
+WEBHOOK_SPOOL_FILE = os.getenv("WEBHOOK_SPOOL_FILE", "webhook_spool.sqlite3")
+WORKER_START_TIMEOUT = 60
+# Кадр апдейта: длина тела и ключ пользователя, затем JSON апдейта как его прислал Telegram
+FRAME = struct.Struct(">Iq")
+# Подтверждение воркера: update_id обработанного апдейта
+ACK = struct.Struct(">q")
+
+SPOOL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS updates (
+    update_id INTEGER PRIMARY KEY,
+    key INTEGER NOT NULL,
+    payload BLOB NOT NULL
+);
+"""
+
+
+class UpdateSpool:
+    """Журнал апдейтов в SQLite: запись до ответа Telegram, удаление по подтверждению воркера.
+
+    Запросы выполняются в пуле потоков (asyncio.to_thread), у каждого потока свое соединение.
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._local = threading.local()
+        self._conn().executescript(SPOOL_SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _add(self, update_id: int, key: int, payload: bytes) -> bool:
+        # Повторная доставка того же апдейта от Telegram не дублируется
+        return self._conn().execute("INSERT OR IGNORE INTO updates (update_id, key, payload) VALUES (?, ?, ?)",
+                                    (update_id, key, payload)).rowcount > 0
+
+    def _remove(self, update_ids: list) -> None:
+        self._conn().executemany("DELETE FROM updates WHERE update_id = ?", [(update_id,) for update_id in update_ids])
+
+    def _pending(self, workers: int, index: int) -> list:
+        return [
+            (update_id, key, payload)
+            for update_id, key, payload in self._conn().execute(
+                "SELECT update_id, key, payload FROM updates ORDER BY update_id"
+            )
+            if key % workers == index
+        ]
+
+    async def add(self, update_id: int, key: int, payload: bytes) -> bool:
+        """False, если апдейт уже в журнале и ждет подтверждения."""
+        return await asyncio.to_thread(self._add, update_id, key, payload)
+
+    async def remove(self, update_ids: list) -> None:
+        await asyncio.to_thread(self._remove, update_ids)
+
+    async def pending(self, workers: int, index: int) -> list:
+        """Неподтвержденные апдейты воркера index в порядке поступления."""
+        return await asyncio.to_thread(self._pending, workers, index)
+
+
+class WorkerLink:
+    """Соединение принимающего процесса с воркером.
+
+    После каждого подключения сначала заново отправляются неподтвержденные
+    апдейты воркера из журнала, потом новые. Подтверждения читаются
+    отдельной задачей и удаляют апдейты из журнала.
+    """
+
+    def __init__(self, socket_path: str, spool: UpdateSpool, workers: int, index: int):
+        self.socket_path = socket_path
+        self._spool = spool
+        self._workers = workers
+        self._index = index
+        self._writer = None
+        self._acks = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self, timeout: float) -> None:
+        async with self._lock:
+            await self._connect(timeout)
+
+    async def _connect(self, timeout: float) -> None:
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+                break
+            except OSError:
+                if asyncio.get_running_loop().time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self._writer = writer
+        self._acks = asyncio.create_task(self._read_acks(reader))
+        pending = await self._spool.pending(self._workers, self._index)
+        for update_id, key, payload in pending:
+            writer.write(FRAME.pack(len(payload), key) + payload)
+        await writer.drain()
+        if pending:
+            logger.info(f"Воркеру {self._index} повторно отправлено апдейтов: {len(pending)}")
+
+    async def _read_acks(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                (update_id,) = ACK.unpack(await reader.readexactly(ACK.size))
+                await self._spool.remove([update_id])
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+
+    async def deliver(self, update_id: int, key: int, payload: bytes) -> None:
+        """Записывает апдейт в журнал и отправляет воркеру.
+
+        sqlite3.Error — апдейт не записан; OSError — записан, но уйдет
+        воркеру только после переподключения. Запись идет под той же
+        блокировкой, что и переотправка, поэтому апдейт не уходит дважды.
+        """
+        async with self._lock:
+            if not await self._spool.add(update_id, key, payload):
+                return
+            if self._writer is None or self._writer.is_closing():
+                # Переотправка журнала после подключения включает и этот апдейт
+                await self._connect(timeout=1.0)
+                return
+            try:
+                self._writer.write(FRAME.pack(len(payload), key) + payload)
+                await self._writer.drain()
+            except OSError:
+                self.reset()
+                raise
+
+    def reset(self) -> None:
+        """Забывает соединение с упавшим воркером: следующая отправка подключится к новому."""
+        if self._acks is not None:
+            self._acks.cancel()
+            self._acks = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def close(self) -> None:
+        self.reset()
+
+
+def run_worker(socket_path: str) -> None:
+    """Точка входа процесса-воркера."""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(serve_worker(socket_path))
+
+
+async def serve_worker(socket_path: str) -> None:
+    import bot as bot_module
+    from aiogram import Bot, Dispatcher, types
+
+    Bot.set_current(bot_module.bot)
+    Dispatcher.set_current(bot_module.dp)
+
+    async def process(item: tuple) -> None:
+        update, writer = item
+        try:
+            await bot_module.dp.process_update(types.Update.to_object(update))
+        finally:
+            # Подтверждение и после ошибки обработчика: как и при polling, апдейт не повторяется.
+            # Если соединение уже закрыто, принимающий процесс отправит апдейт снова
+            if not writer.is_closing():
+                writer.write(ACK.pack(update["update_id"]))
+
+    processor = OrderedProcessor(process, MAX_CONCURRENT_UPDATES)
+    connections = set()
+
+    async def read_frames(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connections.add(writer)
+        try:
+            while True:
+                length, key = FRAME.unpack(await reader.readexactly(FRAME.size))
+                payload = await reader.readexactly(length)
+                processor.submit(key, (json.loads(payload), writer))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            # Принимающий процесс закрыл соединение или упал (ConnectionResetError, BrokenPipeError):
+            # неподтвержденные апдейты он отправит заново после переподключения
+            if not isinstance(e, asyncio.IncompleteReadError):
+                logger.warning(f"Соединение с принимающим процессом разорвано: {e}")
+        finally:
+            connections.discard(writer)
+            writer.close()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    await bot_module.on_startup(bot_module.dp)
+    server = await asyncio.start_unix_server(read_frames, path=socket_path)
+    logger.info(f"Воркер {os.getpid()} принимает апдейты на {socket_path}")
+    try:
+        await stopping.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        # Принятые апдейты дорабатываются и подтверждаются, чтобы не обрабатывать их повторно после перезапуска
+        await processor.drain()
+        for writer in connections:
+            try:
+                await writer.drain()
+            except OSError:
+                pass
+        await bot_module.on_shutdown(bot_module.dp)
+        await bot_module.dp.storage.close()
+        await (await bot_module.bot.get_session()).close()
+
+
+class WebhookFront:
+    """Принимающий процесс: HTTP-вебхук, запуск воркеров и маршрутизация апдейтов по user_id."""
+
+    def __init__(self, workers: int, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 spool_file: str = WEBHOOK_SPOOL_FILE):
+        self.workers = workers
+        self.path = path
+        self.secret = secret
+        self._spool = UpdateSpool(spool_file)
+        self._socket_dir = tempfile.mkdtemp(prefix="bot-workers-")
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = []
+        self._links = []
+        self._monitor = None
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=run_worker, args=(self._links[index].socket_path,),
+                                        name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        return process
+
+    async def on_startup(self, app: web.Application) -> None:
+        self._links = [
+            WorkerLink(os.path.join(self._socket_dir, f"worker-{i}.sock"), self._spool, self.workers, i)
+            for i in range(self.workers)
+        ]
+        self._processes = [self._spawn(i) for i in range(self.workers)]
+        await asyncio.gather(*(link.connect(WORKER_START_TIMEOUT) for link in self._links))
+        logger.info(f"Запущено воркеров бота: {self.workers}")
+        shards = int(os.getenv("FSM_SHARDS", FSM_SHARDS))
+        if shards % self.workers:
+            logger.warning(f"FSM_SHARDS={shards} не делится на число воркеров {self.workers}: "
+                           f"воркеры будут делить файлы FSM и ждать блокировок друг друга")
+        self._monitor = asyncio.create_task(self._watch())
+        if WEBHOOK_URL:
+            await set_webhook(WEBHOOK_URL.rstrip("/") + self.path, self.secret)
+
+    async def on_cleanup(self, app: web.Application) -> None:
+        if self._monitor is not None:
+            self._monitor.cancel()
+        for process in self._processes:
+            process.terminate()
+        # Соединения закрываются после выхода воркеров, чтобы принять подтверждения доработанных апдейтов
+        for process in self._processes:
+            await asyncio.to_thread(process.join, 30)
+        for link in self._links:
+            await link.close()
+
+    async def _watch(self) -> None:
+        """Перезапускает упавших воркеров; их пользователи ждут, пока воркер снова поднимется."""
+        while True:
+            await asyncio.sleep(1.0)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапуск")
+                    self._links[index].reset()
+                    self._processes[index] = self._spawn(index)
+                    # Неподтвержденные апдейты уходят новому воркеру, не дожидаясь следующего апдейта
+                    asyncio.create_task(self._reconnect(index))
+
+    async def _reconnect(self, index: int) -> None:
+        try:
+            await self._links[index].connect(WORKER_START_TIMEOUT)
+        except OSError as e:
+            logger.error(f"Не удалось подключиться к воркеру {index}: {e}")
+
+    async def receive_update(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(
+            request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.secret
+        ):
+            return web.Response(status=403)
+        payload = await request.read()
+        try:
+            update = json.loads(payload)
+        except ValueError:
+            return web.Response(status=400)
+        update_id = update.get("update_id") if isinstance(update, dict) else None
+        if not isinstance(update_id, int):
+            return web.Response(status=400)
+        user_id = update_user_id(update)
+        key = user_id if user_id is not None else update_id
+        try:
+            await self._links[key % self.workers].deliver(update_id, key, payload)
+        except sqlite3.Error as e:
+            # Апдейт не сохранен: Telegram повторит доставку
+            logger.error(f"Не удалось записать апдейт {update_id} в журнал: {e}")
+            return web.Response(status=503)
+        except OSError as e:
+            # Апдейт уже в журнале и уйдет воркеру после переподключения
+            logger.error(f"Воркер для апдейта {update_id} недоступен: {e}")
+        return web.Response()
+
+    async def health(self, request: web.Request) -> web.Response:
+        alive = sum(process.is_alive() for process in self._processes)
+        return web.json_response({"workers": self.workers, "alive": alive}, status=200 if alive else 503)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.receive_update)
+        app.router.add_get("/healthz", self.health)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+
+async def set_webhook(url: str, secret: str) -> None:
+    from aiogram import Bot
+    from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+
+    api_url = os.getenv("TELEGRAM_API_URL")
+    bot = Bot(token=os.getenv("BOT_TOKEN"),
+              server=TelegramAPIServer.from_base(api_url) if api_url else TELEGRAM_PRODUCTION)
+    try:
+        options = {"secret_token": secret} if secret else {}
+        await bot.set_webhook(url, max_connections=WEBHOOK_MAX_CONNECTIONS, **options)
+        logger.info(f"Вебхук установлен: {url}")
+    finally:
+        await (await bot.get_session()).close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Вебхук бота с несколькими воркерами")
+    parser.add_argument("--workers", type=int, default=BOT_WORKERS)
+    parser.add_argument("--host", default=WEBHOOK_HOST)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    args = parser.parse_args()
+    web.run_app(WebhookFront(max(1, args.workers)).make_app(), host=args.host, port=args.port, access_log=None)
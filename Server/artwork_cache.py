@@ -0,0 +1,187 @@
+import os
+import re
+import time
+import shutil
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from contextlib import contextmanager
+import requests
+
+logger = logging.getLogger(__name__)
+
+ITUNES_SEARCH_URL = "https://itunes.apple.com/search"
+HIT_TTL = 30 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+
+
+def normalize_key(artist: str, title: str) -> str:
+    """Нормализует пару (исполнитель, название) для ключа кэша."""
+    parts = []
+    for value in (artist, title):
+        value = unicodedata.normalize("NFKC", value or "").casefold().replace("ё", "е")
+        value = re.sub(r"[^\w]+", " ", value)
+        parts.append(" ".join(value.split()))
+    return "\x1f".join(parts)
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """Ссылается на файл жесткой ссылкой, а если это невозможно — копирует его.
+
+    Старый dst сначала удаляется, чтобы запись никогда не шла в общий inode.
+    """
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class RequestsTransport:
+    """Синхронные HTTP-запросы через requests. Другой транспорт подставляется атрибутом transport."""
+
+    def get_json(self, url: str, params: dict, timeout: float) -> dict:
+        with requests.get(url, params=params, timeout=timeout) as response:
+            response.raise_for_status()
+            return response.json()
+
+    def get_bytes(self, url: str, timeout: float) -> bytes:
+        with requests.get(url, timeout=timeout) as response:
+            response.raise_for_status()
+            return response.content
+
+
+class _Pending:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ArtworkCache:
+    """Общий для всех пользователей кэш поиска обложек в iTunes.
+
+    Результаты поиска (включая отрицательные) хранятся в SQLite с TTL,
+    сами обложки — по одному файлу на URL в `artwork_dir`. Одновременные
+    запросы одного ключа внутри процесса объединяются в один поход в сеть.
+    """
+
+    def __init__(self, artwork_dir: str, search_url: str = ITUNES_SEARCH_URL, timeout: float = 10,
+                 hit_ttl: float = HIT_TTL, negative_ttl: float = NEGATIVE_TTL):
+        self._artwork_dir = artwork_dir
+        self._db_path = os.path.join(artwork_dir, "lookups.sqlite3")
+        self._search_url = search_url
+        self._timeout = timeout
+        self._hit_ttl = hit_ttl
+        self._negative_ttl = negative_ttl
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.transport = RequestsTransport()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(artwork_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lookups ("
+                "key TEXT PRIMARY KEY, artwork TEXT, fetched_at REAL NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path, timeout=self._timeout)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def fetch_into(self, artist: str, title: str, save_path: str) -> bool:
+        """Кладет обложку в save_path. Возвращает False, если обложка не найдена."""
+        artwork_path = self.lookup(artist, title)
+        if artwork_path is None:
+            return False
+        link_or_copy(artwork_path, save_path)
+        return True
+
+    def lookup(self, artist: str, title: str):
+        """Возвращает путь к файлу обложки в общем хранилище или None."""
+        key = normalize_key(artist, title)
+        cached = self._read(key)
+        if cached is not None:
+            self.hits += 1
+            return cached or None
+        self.misses += 1
+
+        with self._lock:
+            pending = self._inflight.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._inflight[key] = _Pending()
+        if not leader:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = self._resolve(key, artist, title)
+            return pending.result
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            pending.event.set()
+
+    def _read(self, key: str):
+        """Возвращает путь из кэша, "" для свежего отрицательного результата или None при промахе."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT artwork, fetched_at FROM lookups WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        artwork, fetched_at = row
+        age = time.time() - fetched_at
+        if artwork is None:
+            return "" if age < self._negative_ttl else None
+        artwork_path = os.path.join(self._artwork_dir, artwork)
+        if age < self._hit_ttl and os.path.exists(artwork_path):
+            return artwork_path
+        return None
+
+    def _write(self, key: str, artwork) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO lookups (key, artwork, fetched_at) VALUES (?, ?, ?)",
+                (key, artwork, time.time())
+            )
+
+    def _resolve(self, key: str, artist: str, title: str):
+        logger.info(f"Запрос к iTunes API: '{artist} {title}'")
+        results = self.transport.get_json(
+            self._search_url, {"term": f"{artist} {title}", "entity": "song"}, self._timeout
+        ).get("results", [])
+        artwork_url = results[0].get("artworkUrl100") if results else None
+        if not artwork_url:
+            self._write(key, None)
+            return None
+
+        cover_url = artwork_url.replace("100x100", "600x600")
+        artwork = f"{hashlib.sha1(cover_url.encode()).hexdigest()}.jpeg"
+        artwork_path = os.path.join(self._artwork_dir, artwork)
+        if not os.path.exists(artwork_path):
+            logger.info(f"URL обложки: {cover_url}")
+            content = self.transport.get_bytes(cover_url, self._timeout)
+            tmp_path = f"{artwork_path}.tmp{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, artwork_path)
+        self._write(key, artwork)
+        return artwork_path
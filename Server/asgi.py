@@ -0,0 +1,197 @@
+"""ASGI-точка входа: uvicorn asgi:app --workers 4
+
+Аудио и статика отдаются асинхронно, чтение диска вынесено в пул потоков,
+поэтому медленный диск или клиент не занимает воркер целиком. Остальные
+маршруты обслуживает то же Flask-приложение через WsgiToAsgi, а обложки
+скачиваются общим aiohttp-клиентом. Синхронный режим (server.py, gunicorn)
+остается доступным без изменений.
+"""
+import os
+import re
+import time
+import stat
+import asyncio
+import mimetypes
+import logging
+import aiohttp
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_cookie
+from werkzeug.security import safe_join
+import server
+import metrics
+from audio_stream import CHUNK_SIZE, plan_response
+
+logger = logging.getLogger(__name__)
+
+STREAM_ROUTE = re.compile(r"^/stream/(\d+)/([^/]+)$")
+STATIC_PREFIX = "/static/"
+ASSET_PREFIX = "/assets/"
+STREAM_RULE = "/stream/<int:user_id>/<track>"
+STATIC_RULE = "/static/<path:path>"
+ASSET_RULE = "/assets/<path:path>"
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+
+flask_app = WsgiToAsgi(server.app)
+
+
+class AiohttpTransport:
+    """Транспорт ArtworkCache поверх aiohttp: запросы идут в цикле событий ASGI-сервера.
+
+    Задачи обложек выполняются в потоках очереди, поэтому корутины
+    передаются в цикл через run_coroutine_threadsafe.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, loop: asyncio.AbstractEventLoop):
+        self._session = session
+        self._loop = loop
+
+    async def _get_json(self, url: str, params: dict, timeout: float) -> dict:
+        async with self._session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            # iTunes отвечает с Content-Type text/javascript
+            return await response.json(content_type=None)
+
+    async def _get_bytes(self, url: str, timeout: float) -> bytes:
+        async with self._session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    def get_json(self, url: str, params: dict, timeout: float) -> dict:
+        return asyncio.run_coroutine_threadsafe(self._get_json(url, params, timeout), self._loop).result()
+
+    def get_bytes(self, url: str, timeout: float) -> bytes:
+        return asyncio.run_coroutine_threadsafe(self._get_bytes(url, timeout), self._loop).result()
+
+
+class RequestHeaders:
+    """Заголовки ASGI-запроса с доступом по имени без учета регистра."""
+
+    def __init__(self, scope):
+        self._headers = {}
+        for name, value in scope["headers"]:
+            self._headers[name.decode("latin-1").lower()] = value.decode("latin-1")
+
+    def get(self, name: str, default=None):
+        return self._headers.get(name.lower(), default)
+
+
+def read_range(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+
+async def send_simple(send, status: int, body: bytes = b"", content_type: str = "text/plain; charset=utf-8") -> int:
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())
+    ]})
+    await send({"type": "http.response.body", "body": body})
+    return status
+
+
+async def send_file(scope, send, path: str, mimetype: str, max_age: int, counter_labels: tuple = None,
+                    extra_headers: dict = None) -> int:
+    """Отдает файл с Range/ETag/304, читая его кусками в пуле потоков. Возвращает статус ответа.
+
+    С counter_labels отданные байты учитываются в metrics.STREAM_BYTES,
+    extra_headers дополняют или заменяют заголовки plan_response.
+    """
+    try:
+        st = await asyncio.to_thread(server.stat_cache.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        return await send_simple(send, 404, b"Not Found")
+    method = scope["method"]
+    status, headers, start, length = plan_response(st, RequestHeaders(scope), method, max_age)
+    if extra_headers:
+        headers.update(extra_headers)
+    response_headers = [(name.lower().encode(), value.encode()) for name, value in headers.items()]
+    if status != 304:
+        response_headers.append((b"content-length", str(length).encode()))
+    if status in (200, 206):
+        response_headers.append((b"content-type", mimetype.encode()))
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    if method == "HEAD" or status in (304, 416):
+        await send({"type": "http.response.body", "body": b""})
+        return status
+
+    end = start + length
+    while start < end:
+        chunk = await asyncio.to_thread(read_range, path, start, min(CHUNK_SIZE, end - start))
+        if not chunk:
+            break
+        start += len(chunk)
+        if counter_labels is not None:
+            metrics.STREAM_BYTES.inc(counter_labels, len(chunk))
+        # Медленный клиент задерживает только свою корутину, а не воркер
+        await send({"type": "http.response.body", "body": chunk, "more_body": start < end})
+    if start < end:
+        await send({"type": "http.response.body", "body": b""})
+    return status
+
+
+async def lifespan(receive, send) -> None:
+    session = None
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT))
+            server.artwork_cache.transport = AiohttpTransport(session, asyncio.get_running_loop())
+            logger.info("ASGI-режим: обложки скачиваются через aiohttp")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if session is not None:
+                await session.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def serve_native(scope, send):
+    """Отдает аудио и статику без Flask. Возвращает (шаблон маршрута, статус) или None, если запрос не наш."""
+    path = scope["path"]
+    match = STREAM_ROUTE.match(path)
+    if match and match.group(2).startswith("track_"):
+        headers = RequestHeaders(scope)
+        caller = server.request_user(headers, parse_cookie(headers.get("cookie")))
+        if not server.is_allowed(caller, match.group(1)):
+            return STREAM_RULE, await send_simple(send, 403, b"Forbidden")
+        audio_path = safe_join(server.PATH, f"user_{match.group(1)}", match.group(2), "song.mp3")
+        if audio_path is None:
+            return STREAM_RULE, await send_simple(send, 404, b"Not Found")
+        status = await send_file(scope, send, audio_path, "audio/mpeg", server.STREAM_MAX_AGE, ("asgi",))
+        return STREAM_RULE, status
+    if path.startswith(ASSET_PREFIX):
+        accept_encoding = RequestHeaders(scope).get("accept-encoding")
+        resolved = await asyncio.to_thread(server.static_assets.resolve, path[len(ASSET_PREFIX):], accept_encoding)
+        if resolved is None:
+            return ASSET_RULE, await send_simple(send, 404, b"Not Found")
+        file_path, encoding = resolved
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        headers = {"Cache-Control": server.ASSET_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return ASSET_RULE, await send_file(scope, send, file_path, mimetype, 0, extra_headers=headers)
+    if path.startswith(STATIC_PREFIX):
+        static_path = safe_join("static", path[len(STATIC_PREFIX):])
+        if static_path is None or not server.is_public_static(path[len(STATIC_PREFIX):]):
+            return STATIC_RULE, await send_simple(send, 404, b"Not Found")
+        mimetype = mimetypes.guess_type(static_path)[0] or "application/octet-stream"
+        return STATIC_RULE, await send_file(scope, send, static_path, mimetype, 0)
+    return None
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+        started = time.perf_counter()
+        served = await serve_native(scope, send)
+        if served is not None:
+            # Здесь время включает отдачу всего тела, а не только начало ответа
+            route, status = served
+            metrics.REQUEST_DURATION.observe(time.perf_counter() - started, (route, scope["method"]))
+            metrics.REQUESTS.inc((route, scope["method"], str(status)))
+            return
+    await flask_app(scope, receive, send)
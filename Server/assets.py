@@ -0,0 +1,177 @@
+"""Сборка статики: файлы с отпечатком содержимого в имени и заранее сжатые варианты.
+
+Собранные файлы лежат в static/build и отдаются по /assets/ с
+Cache-Control immutable: имя меняется вместе с содержимым, поэтому
+повторные визиты не делают запросов за CSS, JS и стандартной обложкой.
+Сборка идет при старте сервера или отдельно: python assets.py
+"""
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+import logging
+import threading
+from werkzeug.security import safe_join
+from covers import render_thumbnail
+
+try:
+    import brotli
+except ImportError:
+    # Без пакета brotli отдаются gzip и несжатые файлы
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+ASSETS = ("css/styles.css", "js/index.js")
+DEFAULT_COVER_ASSET = "css/standart.png"
+DEFAULT_COVER_SIZE = 600
+COMPRESSIBLE = (".css", ".js", ".svg", ".json")
+URL_PREFIX = "/assets/"
+ASSET_MAX_AGE = 365 * 24 * 3600
+CACHE_CONTROL = f"public, max-age={ASSET_MAX_AGE}, immutable"
+HASH_LENGTH = 12
+# Порядок предпочтения кодировок и суффиксы их файлов
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def fingerprint_name(name: str, digest: str) -> str:
+    """css/styles.css -> css/styles.<хэш>.css"""
+    root, ext = os.path.splitext(name)
+    return f"{root}.{digest}{ext}"
+
+
+def accepted_encodings(header: str) -> set:
+    """Кодировки из Accept-Encoding, кроме отключенных через q=0."""
+    encodings = set()
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            encodings.add(coding.strip().lower())
+    return encodings
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Пишет файл через временный: воркеры gunicorn собирают статику одновременно."""
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class StaticAssets:
+    """Манифест собранной статики: логическое имя -> имя файла с отпечатком.
+
+    Файлы с отпечатком не перезаписываются и не удаляются: старые версии
+    нужны клиентам, у которых еще открыта страница прошлого выпуска.
+    """
+
+    def __init__(self, static_dir: str, build_dir: str, assets: tuple = ASSETS,
+                 default_cover: str = DEFAULT_COVER_ASSET):
+        self.static_dir = static_dir
+        self.build_dir = build_dir
+        self.assets = assets
+        self.default_cover = default_cover
+        self.manifest = {}
+
+    def build(self) -> dict:
+        manifest = {}
+        for name in self.assets:
+            with open(os.path.join(self.static_dir, name), "rb") as f:
+                manifest[name] = self._emit(name, f.read())
+        cover_data = self._optimized_cover()
+        if cover_data is not None:
+            manifest[self.default_cover] = self._emit(self.default_cover, cover_data[1], cover_data[0])
+        self.manifest = manifest
+        logger.info(f"Статика собрана: {len(manifest)} файлов в {self.build_dir}")
+        return manifest
+
+    def _optimized_cover(self):
+        """Уменьшенная стандартная обложка в JPEG: (имя, байты).
+
+        Если JPEG вышел не меньше исходника, возвращается сам исходник;
+        None — исходника нет или его не удалось открыть.
+        """
+        source_path = os.path.join(self.static_dir, self.default_cover)
+        if not os.path.isfile(source_path):
+            return None
+        os.makedirs(self.build_dir, exist_ok=True)
+        tmp_path = os.path.join(self.build_dir, f"cover.tmp{os.getpid()}.{threading.get_ident()}")
+        try:
+            render_thumbnail(source_path, tmp_path, DEFAULT_COVER_SIZE, "jpeg")
+            with open(tmp_path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            logger.error(f"Не удалось уменьшить стандартную обложку: {e}")
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if len(data) >= os.path.getsize(source_path):
+            with open(source_path, "rb") as f:
+                return self.default_cover, f.read()
+        return os.path.splitext(self.default_cover)[0] + ".jpeg", data
+
+    def _emit(self, name: str, data: bytes, target_name: str = None) -> str:
+        """Кладет файл с отпечатком и его сжатые варианты, если их еще нет. Возвращает путь внутри build."""
+        built_name = fingerprint_name(target_name or name, content_hash(data))
+        path = os.path.join(self.build_dir, built_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+        if not built_name.endswith(COMPRESSIBLE):
+            return built_name
+        variants = {".gz": lambda: gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants[".br"] = lambda: brotli.compress(data, quality=11)
+        for suffix, compress in variants.items():
+            if os.path.exists(path + suffix):
+                continue
+            compressed = compress()
+            # Сжатый вариант, который не меньше исходника, не нужен
+            if len(compressed) < len(data):
+                write_atomic(path + suffix, compressed)
+        return built_name
+
+    def url(self, name: str) -> str:
+        """URL ресурса для шаблона; до сборки — обычный путь /static/."""
+        built_name = self.manifest.get(name)
+        if built_name is None:
+            return f"/static/{name}"
+        return URL_PREFIX + built_name
+
+    def resolve(self, path: str, accept_encoding: str):
+        """Файл для запроса /assets/<path>: (путь, кодировка или None) либо None, если такого нет.
+
+        Отдаются и файлы прошлых сборок: их имена тоже уникальны.
+        """
+        if path.endswith((".gz", ".br")) or ".tmp" in path:
+            return None
+        file_path = safe_join(self.build_dir, path)
+        if file_path is None or not os.path.isfile(file_path):
+            return None
+        accepted = accepted_encodings(accept_encoding)
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.isfile(file_path + suffix):
+                return file_path + suffix, encoding
+        return file_path, None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    build_dir = os.path.join("static", "build")
+    if "--clean" in sys.argv and os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    for name, built_name in StaticAssets("static", build_dir).build().items():
+        print(f"{name} -> {URL_PREFIX}{built_name}")
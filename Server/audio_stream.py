@@ -0,0 +1,175 @@
+import os
+import mmap
+import time
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from werkzeug.wsgi import wrap_file
+
+CHUNK_SIZE = 256 * 1024
+STAT_TTL = 2.0
+
+
+class StatCache:
+    """Кэш os.stat с коротким TTL, чтобы условные запросы не трогали диск."""
+
+    def __init__(self, ttl: float = STAT_TTL, max_entries: int = 4096):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def stat(self, path: str) -> os.stat_result:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None and cached[1] > now:
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+        st = os.stat(path)
+        with self._lock:
+            if len(self._entries) >= self._max_entries:
+                self._entries.clear()
+            self._entries[path] = (st, now + self._ttl)
+        return st
+
+    def forget(self, path: str) -> None:
+        with self._lock:
+            self._entries.pop(path, None)
+
+
+def make_etag(st: os.stat_result) -> str:
+    """Сильный ETag из размера, времени изменения и inode файла."""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}-{st.st_ino:x}"'
+
+
+def parse_range(header: str, size: int):
+    """Разбирает заголовок Range.
+
+    Возвращает (start, end) включительно, None если заголовок надо игнорировать,
+    или False если единственный диапазон невыполним. Несколько диапазонов
+    (multipart/byteranges) не поддерживаются и игнорируются: RFC 9110
+    разрешает ответить на них 200 с файлом целиком.
+    """
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes" or not spec:
+        return None
+    if "," in spec:
+        return None
+    start_text, sep, end_text = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not start_text:
+            suffix = int(end_text)
+            # У пустого файла нет ни одного байта, который можно отдать
+            if suffix <= 0 or size == 0:
+                return False
+            return max(size - suffix, 0), size - 1
+        start = int(start_text)
+        end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def if_range_matches(value: str, etag: str, st: os.stat_result) -> bool:
+    """Проверяет If-Range: сильное сравнение ETag или точное совпадение даты."""
+    value = value.strip()
+    if value.startswith('"') or value.startswith("W/"):
+        return value == etag
+    try:
+        return int(parsedate_to_datetime(value).timestamp()) == int(st.st_mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Проверяет If-None-Match (слабое сравнение, как требует RFC 9110)."""
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def iter_mmap(path: str, start: int, length: int):
+    """Отдает диапазон файла кусками memoryview поверх mmap."""
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                end = start + length
+                while start < end:
+                    chunk_end = min(start + CHUNK_SIZE, end)
+                    yield bytes(view[start:chunk_end])
+                    start = chunk_end
+            finally:
+                view.release()
+
+
+def plan_response(st: os.stat_result, headers_in, method: str, max_age: int = 86400) -> tuple:
+    """Решает, что отдать на запрос файла: (статус, заголовки, начало, длина).
+
+    headers_in — любой объект с методом get() по имени заголовка.
+    Для 304 и 416 длина равна нулю.
+    """
+    size = st.st_size
+    etag = make_etag(st)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": f"private, max-age={max_age}",
+        "Accept-Ranges": "bytes",
+    }
+
+    if_none_match = headers_in.get("If-None-Match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return 304, headers, 0, 0
+
+    byte_range = None
+    range_header = headers_in.get("Range")
+    if range_header and method == "GET":
+        if_range = headers_in.get("If-Range")
+        if not if_range or if_range_matches(if_range, etag, st):
+            byte_range = parse_range(range_header, size)
+    if byte_range is False:
+        headers["Content-Range"] = f"bytes */{size}"
+        return 416, headers, 0, 0
+
+    start, end = byte_range if byte_range else (0, size - 1)
+    length = end - start + 1 if size else 0
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return 206, headers, start, length
+    return 200, headers, start, length
+
+
+def stream_file(path: str, request, response_class, stat_cache: StatCache,
+                mimetype: str = "audio/mpeg", max_age: int = 86400):
+    """Отдает файл с поддержкой Range, If-Range, ETag и 304."""
+    st = stat_cache.stat(path)
+    status, headers, start, length = plan_response(st, request.headers, request.method, max_age)
+    if status in (304, 416):
+        return response_class(status=status, headers=headers)
+
+    if request.method == "HEAD" or length == 0:
+        response = response_class(status=status, headers=headers, mimetype=mimetype)
+        response.content_length = length
+        return response
+
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None:
+        # gunicorn отдает такой ответ через sendfile ровно на Content-Length байт с текущей позиции
+        f = open(path, "rb")
+        f.seek(start)
+        body = wrap_file(request.environ, f, CHUNK_SIZE)
+    else:
+        body = iter_mmap(path, start, length)
+    response = response_class(body, status=status, headers=headers, mimetype=mimetype,
+                              direct_passthrough=True)
+    response.content_length = length
+    return response
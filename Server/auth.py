@@ -0,0 +1,148 @@
+import hmac
+import json
+import time
+import base64
+import hashlib
+import threading
+import urllib.parse
+from collections import OrderedDict
+
+INIT_DATA_MAX_AGE = 24 * 3600
+SESSION_TTL = 3600
+CLOCK_SKEW = 60
+
+
+class AuthError(Exception):
+    """initData или токен сессии не прошли проверку."""
+
+
+class TTLCache:
+    """Ограниченный по размеру кэш с временем жизни записей (LRU при переполнении)."""
+
+    def __init__(self, max_entries: int = 10_000):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+def verify_init_data(init_data: str, bot_token: str, max_age: int = INIT_DATA_MAX_AGE) -> dict:
+    """Проверяет подпись initData Telegram Web App и свежесть auth_date.
+
+    Ключ — HMAC-SHA256 токена бота с ключом "WebAppData", подпись — HMAC
+    строки "key=value" всех полей, кроме hash, отсортированных и разделенных
+    переводом строки. Возвращает данные пользователя из поля user.
+    """
+    try:
+        fields = dict(urllib.parse.parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+    except ValueError:
+        raise AuthError("initData не разобраны")
+    received_hash = fields.pop("hash", None)
+    if not received_hash:
+        raise AuthError("В initData нет hash")
+    data_check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    expected_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_hash, received_hash):
+        raise AuthError("Неверная подпись initData")
+
+    try:
+        auth_date = int(fields["auth_date"])
+    except (KeyError, ValueError):
+        raise AuthError("В initData нет auth_date")
+    age = time.time() - auth_date
+    if age > max_age or age < -CLOCK_SKEW:
+        raise AuthError("initData устарели")
+
+    try:
+        user = json.loads(fields["user"])
+    except (KeyError, ValueError):
+        raise AuthError("В initData нет user")
+    if not isinstance(user, dict) or not isinstance(user.get("id"), int):
+        raise AuthError("В initData нет id пользователя")
+    return user
+
+
+def bot_auth_key(bot_token: str) -> str:
+    """Ключ для запросов бота к серверу: производный от токена, сам токен не передается."""
+    return hmac.new(bot_token.encode(), b"music-player-server", hashlib.sha256).hexdigest()
+
+
+class SessionAuth:
+    """Проверенные сессии Web App.
+
+    После проверки initData выдается короткий подписанный токен
+    "user_id.expires.signature". Проверенные токены и initData кэшируются
+    до истечения, поэтому повторные запросы не пересчитывают HMAC initData
+    и не разбирают JSON.
+    """
+
+    def __init__(self, bot_token: str, secret: str, session_ttl: int = SESSION_TTL,
+                 init_data_max_age: int = INIT_DATA_MAX_AGE, max_sessions: int = 10_000):
+        self._bot_token = bot_token
+        self._secret = secret.encode()
+        self._session_ttl = session_ttl
+        self._init_data_max_age = init_data_max_age
+        self._sessions = TTLCache(max_sessions)
+        self._init_data = TTLCache(max_sessions)
+        self._bot_key = bot_auth_key(bot_token) if bot_token else None
+
+    def _sign(self, payload: str) -> str:
+        digest = hmac.new(self._secret, payload.encode(), hashlib.sha256).digest()[:18]
+        return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+    def login(self, init_data: str) -> tuple:
+        """Проверяет initData и возвращает (user_id, токен, срок жизни токена в секундах)."""
+        if not self._bot_token:
+            raise AuthError("BOT_TOKEN не задан, проверить initData невозможно")
+        user_id = self._init_data.get(init_data)
+        if user_id is None:
+            user = verify_init_data(init_data, self._bot_token, self._init_data_max_age)
+            user_id = user["id"]
+            auth_date = int(dict(urllib.parse.parse_qsl(init_data))["auth_date"])
+            self._init_data.put(init_data, user_id, auth_date + self._init_data_max_age)
+        expires_at = int(time.time()) + self._session_ttl
+        payload = f"{user_id}.{expires_at}"
+        token = f"{payload}.{self._sign(payload)}"
+        self._sessions.put(token, user_id, expires_at)
+        return user_id, token, self._session_ttl
+
+    def authenticate(self, token: str):
+        """Возвращает user_id по токену сессии или None."""
+        if not token:
+            return None
+        user_id = self._sessions.get(token)
+        if user_id is not None:
+            return user_id
+        # Токен, выданный другим воркером или до перезапуска: проверяем подпись один раз
+        payload, _, signature = token.rpartition(".")
+        user_text, _, expires_text = payload.partition(".")
+        try:
+            user_id, expires_at = int(user_text), int(expires_text)
+        except ValueError:
+            return None
+        if expires_at <= time.time() or not hmac.compare_digest(self._sign(payload), signature):
+            return None
+        self._sessions.put(token, user_id, expires_at)
+        return user_id
+
+    def is_bot(self, key: str) -> bool:
+        return bool(self._bot_key and key and hmac.compare_digest(self._bot_key, key))
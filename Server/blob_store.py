@@ -0,0 +1,199 @@
+import os
+import sys
+import fcntl
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class HashingUpload:
+    """Временный файл загрузки внутри хранилища, считающий SHA-256 по мере записи.
+
+    Подставляется парсеру multipart вместо обычного временного файла, чтобы
+    загруженный трек попадал в хранилище переименованием, без повторного копирования.
+    """
+
+    def __init__(self, tmp_dir: str):
+        self.path = os.path.join(tmp_dir, f"{os.getpid()}.{threading.get_ident()}.{id(self)}.upload")
+        self._file = open(self.path, "w+b")
+        self._digest = hashlib.sha256()
+        self.committed = False
+
+    def write(self, data) -> int:
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+    def size(self) -> int:
+        """Сколько байт уже записано: известно и без Content-Length у потоковой загрузки."""
+        self._file.flush()
+        return os.fstat(self._file.fileno()).st_size
+
+    def close(self) -> None:
+        self._file.close()
+        if not self.committed:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class BlobStore:
+    """Контентно-адресуемое хранилище аудиофайлов.
+
+    Каждый уникальный файл хранится один раз под своим SHA-256, а папки
+    треков ссылаются на него жесткими ссылками. Счетчик ссылок — это
+    st_nlink блоба минус единица, поэтому /playlists, /stream и отдача
+    статики работают с путями треков без изменений. Если файловая система
+    не поддерживает жесткие ссылки, файл копируется без дедупликации.
+    """
+
+    def __init__(self, root: str):
+        self._root = root
+        self._tmp_dir = os.path.join(root, "tmp")
+        self._lock = threading.Lock()
+        os.makedirs(self._tmp_dir, exist_ok=True)
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self._root, digest[:2], digest[2:4], digest)
+
+    @contextmanager
+    def _locked(self):
+        # Блокировка и между потоками, и между воркерами gunicorn
+        with self._lock:
+            with open(os.path.join(self._root, ".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def open_upload(self) -> HashingUpload:
+        """Создает временный файл для потоковой записи загрузки."""
+        return HashingUpload(self._tmp_dir)
+
+    def ingest(self, stream, target_path: str) -> str:
+        """Пишет поток во временный файл, считая хэш, и привязывает target_path к блобу."""
+        if isinstance(stream, HashingUpload):
+            stream.committed = True
+            stream.close()
+            return self._commit(stream.path, stream.hexdigest(), target_path)
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self._tmp_dir, f"{os.getpid()}.{threading.get_ident()}.part")
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        return self._commit(tmp_path, digest.hexdigest(), target_path)
+
+    def adopt(self, path: str) -> str:
+        """Переносит уже существующий файл трека в хранилище."""
+        if os.stat(path).st_nlink > 1:
+            return ""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        tmp_path = os.path.join(self._tmp_dir, f"{os.getpid()}.{threading.get_ident()}.part")
+        os.link(path, tmp_path)
+        return self._commit(tmp_path, digest, path)
+
+    def _commit(self, tmp_path: str, digest: str, target_path: str) -> str:
+        blob_path = self.blob_path(digest)
+        link_tmp = f"{target_path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with self._locked():
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            try:
+                os.link(blob_path, link_tmp)
+            except OSError:
+                with open(blob_path, "rb") as src, open(link_tmp, "wb") as dst:
+                    while chunk := src.read(CHUNK_SIZE):
+                        dst.write(chunk)
+            # Прежний файл трека (если был) уходит атомарно; осиротевший блоб подберет collect()
+            os.replace(link_tmp, target_path)
+        logger.info(f"Файл {target_path} привязан к блобу {digest} (ссылок: {self.refcount(digest)})")
+        return digest
+
+    def refcount(self, digest: str) -> int:
+        """Число папок треков, ссылающихся на блоб."""
+        try:
+            return os.stat(self.blob_path(digest)).st_nlink - 1
+        except FileNotFoundError:
+            return 0
+
+    def release(self, path: str, digest: str = None) -> None:
+        """Удаляет файл трека и сам блоб, если на него больше никто не ссылается.
+
+        Без digest блоб ищется по inode полным обходом хранилища.
+        """
+        with self._locked():
+            st = os.stat(path)
+            os.remove(path)
+            if st.st_nlink != 2:
+                return
+            if digest:
+                blob_path = self.blob_path(digest)
+                if os.path.exists(blob_path) and os.stat(blob_path).st_ino == st.st_ino:
+                    os.remove(blob_path)
+                    logger.info(f"Удален блоб без ссылок: {blob_path}")
+            else:
+                self._remove_inode(st.st_ino)
+
+    def _remove_inode(self, inode: int) -> None:
+        for blob_path in self._iter_blobs():
+            if os.stat(blob_path).st_ino == inode:
+                os.remove(blob_path)
+                logger.info(f"Удален блоб без ссылок: {blob_path}")
+                return
+
+    def _iter_blobs(self):
+        for first in os.scandir(self._root):
+            if not first.is_dir() or first.path == self._tmp_dir:
+                continue
+            for second in os.scandir(first.path):
+                for entry in os.scandir(second.path):
+                    yield entry.path
+
+    def collect(self, dry_run: bool = False) -> list:
+        """Удаляет блобы, на которые не ссылается ни одна папка трека."""
+        removed = []
+        with self._locked():
+            for blob_path in self._iter_blobs():
+                if os.stat(blob_path).st_nlink == 1:
+                    removed.append(blob_path)
+                    if not dry_run:
+                        os.remove(blob_path)
+        return removed
+
+
+if __name__ == '__main__':
+    # Однократный перенос существующих song.mp3 в хранилище: python blob_store.py static/DB
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    db_root = sys.argv[1] if len(sys.argv) > 1 else "static/DB"
+    store = BlobStore(os.path.join(db_root, "blobs"))
+    for user_folder in os.listdir(db_root):
+        if not user_folder.startswith("user_"):
+            continue
+        user_dir = os.path.join(db_root, user_folder)
+        for track_folder in os.listdir(user_dir):
+            audio_path = os.path.join(user_dir, track_folder, "song.mp3")
+            if track_folder.startswith("track_") and os.path.isfile(audio_path):
+                store.adopt(audio_path)
@@ -0,0 +1,99 @@
+import os
+import hashlib
+import logging
+import threading
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+COVER_SIZES = (64, 200, 600)
+COVER_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+COVER_QUALITY = 82
+
+
+def snap_size(size: int) -> int:
+    """Приводит запрошенный размер к ближайшему допустимому не меньше него."""
+    for allowed in COVER_SIZES:
+        if size <= allowed:
+            return allowed
+    return COVER_SIZES[-1]
+
+
+def thumbnail_name(size: int, fmt: str) -> str:
+    return f"cover_{size}.{fmt}"
+
+
+def render_thumbnail(source_path: str, target_path: str, size: int, fmt: str) -> None:
+    """Сохраняет квадратную миниатюру обложки через временный файл."""
+    with Image.open(source_path) as image:
+        image = image.convert("RGB")
+        image.thumbnail((size, size), Image.LANCZOS)
+        tmp_path = f"{target_path}.tmp{os.getpid()}.{threading.get_ident()}"
+        image.save(tmp_path, COVER_FORMATS[fmt], quality=COVER_QUALITY, optimize=True)
+    os.replace(tmp_path, target_path)
+
+
+def generate_thumbnails(track_dir: str) -> None:
+    """Создает все размеры обложки трека рядом с cover.jpeg."""
+    source_path = os.path.join(track_dir, "cover.jpeg")
+    for size in COVER_SIZES:
+        for fmt in COVER_FORMATS:
+            render_thumbnail(source_path, os.path.join(track_dir, thumbnail_name(size, fmt)), size, fmt)
+    logger.info(f"Миниатюры обложки созданы: {track_dir}")
+
+
+class DerivedImageCache:
+    """Ограниченный по объему дисковый кэш производных изображений.
+
+    Используется для обложек, у которых нет заранее созданных миниатюр
+    (старые треки, стандартная обложка). При превышении лимита удаляются
+    файлы с самым давним временем последнего обращения.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._total_bytes = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def get(self, source_path: str, size: int, fmt: str) -> str:
+        """Возвращает путь к миниатюре, создавая её при промахе."""
+        st = os.stat(source_path)
+        key = hashlib.sha1(f"{os.path.abspath(source_path)}:{st.st_mtime_ns}:{size}".encode()).hexdigest()
+        target_path = os.path.join(self._cache_dir, f"{key}.{fmt}")
+        try:
+            os.utime(target_path)
+            self.hits += 1
+            return target_path
+        except FileNotFoundError:
+            self.misses += 1
+        render_thumbnail(source_path, target_path, size, fmt)
+        with self._lock:
+            self._total_bytes += os.path.getsize(target_path)
+            if self._total_bytes > self._max_bytes:
+                self._evict(keep=target_path)
+        return target_path
+
+    def _evict(self, keep: str) -> None:
+        entries = sorted(
+            (entry for entry in os.scandir(self._cache_dir) if entry.is_file()),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        total = sum(entry.stat().st_size for entry in entries)
+        # Чистим с запасом, чтобы не сканировать каталог на каждой новой миниатюре
+        low_watermark = self._max_bytes * 9 // 10
+        for entry in entries:
+            if total <= low_watermark:
+                break
+            if entry.path == keep:
+                continue
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except FileNotFoundError:
+                continue
+        self._total_bytes = total
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import random
+import socket
+import uuid
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKFILL = 10
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 5.0
+RETRY_MAX_DELAY = 600.0
+LEASE_SECONDS = 300.0
+POLL_INTERVAL = 1.0
+DONE_RETENTION = 24 * 3600
+CLAIM_SCAN = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    host TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    locked_by TEXT,
+    locked_until REAL,
+    finished_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs(status, priority, run_at);
+"""
+
+SQL_ENQUEUE = (
+    "INSERT INTO jobs (key, kind, payload, priority, host, run_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+    # Повторная постановка того же ключа: выполненная задача не повторяется,
+    # ждущая только повышает приоритет, упавшая ставится заново
+    "ON CONFLICT (key) DO UPDATE SET "
+    "priority = MIN(priority, excluded.priority), "
+    "payload = CASE WHEN status = 'failed' THEN excluded.payload ELSE payload END, "
+    "attempts = CASE WHEN status = 'failed' THEN 0 ELSE attempts END, "
+    "run_at = CASE WHEN status = 'failed' THEN excluded.run_at ELSE run_at END, "
+    "status = CASE WHEN status = 'failed' THEN 'pending' ELSE status END "
+    "WHERE status != 'done'"
+)
+SQL_RUNNING_BY_HOST = (
+    "SELECT host, COUNT(*) FROM jobs WHERE status = 'running' AND locked_until > ? AND host IS NOT NULL GROUP BY host"
+)
+SQL_CANDIDATES = (
+    "SELECT id, host FROM jobs "
+    "WHERE (status = 'pending' AND run_at <= ?) OR (status = 'running' AND locked_until <= ?) "
+    "ORDER BY priority, run_at, id LIMIT ?"
+)
+SQL_CLAIM = "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, locked_until = ? WHERE id = ?"
+SQL_SELECT_JOB = "SELECT kind, payload, attempts FROM jobs WHERE id = ?"
+# Завершить задачу может только держатель аренды: locked_by — уникальный для
+# каждого захвата токен, и он меняется, если после истечения аренды задачу
+# захватил другой обработчик
+SQL_DONE = (
+    "UPDATE jobs SET status = 'done', locked_by = NULL, locked_until = NULL, finished_at = ?, last_error = NULL "
+    "WHERE id = ? AND locked_by = ?"
+)
+SQL_RETRY = (
+    "UPDATE jobs SET status = 'pending', run_at = ?, locked_by = NULL, locked_until = NULL, last_error = ? "
+    "WHERE id = ? AND locked_by = ?"
+)
+SQL_FAILED = (
+    "UPDATE jobs SET status = 'failed', locked_by = NULL, locked_until = NULL, finished_at = ?, last_error = ? "
+    "WHERE id = ? AND locked_by = ?"
+)
+SQL_EXTEND = (
+    "UPDATE jobs SET locked_until = ? WHERE id = ? AND status = 'running' AND locked_by = ?"
+)
+SQL_PURGE = "DELETE FROM jobs WHERE status = 'done' AND finished_at < ?"
+
+
+class QueueFull(Exception):
+    """Очередь фоновых задач переполнена, задача с низким приоритетом не принята."""
+
+
+def retry_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """Экспоненциальная задержка с полным джиттером, чтобы повторы не приходили пачкой."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class JobQueue:
+    """Надежная очередь фоновых задач в локальной SQLite.
+
+    Задачи переживают перезапуск и общие для всех воркеров gunicorn: каждый
+    процесс запускает свои потоки, а захват задачи — транзакция с арендой
+    на `lease` секунд, после которой задача упавшего процесса снова
+    доступна. Задачи выбираются по приоритету (меньше — раньше), число
+    одновременных задач к одному внешнему хосту ограничено, повторы идут
+    с экспоненциальной задержкой и джиттером. Ключ задачи делает постановку
+    идемпотентной.
+
+    Пока обработчик работает, аренда продлевается каждые lease/3 секунд.
+    Если продлить не удалось (процесс завис дольше аренды), задачу может
+    выполнить и другой обработчик: завершит ее только тот, чья аренда
+    действует, поэтому обработчики должны быть идемпотентными.
+    """
+
+    def __init__(self, db_path: str, workers: int = 5, host_limit: int = 2, max_backlog: int = 10_000,
+                 max_attempts: int = MAX_ATTEMPTS, lease: float = LEASE_SECONDS):
+        self._db_path = db_path
+        self._workers = workers
+        self._host_limit = host_limit
+        self._max_backlog = max_backlog
+        self._max_attempts = max_attempts
+        self._lease = lease
+        self._handlers = {}
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.lost_leases = 0
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def register(self, kind: str, handler) -> None:
+        """Регистрирует обработчик handler(payload) для задач вида kind."""
+        self._handlers[kind] = handler
+
+    def enqueue(self, kind: str, payload: dict, key: str, priority: int = PRIORITY_INTERACTIVE,
+                host: str = None) -> None:
+        """Ставит задачу в очередь. Задача с тем же ключом не дублируется.
+
+        Задачи ниже интерактивного приоритета отклоняются с QueueFull,
+        если ждущих задач больше max_backlog.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            if priority > PRIORITY_INTERACTIVE:
+                depth = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+                if depth >= self._max_backlog:
+                    raise QueueFull(f"В очереди {depth} задач")
+            conn.execute(SQL_ENQUEUE, (key, kind, json.dumps(payload, ensure_ascii=False), priority, host, now, now))
+        self._wakeup.set()
+
+    def start(self) -> None:
+        """Запускает потоки-обработчики в текущем процессе."""
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        last_purge = 0.0
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._execute(*job)
+                    continue
+                if time.time() - last_purge > DONE_RETENTION / 24:
+                    last_purge = time.time()
+                    with self._transaction() as conn:
+                        conn.execute(SQL_PURGE, (last_purge - DONE_RETENTION,))
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка очереди задач: {e}")
+            # Задачи, поставленные другими процессами, подхватываются по таймауту
+            self._wakeup.wait(POLL_INTERVAL)
+            self._wakeup.clear()
+
+    def _claim(self):
+        now = time.time()
+        with self._transaction() as conn:
+            running = dict(conn.execute(SQL_RUNNING_BY_HOST, (now,)).fetchall())
+            for job_id, host in conn.execute(SQL_CANDIDATES, (now, now, CLAIM_SCAN)).fetchall():
+                if host is not None and running.get(host, 0) >= self._host_limit:
+                    continue
+                owner = f"{self._worker_id}:{uuid.uuid4().hex}"
+                conn.execute(SQL_CLAIM, (owner, now + self._lease, job_id))
+                kind, payload, attempts = conn.execute(SQL_SELECT_JOB, (job_id,)).fetchone()
+                return job_id, kind, json.loads(payload), attempts, owner
+        return None
+
+    def _heartbeat(self, job_id: int, owner: str, done: threading.Event) -> None:
+        """Продлевает аренду, пока обработчик работает; останавливается, если аренду перехватили."""
+        while not done.wait(self._lease / 3):
+            try:
+                extended = self._conn().execute(
+                    SQL_EXTEND, (time.time() + self._lease, job_id, owner)
+                ).rowcount
+            except sqlite3.Error as e:
+                logger.warning(f"Не удалось продлить аренду задачи #{job_id}: {e}")
+                continue
+            if not extended:
+                return
+
+    def _execute(self, job_id: int, kind: str, payload: dict, attempts: int, owner: str) -> None:
+        handler = self._handlers.get(kind)
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, owner, done),
+                                     name=f"job-lease-{job_id}", daemon=True)
+        heartbeat.start()
+        try:
+            if handler is None:
+                raise LookupError(f"Нет обработчика для задач '{kind}'")
+            handler(payload)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            with self._transaction() as conn:
+                if attempts >= self._max_attempts or handler is None:
+                    updated = conn.execute(SQL_FAILED, (time.time(), error, job_id, owner)).rowcount
+                    if updated:
+                        logger.error(f"Задача {kind}#{job_id} не выполнена после {attempts} попыток: {error}")
+                else:
+                    delay = retry_delay(attempts)
+                    updated = conn.execute(SQL_RETRY, (time.time() + delay, error, job_id, owner)).rowcount
+                    if updated:
+                        logger.warning(f"Задача {kind}#{job_id} упала ({error}), повтор через {delay:.1f} с")
+        else:
+            with self._transaction() as conn:
+                updated = conn.execute(SQL_DONE, (time.time(), job_id, owner)).rowcount
+        finally:
+            done.set()
+            heartbeat.join()
+        if not updated:
+            self.lost_leases += 1
+            logger.warning(f"Аренда задачи {kind}#{job_id} истекла до завершения, результат попытки {attempts} "
+                           f"не записан")
+
+    def stats(self) -> dict:
+        """Глубина очереди, задержка самой старой готовой задачи и занятость хостов."""
+        now = time.time()
+        conn = self._conn()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        by_priority = dict(conn.execute(
+            "SELECT priority, COUNT(*) FROM jobs WHERE status = 'pending' GROUP BY priority"
+        ).fetchall())
+        oldest = conn.execute(
+            "SELECT MIN(run_at) FROM jobs WHERE status = 'pending' AND run_at <= ?", (now,)
+        ).fetchone()[0]
+        return {
+            "depth": counts.get("pending", 0),
+            "running": counts.get("running", 0),
+            "failed": counts.get("failed", 0),
+            "done": counts.get("done", 0),
+            "lag": round(now - oldest, 3) if oldest is not None else 0.0,
+            "by_priority": {str(priority): count for priority, count in by_priority.items()},
+            "hosts": dict(conn.execute(SQL_RUNNING_BY_HOST, (now,)).fetchall()),
+            "workers": len(self._threads),
+            "lost_leases": self.lost_leases,
+        }
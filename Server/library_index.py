@@ -0,0 +1,261 @@
+import copy
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from search_index import TrackSearchIndex, SEARCH_LIMIT
+
+logger = logging.getLogger(__name__)
+
+
+class PlaylistChanged(Exception):
+    """Плейлист изменился после того, как клиент получил курсор страницы."""
+
+    def __init__(self, summary: dict):
+        super().__init__(f"Плейлист '{summary['name']}' изменился, версия {summary['version']}")
+        self.summary = summary
+
+
+class UserLibrary:
+    """Снимок библиотеки пользователя: плейлисты, метаданные треков по имени папки и версия.
+
+    Поисковый индекс строится при первом поиске и дальше обновляется вместе с треками.
+    Списки треков плейлистов с подставленными данными (resolved) собираются
+    один раз и сбрасываются при изменении плейлистов или треков; на месте
+    записей без данных трека в них стоит None, поэтому позиции совпадают с
+    позициями записей плейлиста.
+    """
+
+    __slots__ = ("playlists", "tracks", "version", "search", "resolved")
+
+    def __init__(self, playlists: list, tracks: dict, version: int = 0):
+        self.playlists = playlists
+        self.tracks = tracks
+        self.version = version
+        self.search = None
+        self.resolved = None
+
+
+class LibraryIndex:
+    """Общий для процесса LRU-индекс библиотек пользователей.
+
+    Библиотека пользователя читается с диска один раз через `loader(user_id)`,
+    дальше обновляется маршрутами изменения и вытесняется, когда превышен
+    лимит пользователей или суммарного числа треков. Если задан
+    `version_of(user_id)`, обращение сверяет версию с хранилищем и
+    перечитывает библиотеку, измененную другим процессом. Чтобы запрос
+    читал версию из хранилища один раз, методы принимают уже известную
+    версию `version` (например, полученную из version()).
+    """
+
+    def __init__(self, loader, max_users: int = 512, max_tracks: int = 500_000, version_of=None):
+        self._loader = loader
+        self._version_of = version_of
+        self._max_users = max_users
+        self._max_tracks = max_tracks
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._track_count = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, version: int = None) -> UserLibrary:
+        """Возвращает библиотеку пользователя, загружая её при промахе или устаревшей версии.
+
+        Загрузка идет вне общей блокировки: остальные пользователи ее не ждут,
+        а параллельные запросы того же пользователя ждут одну загрузку.
+        С `version` версия хранилища не читается: библиотека не старше нее считается свежей.
+        """
+        key = str(user_id)
+        current = version
+        if current is None and self._version_of is not None:
+            current = self._version_of(user_id)
+        with self._lock:
+            library = self._entries.get(key)
+            if library is not None and (current is None or library.version >= current):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return library
+            loading = self._loading.get(key)
+            owner = loading is None
+            if owner:
+                self.misses += 1
+                loading = self._loading[key] = Future()
+        if not owner:
+            return loading.result()
+        try:
+            playlists, tracks, version = self._loader(user_id)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[key]
+            library = self._entries.get(key)
+            # Пока шла загрузка, маршрут этого процесса мог записать более новую версию
+            if library is None or library.version <= version:
+                if library is not None:
+                    self._track_count -= len(library.tracks)
+                library = UserLibrary(playlists, tracks, version)
+                self._entries[key] = library
+                self._track_count += len(tracks)
+                self._evict()
+                logger.info(f"Библиотека user_{user_id} загружена в индекс: {len(tracks)} треков")
+        loading.set_result(library)
+        return library
+
+    def version(self, user_id) -> int:
+        """Возвращает версию библиотеки пользователя, не собирая плейлисты."""
+        return self.get(user_id).version
+
+    def resolve(self, user_id, since: int = None, version: int = None) -> tuple:
+        """Возвращает (версия, плейлисты) с подставленными данными треков в порядке playlists.json.
+
+        С `since` в ответ попадают только плейлисты, измененные после этой версии.
+        """
+        library = self.get(user_id, version)
+        with self._lock:
+            resolved = self._resolved(library)
+            result = []
+            for playlist, tracks in zip(library.playlists, resolved):
+                if since is not None and playlist.get("version", 0) <= since:
+                    continue
+                result.append({**playlist, "tracks": [dict(track) for track in tracks if track is not None]})
+            return library.version, result
+
+    def summaries(self, user_id, version: int = None) -> tuple:
+        """Возвращает (версия, [{"name", "count", "version"}]) без данных треков."""
+        library = self.get(user_id, version)
+        with self._lock:
+            resolved = self._resolved(library)
+            return library.version, [
+                self._summary(playlist, tracks) for playlist, tracks in zip(library.playlists, resolved)
+            ]
+
+    def summary(self, user_id, playlist_name: str, version: int = None):
+        """Возвращает {"name", "count", "version"} плейлиста или None, если его нет."""
+        library = self.get(user_id, version)
+        with self._lock:
+            index = self._find(library, playlist_name)
+            if index is None:
+                return None
+            return self._summary(library.playlists[index], self._resolved(library)[index])
+
+    @staticmethod
+    def _summary(playlist: dict, tracks: list) -> dict:
+        # count — число позиций плейлиста, включая записи треков без данных
+        return {"name": playlist["name"], "count": len(tracks), "version": playlist.get("version", 0)}
+
+    @staticmethod
+    def _find(library: UserLibrary, playlist_name: str):
+        for index, playlist in enumerate(library.playlists):
+            if playlist["name"] == playlist_name:
+                return index
+        return None
+
+    def page(self, user_id, playlist_name: str, cursor: int, limit: int, playlist_version: int = None,
+             version: int = None):
+        """Возвращает до limit треков плейлиста с позиции cursor или None, если плейлиста нет.
+
+        Курсор — позиция записи в плейлисте, каждый трек страницы несет свою
+        позицию ("position"). Записи треков без данных пропускаются, но
+        позиции не сдвигают. Удаление треков меняет версию плейлиста, поэтому
+        курсор действителен только для версии плейлиста, с которой он получен:
+        если playlist_version не совпадает с текущей, поднимается PlaylistChanged.
+        """
+        library = self.get(user_id, version)
+        with self._lock:
+            index = self._find(library, playlist_name)
+            if index is None:
+                return None
+            playlist = library.playlists[index]
+            resolved = self._resolved(library)[index]
+            if playlist_version is not None and playlist_version != playlist.get("version", 0):
+                raise PlaylistChanged(self._summary(playlist, resolved))
+            tracks = []
+            position = cursor
+            while position < len(resolved) and len(tracks) < limit:
+                track = resolved[position]
+                if track is not None:
+                    tracks.append({**track, "position": position})
+                position += 1
+            return {
+                "name": playlist["name"],
+                "version": playlist.get("version", 0),
+                "count": len(resolved),
+                "cursor": cursor,
+                "next_cursor": position if position < len(resolved) else None,
+                "tracks": tracks
+            }
+
+    @staticmethod
+    def _resolved(library: UserLibrary) -> list:
+        """Списки данных треков по позициям плейлистов; собираются один раз на версию библиотеки."""
+        if library.resolved is None:
+            library.resolved = [
+                [library.tracks.get(entry.get("id")) for entry in playlist.get("tracks", [])]
+                for playlist in library.playlists
+            ]
+        return library.resolved
+
+    def names(self, user_id, version: int = None) -> list:
+        """Возвращает имена всех плейлистов пользователя в порядке playlists.json."""
+        library = self.get(user_id, version)
+        with self._lock:
+            return [playlist["name"] for playlist in library.playlists]
+
+    def search(self, user_id, query: str, limit: int = SEARCH_LIMIT) -> list:
+        """Ищет треки пользователя по названию и исполнителю, подходит для набора по мере ввода."""
+        library = self.get(user_id)
+        with self._lock:
+            if library.search is None:
+                library.search = TrackSearchIndex()
+                library.search.add_many(
+                    (track_folder, track.get("title", ""), track.get("artist", ""))
+                    for track_folder, track in library.tracks.items()
+                )
+            return [
+                {"id": track_folder, **library.tracks[track_folder]}
+                for track_folder in library.search.search(query, limit)
+            ]
+
+    def put_track(self, user_id, track_folder: str, track: dict) -> None:
+        """Добавляет или обновляет трек в уже загруженной библиотеке."""
+        with self._lock:
+            library = self._entries.get(str(user_id))
+            if library is None:
+                return
+            if track_folder not in library.tracks:
+                self._track_count += 1
+            library.tracks[track_folder] = dict(track)
+            library.resolved = None
+            if library.search is not None:
+                library.search.add(track_folder, track.get("title", ""), track.get("artist", ""))
+            self._evict()
+
+    def set_playlists(self, user_id, playlists: list, version: int) -> None:
+        """Заменяет плейлисты уже загруженной библиотеки после записи на диск."""
+        with self._lock:
+            library = self._entries.get(str(user_id))
+            if library is not None and version >= library.version:
+                library.playlists = copy.deepcopy(playlists)
+                library.version = version
+                library.resolved = None
+
+    def invalidate(self, user_id) -> None:
+        """Удаляет библиотеку пользователя из индекса."""
+        with self._lock:
+            library = self._entries.pop(str(user_id), None)
+            if library is not None:
+                self._track_count -= len(library.tracks)
+
+    def _evict(self) -> None:
+        # Последний добавленный пользователь не вытесняется, даже если он один превышает лимит
+        while len(self._entries) > 1 and (
+            len(self._entries) > self._max_users or self._track_count > self._max_tracks
+        ):
+            user_key, library = self._entries.popitem(last=False)
+            self._track_count -= len(library.tracks)
+            logger.info(f"Библиотека user_{user_key} вытеснена из индекса")
@@ -0,0 +1,168 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек в секундах
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labelnames: tuple, labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value) if value != float("inf") else "+Inf"
+    return str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Монотонный счетчик."""
+
+    kind = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_total(self, labels: tuple, value: float) -> None:
+        """Для счетчиков, которые ведет сам объект (кэши): переносит накопленное значение."""
+        with self._lock:
+            self._values[labels] = value
+
+    def collect(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in values
+        ]
+
+
+class Gauge(Counter):
+    """Текущее значение (глубина очереди и т.п.), выставляется перед выдачей /metrics."""
+
+    kind = "gauge"
+
+    def set(self, labels: tuple, value: float) -> None:
+        self.set_total(labels, value)
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными корзинами: наблюдение — бинарный поиск и инкремент под замком."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # Счетчики по корзинам (последняя — +Inf), сумма, количество
+                series = self._values[labels] = [[0] * (len(self._buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, labels: tuple = ()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def collect(self) -> list:
+        with self._lock:
+            values = sorted((labels, (list(series[0]), series[1], series[2])) for labels, series in self._values.items())
+        lines = self.header()
+        bounds = [_format_value(float(bound)) for bound in self._buckets] + ["+Inf"]
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="' + bound + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            suffix = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{suffix} {_format_value(total)}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса в текстовом формате Prometheus.
+
+    Метрики живут в памяти процесса: при нескольких воркерах gunicorn
+    каждый отдает свои значения, а суммирует их Prometheus.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "Время обработки запроса до начала ответа", ("route", "method")
+)
+REQUESTS = REGISTRY.counter("http_requests_total", "Число запросов", ("route", "method", "status"))
+PHASE_DURATION = REGISTRY.histogram("phase_duration_seconds", "Время этапов обработки", ("phase",))
+STREAM_BYTES = REGISTRY.counter("stream_bytes_total", "Байт аудио, отданных клиентам", ("server",))
+CACHE_REQUESTS = REGISTRY.counter("cache_requests_total", "Обращения к кэшам", ("cache", "result"))
+JOB_QUEUE_JOBS = REGISTRY.gauge("job_queue_jobs", "Задачи фоновой очереди по состояниям", ("status",))
+JOB_QUEUE_LAG = REGISTRY.gauge("job_queue_lag_seconds", "Задержка самой старой готовой задачи")
+BOT_RTT = REGISTRY.histogram(
+    "bot_server_rtt_seconds", "Время запроса бота к серверу, измеренное ботом", ("route",),
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+
+
+def phase(name: str):
+    """Замер этапа: with metrics.phase("load_playlists"): ..."""
+    return PHASE_DURATION.time((name,))
@@ -0,0 +1,256 @@
+import os
+import sys
+import mmap
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PEAKS_COUNT = 256
+PEAKS_MAGIC = b"PKS1"
+# Заголовок файла пиков: сигнатура, число значений, длительность в миллисекундах; дальше по байту на значение
+PEAKS_HEADER = struct.Struct(">4sHI")
+MAX_RESYNC = 64 * 1024
+
+# Битрейты в кбит/с по (MPEG-1?, слой)
+BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+class FrameHeader:
+    __slots__ = ("mpeg1", "layer", "bitrate", "sample_rate", "mono", "length", "samples", "side_info", "crc")
+
+    def __init__(self, mpeg1, layer, bitrate, sample_rate, mono, length, samples, side_info, crc):
+        self.mpeg1 = mpeg1
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.mono = mono
+        self.length = length
+        self.samples = samples
+        self.side_info = side_info
+        # Байты CRC сразу за заголовком (бит protection равен 0); side info идет после них
+        self.crc = crc
+
+
+def parse_header(data, pos: int):
+    """Разбирает 4-байтовый заголовок кадра MPEG audio или возвращает None."""
+    if pos + 4 > len(data):
+        return None
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    if data[pos] != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version = (b1 >> 3) & 3
+    layer = 4 - ((b1 >> 1) & 3)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 1
+    mono = (b3 >> 6) == 3
+    crc = 0 if b1 & 1 else 2
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+        samples = 384
+    elif layer == 2 or mpeg1:
+        length = 144 * bitrate // sample_rate + padding
+        samples = 1152
+    else:
+        length = 72 * bitrate // sample_rate + padding
+        samples = 576
+    if layer == 3:
+        side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    else:
+        side_info = 0
+    return FrameHeader(mpeg1, layer, bitrate, sample_rate, mono, length, samples, side_info, crc)
+
+
+def skip_id3v2(data) -> int:
+    if len(data) >= 10 and data[:3] == b"ID3":
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def find_frame(data, pos: int):
+    """Ищет начало кадра, за которым идет еще один корректный кадр."""
+    limit = min(len(data), pos + MAX_RESYNC)
+    while pos < limit:
+        pos = data.find(b"\xff", pos, limit)
+        if pos < 0:
+            return None, None
+        header = parse_header(data, pos)
+        if header is not None and header.length > 0:
+            following = parse_header(data, pos + header.length)
+            if following is not None or pos + header.length >= len(data):
+                return pos, header
+        pos += 1
+    return None, None
+
+
+def read_vbr_header(data, pos: int, header: FrameHeader):
+    """Возвращает число кадров из заголовка Xing/Info или VBRI первого кадра, либо None."""
+    xing = pos + 4 + header.crc + header.side_info
+    if data[xing:xing + 4] in (b"Xing", b"Info"):
+        flags = struct.unpack_from(">I", data, xing + 4)[0]
+        if flags & 1:
+            return struct.unpack_from(">I", data, xing + 8)[0]
+    vbri = pos + 36
+    if data[vbri:vbri + 4] == b"VBRI":
+        return struct.unpack_from(">I", data, vbri + 14)[0]
+    return None
+
+
+class BitReader:
+    __slots__ = ("_data", "_bit")
+
+    def __init__(self, data, offset: int):
+        self._data = data
+        self._bit = offset * 8
+
+    def skip(self, count: int) -> None:
+        self._bit += count
+
+    def read(self, count: int) -> int:
+        start = self._bit >> 3
+        end = (self._bit + count + 7) >> 3
+        chunk = int.from_bytes(self._data[start:end], "big")
+        value = (chunk >> ((end - start) * 8 - (self._bit & 7) - count)) & ((1 << count) - 1)
+        self._bit += count
+        return value
+
+
+def frame_loudness(data, pos: int, header: FrameHeader) -> int:
+    """Оценивает громкость кадра Layer III по global_gain из side info, без декодирования.
+
+    global_gain — шаг квантования гранулы: чем он больше, тем громче
+    сигнал. Гранулы без данных (part2_3_length == 0) считаются тишиной.
+    """
+    channels = 1 if header.mono else 2
+    reader = BitReader(data, pos + 4 + header.crc)
+    if header.mpeg1:
+        reader.skip(9 + (5 if header.mono else 3) + 4 * channels)
+        granules, block = 2, 59
+    else:
+        reader.skip(8 + (1 if header.mono else 2))
+        granules, block = 1, 63
+    loudness = 0
+    for _ in range(granules * channels):
+        part2_3_length = reader.read(12)
+        reader.skip(9)
+        global_gain = reader.read(8)
+        reader.skip(block - 29)
+        if part2_3_length:
+            loudness = max(loudness, global_gain)
+    return loudness
+
+
+def analyze(path: str, peaks_count: int = PEAKS_COUNT) -> dict:
+    """Разбирает MP3 и возвращает длительность, битрейт, частоту и сжатые пики.
+
+    Длительность берется из заголовка Xing/Info/VBRI, если он есть, иначе
+    из подсчета кадров. Возвращает {"duration", "bitrate", "sample_rate", "peaks"}
+    или None, если кадров MPEG audio не найдено.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _analyze(data, peaks_count)
+
+
+def _analyze(data, peaks_count: int):
+    end = len(data) - (128 if data[-128:-125] == b"TAG" else 0)
+    pos, first = find_frame(data, skip_id3v2(data))
+    if first is None:
+        return None
+
+    vbr_frames = read_vbr_header(data, pos, first)
+    if vbr_frames is not None:
+        # Кадр с заголовком Xing/VBRI не содержит звука
+        pos += first.length
+
+    start = pos
+    frames = 0
+    samples = 0
+    loudness = []
+    audio_end = pos
+    while pos < end:
+        header = parse_header(data, pos)
+        if header is None or header.length <= 0:
+            pos, header = find_frame(data, pos + 1)
+            if header is None:
+                break
+        if pos + header.length > end:
+            break
+        frames += 1
+        samples += header.samples
+        loudness.append(frame_loudness(data, pos, header) if header.layer == 3 else 0)
+        pos += header.length
+        audio_end = pos
+
+    if frames == 0:
+        return None
+    sample_rate = first.sample_rate
+    if vbr_frames:
+        duration = vbr_frames * first.samples / sample_rate
+    else:
+        duration = samples / sample_rate
+    bitrate = int((audio_end - start) * 8 / duration) if duration else first.bitrate
+    return {
+        "duration": round(duration, 3),
+        "bitrate": bitrate,
+        "sample_rate": sample_rate,
+        "peaks": downsample(loudness, peaks_count),
+    }
+
+
+def downsample(values: list, count: int) -> bytes:
+    """Сжимает значения по кадрам до count корзин (максимум в корзине), нормируя в 0..255."""
+    if not values:
+        return b""
+    count = min(count, len(values))
+    buckets = []
+    for i in range(count):
+        chunk = values[i * len(values) // count:(i + 1) * len(values) // count]
+        buckets.append(max(chunk))
+    audible = [v for v in buckets if v]
+    if not audible:
+        return bytes(count)
+    low, high = min(audible), max(audible)
+    span = max(high - low, 1)
+    return bytes(0 if v == 0 else 16 + (v - low) * 239 // span for v in buckets)
+
+
+def encode_peaks(peaks: bytes, duration: float) -> bytes:
+    return PEAKS_HEADER.pack(PEAKS_MAGIC, len(peaks), int(duration * 1000)) + peaks
+
+
+def write_peaks(path: str, peaks: bytes, duration: float) -> None:
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(encode_peaks(peaks, duration))
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    # Проверка разбора файла: python mp3_info.py song.mp3
+    for file_path in sys.argv[1:]:
+        info = analyze(file_path)
+        if info is None:
+            print(f"{file_path}: кадры MPEG audio не найдены")
+            continue
+        print(f"{file_path}: {info['duration']:.1f} с, {info['bitrate'] // 1000} кбит/с, "
+              f"{info['sample_rate']} Гц, {len(info['peaks'])} пиков")
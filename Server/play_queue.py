@@ -0,0 +1,30 @@
+import random
+import hashlib
+
+QUEUE_MODES = ("ordered", "shuffle")
+
+
+def default_seed(user_id, playlist_name: str, playlist_version: int) -> str:
+    """Seed перемешивания по умолчанию: одинаковый на всех устройствах, пока плейлист не изменился."""
+    key = f"{user_id}\x1f{playlist_name}\x1f{playlist_version}".encode()
+    return hashlib.sha1(key).hexdigest()[:16]
+
+
+def make_order(count: int, mode: str = "ordered", seed: str = "", cycle: int = 0, start: int = None) -> list:
+    """Возвращает порядок воспроизведения — перестановку позиций 0..count-1.
+
+    В режиме "shuffle" перестановка зависит только от seed и номера круга
+    cycle: при повторе всего плейлиста каждый следующий круг перемешан
+    заново, но воспроизводимо. Позиция start (если задана) ставится первой,
+    чтобы включение перемешивания не прерывало текущий трек.
+    """
+    order = list(range(count))
+    if mode == "shuffle":
+        random.Random(f"{seed}:{cycle}").shuffle(order)
+    if start is not None and 0 <= start < count:
+        if mode == "shuffle":
+            order.remove(start)
+            order.insert(0, start)
+        else:
+            order = order[start:] + order[:start]
+    return order
@@ -0,0 +1,363 @@
+"""Сверка папок треков с хранилищем: сборка мусора и учет места пользователей.
+
+Папка трека, на которую не ссылается ни один плейлист (например, после
+delete_playlist), или поврежденная папка (нет song.mp3) удаляется, если
+пролежала в таком состоянии дольше grace секунд. Трек с аудио, но без
+данных (пустой data.txt), восстанавливается по записи плейлиста. Заодно
+для каждого пользователя пересчитываются занятые байты и число треков —
+по ним /add_track и /add_tracks проверяют квоту.
+Пользователь, которого нет в хранилище или чьи плейлисты не читаются,
+пропускается целиком: без них любая папка выглядела бы мусором.
+
+Фоновый режим обходит пользователей по одному с паузами и продолжает с
+места остановки после перезапуска. Разовый проход: python reconcile.py --dry-run
+"""
+import os
+import time
+import shutil
+import sqlite3
+import fcntl
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+GRACE_SECONDS = 24 * 3600
+TRACK_PAUSE = 0.01
+USER_PAUSE = 0.5
+PASS_INTERVAL = 3600.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS pending (
+    user_id TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    PRIMARY KEY (user_id, folder)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS usage (
+    user_id TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    tracks INTEGER NOT NULL DEFAULT 0,
+    updated REAL
+);
+"""
+
+SQL_SELECT_USAGE = "SELECT bytes, tracks FROM usage WHERE user_id = ?"
+SQL_CHARGE = (
+    "INSERT INTO usage (user_id, bytes, tracks, updated) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET bytes = bytes + excluded.bytes, tracks = tracks + excluded.tracks"
+)
+SQL_SET_USAGE = "INSERT OR REPLACE INTO usage (user_id, bytes, tracks, updated) VALUES (?, ?, ?, ?)"
+SQL_SELECT_PENDING = "SELECT folder, reason, first_seen FROM pending WHERE user_id = ?"
+SQL_INSERT_PENDING = "INSERT OR IGNORE INTO pending (user_id, folder, reason, first_seen) VALUES (?, ?, ?, ?)"
+SQL_DELETE_PENDING = "DELETE FROM pending WHERE user_id = ? AND folder = ?"
+SQL_SELECT_CURSOR = "SELECT value FROM meta WHERE key = 'cursor'"
+SQL_SET_CURSOR = "INSERT OR REPLACE INTO meta (key, value) VALUES ('cursor', ?)"
+
+
+def dir_size(path: str) -> int:
+    """Сумма размеров файлов папки трека (аудио, обложки, пики, данные)."""
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+class Reconciler:
+    """Инкрементальная сверка static/DB с хранилищем метаданных.
+
+    Время, с которого папка числится мусором, и счетчики места хранятся в
+    своей SQLite, общей для всех воркеров. Фоновый проход выполняет только
+    один процесс — тот, кто захватил flock рядом с базой.
+    """
+
+    def __init__(self, root: str, storage, blob_store, db_path: str, grace: float = GRACE_SECONDS,
+                 quota_bytes: int = 0, quota_tracks: int = 0, track_pause: float = TRACK_PAUSE,
+                 user_pause: float = USER_PAUSE, interval: float = PASS_INTERVAL, on_removed=None):
+        self._root = root
+        self._storage = storage
+        self._blob_store = blob_store
+        self._db_path = db_path
+        self._grace = grace
+        self.quota_bytes = quota_bytes
+        self.quota_tracks = quota_tracks
+        self._track_pause = track_pause
+        self._user_pause = user_pause
+        self._interval = interval
+        # Вызывается с user_id после удаления папок, чтобы сбросить кэш библиотеки
+        self._on_removed = on_removed
+        self._local = threading.local()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock_file = None
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def usage(self, user_id) -> tuple:
+        """Возвращает (байты, треки) пользователя на момент последнего прохода и добавлений после него."""
+        row = self._conn().execute(SQL_SELECT_USAGE, (str(user_id),)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def charge(self, user_id, size: int, tracks: int = 1) -> None:
+        """Учитывает добавленные треки до следующего прохода, который пересчитает счетчики с диска."""
+        self._conn().execute(SQL_CHARGE, (str(user_id), size, tracks, time.time()))
+
+    def over_quota(self, user_id, incoming_bytes: int, incoming_tracks: int) -> bool:
+        """True, если добавление превысит квоту; нулевой предел означает отсутствие ограничения."""
+        if not self.quota_bytes and not self.quota_tracks:
+            return False
+        used_bytes, used_tracks = self.usage(user_id)
+        if self.quota_bytes and used_bytes + incoming_bytes > self.quota_bytes:
+            return True
+        return bool(self.quota_tracks and used_tracks + incoming_tracks > self.quota_tracks)
+
+    def _referenced(self, user_id):
+        """Записи плейлистов по папке трека или None, если плейлисты пользователя прочитать не удалось.
+
+        Хранилище не создает пользователя ради проверки. Пропавший из хранилища
+        пользователь или поврежденный playlists.json не означают, что треки
+        никому не нужны: такие папки не считаются мусором.
+        """
+        if not self._storage.has_user(user_id):
+            return None
+        try:
+            playlists = self._storage.load_playlists(user_id, strict=True)
+        except ValueError as e:
+            logger.error(f"Плейлисты user_{user_id} не прочитаны, сверка пропущена: {e}")
+            return None
+        return {
+            track_entry["id"]: track_entry
+            for playlist in playlists
+            for track_entry in playlist.get("tracks", [])
+        }
+
+    def reconcile_user(self, user_id, dry_run: bool = False, now: float = None) -> dict:
+        """Сверяет папки одного пользователя. Возвращает отчет со списками папок и счетчиками.
+
+        В dry_run ничего не меняется, а "removed" — папки, которые были бы удалены.
+        """
+        now = time.time() if now is None else now
+        user_id = str(user_id)
+        user_dir = os.path.join(self._root, f"user_{user_id}")
+        report = {"user_id": user_id, "orphan": [], "corrupt": [], "repaired": [], "removed": [],
+                  "pending": [], "bytes": 0, "tracks": 0, "skipped": False}
+        if not os.path.isdir(user_dir):
+            return report
+
+        referenced = self._referenced(user_id)
+        if referenced is None:
+            # Без достоверного списка плейлистов любая папка выглядела бы мусором
+            logger.warning(f"Папки user_{user_id} оставлены без сверки: нет достоверных плейлистов")
+            report["skipped"] = True
+            return report
+        tracks = self._storage.load_tracks(user_id)
+        pending = {folder: first_seen for folder, _, first_seen in
+                   self._conn().execute(SQL_SELECT_PENDING, (user_id,))}
+        candidates = []
+        seen = set()
+        for entry in sorted(os.scandir(user_dir), key=lambda e: e.name):
+            if not entry.name.startswith("track_") or not entry.is_dir(follow_symlinks=False):
+                continue
+            folder = entry.name
+            seen.add(folder)
+            has_audio = os.path.isfile(os.path.join(entry.path, "song.mp3"))
+            if folder not in referenced:
+                reason = "orphan"
+            elif not has_audio:
+                reason = "corrupt"
+            else:
+                reason = None
+                if folder not in tracks:
+                    # Аудио на месте, а данных нет (пустой или битый data.txt): берем их из плейлиста
+                    track_entry = referenced[folder]
+                    report["repaired"].append(folder)
+                    if not dry_run:
+                        self._storage.save_track(user_id, folder, {
+                            "title": track_entry.get("title") or "Без названия",
+                            "artist": track_entry.get("artist") or "Неизвестный исполнитель"
+                        })
+                report["bytes"] += dir_size(entry.path)
+                report["tracks"] += 1
+                if folder in pending and not dry_run:
+                    self._conn().execute(SQL_DELETE_PENDING, (user_id, folder))
+
+            if reason is not None:
+                report[reason].append(folder)
+                first_seen = pending.get(folder)
+                if first_seen is None:
+                    first_seen = now
+                    if not dry_run:
+                        self._conn().execute(SQL_INSERT_PENDING, (user_id, folder, reason, now))
+                # Свежая папка может быть загрузкой, которая еще не попала в плейлист
+                if now - first_seen >= self._grace and now - entry.stat().st_mtime >= self._grace:
+                    candidates.append(folder)
+                else:
+                    report["pending"].append(folder)
+            if self._track_pause:
+                time.sleep(self._track_pause)
+
+        if candidates:
+            report["removed"] = candidates if dry_run else self._remove(user_id, user_dir, candidates, tracks)
+        if not dry_run:
+            with self._transaction() as conn:
+                for folder in pending:
+                    if folder not in seen:
+                        conn.execute(SQL_DELETE_PENDING, (user_id, folder))
+                conn.execute(SQL_SET_USAGE, (user_id, report["bytes"], report["tracks"], now))
+        return report
+
+    def _remove(self, user_id: str, user_dir: str, folders: list, tracks: dict) -> list:
+        # Плейлисты перечитываются прямо перед удалением: трек могли вернуть в плейлист за время прохода
+        referenced = self._referenced(user_id)
+        if referenced is None:
+            return []
+        removed = []
+        for folder in folders:
+            track_dir = os.path.join(user_dir, folder)
+            audio_path = os.path.join(track_dir, "song.mp3")
+            if folder in referenced and os.path.isfile(audio_path):
+                continue
+            try:
+                if os.path.isfile(audio_path):
+                    self._blob_store.release(audio_path, tracks.get(folder, {}).get("digest"))
+                shutil.rmtree(track_dir)
+            except OSError as e:
+                logger.error(f"Не удалось удалить {track_dir}: {e}")
+                continue
+            self._conn().execute(SQL_DELETE_PENDING, (user_id, folder))
+            removed.append(folder)
+        if removed:
+            # Поврежденные треки еще числились в плейлистах: хранилище сменит версию, и клиенты не получат 304
+            self._storage.delete_tracks(user_id, removed)
+            if self._on_removed is not None:
+                self._on_removed(user_id)
+            logger.info(f"Удалено папок треков user_{user_id}: {len(removed)}")
+        return removed
+
+    def _user_ids(self) -> list:
+        if not os.path.isdir(self._root):
+            return []
+        return sorted(name[len("user_"):] for name in os.listdir(self._root) if name.startswith("user_"))
+
+    def run_pass(self, dry_run: bool = False, user_ids: list = None) -> dict:
+        """Один проход по всем пользователям (или по user_ids). Прерванный фоновый проход продолжается с курсора."""
+        conn = self._conn()
+        cursor = None
+        if user_ids is None:
+            user_ids = self._user_ids()
+            if not dry_run:
+                row = conn.execute(SQL_SELECT_CURSOR).fetchone()
+                cursor = row[0] if row and row[0] else None
+        summary = {"users": 0, "skipped": 0, "orphan": 0, "corrupt": 0, "repaired": 0, "removed": 0,
+                   "pending": 0, "bytes": 0, "tracks": 0, "reports": []}
+        for user_id in user_ids:
+            if self._stopping.is_set():
+                return summary
+            if cursor is not None and user_id <= cursor:
+                continue
+            try:
+                report = self.reconcile_user(user_id, dry_run)
+            except Exception as e:
+                logger.error(f"Ошибка сверки user_{user_id}: {e}")
+                continue
+            summary["users"] += 1
+            summary["skipped"] += report["skipped"]
+            for key in ("orphan", "corrupt", "repaired", "removed", "pending"):
+                summary[key] += len(report[key])
+            summary["bytes"] += report["bytes"]
+            summary["tracks"] += report["tracks"]
+            if any(report[key] for key in ("orphan", "corrupt", "repaired")):
+                summary["reports"].append(report)
+            if not dry_run:
+                conn.execute(SQL_SET_CURSOR, (user_id,))
+            if self._user_pause:
+                self._stopping.wait(self._user_pause)
+        if not dry_run:
+            conn.execute(SQL_SET_CURSOR, ("",))
+        # Блобы, на которые после удаления папок никто не ссылается
+        summary["blobs"] = len(self._blob_store.collect(dry_run))
+        return summary
+
+    def start(self) -> bool:
+        """Запускает фоновые проходы, если их еще не выполняет другой процесс."""
+        self._lock_file = open(f"{self._db_path}.lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            return False
+        self._thread = threading.Thread(target=self._run, name="reconciler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                summary = self.run_pass()
+                logger.info(
+                    f"Сверка хранилища: пользователей {summary['users']}, удалено папок {summary['removed']}, "
+                    f"ожидают удаления {summary['pending']}, восстановлено {summary['repaired']}"
+                )
+            except Exception as e:
+                logger.error(f"Ошибка фоновой сверки хранилища: {e}")
+            self._stopping.wait(self._interval)
+
+
+if __name__ == '__main__':
+    # Разовая сверка: python reconcile.py --dry-run [--user 123] [--grace 86400]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from blob_store import BlobStore
+    from storage import create_storage
+
+    parser = argparse.ArgumentParser(description="Сверка папок треков с хранилищем")
+    parser.add_argument("--dry-run", action="store_true", help="только показать, что будет удалено")
+    parser.add_argument("--user", action="append", help="сверить только этих пользователей")
+    parser.add_argument("--grace", type=float, default=float(os.getenv("RECONCILE_GRACE", GRACE_SECONDS)))
+    parser.add_argument("--root", default="static/DB")
+    parser.add_argument("--backend", default=os.getenv("STORAGE_BACKEND", "sqlite"))
+    parser.add_argument("--db-file", default=os.getenv("DB_FILE", "library.sqlite3"))
+    parser.add_argument("--reconcile-db", default=os.getenv("RECONCILE_DB_FILE", "reconcile.sqlite3"))
+    args = parser.parse_args()
+
+    reconciler = Reconciler(args.root, create_storage(args.backend, args.root, args.db_file),
+                            BlobStore(os.path.join(args.root, "blobs")), args.reconcile_db, args.grace,
+                            track_pause=0, user_pause=0)
+    summary = reconciler.run_pass(args.dry_run, args.user)
+    for report in summary.pop("reports"):
+        for key in ("orphan", "corrupt", "repaired", "removed"):
+            for folder in report[key]:
+                print(f"user_{report['user_id']}\t{key}\t{folder}")
+    print(" ".join(f"{key}={value}" for key, value in summary.items()))
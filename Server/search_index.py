@@ -0,0 +1,110 @@
+import re
+import heapq
+import bisect
+import unicodedata
+
+# Кириллица приводится к латинице, чтобы "кино" находило "Kino" и наоборот
+TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh",
+    "з": "z", "и": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu",
+    "я": "ya", "і": "i", "ї": "i", "є": "e", "ґ": "g",
+})
+SEARCH_LIMIT = 20
+
+
+def normalize(text: str) -> str:
+    """Приводит строку к форме для поиска: регистр, ё -> е, транслитерация, без пунктуации."""
+    text = unicodedata.normalize("NFKC", text or "").casefold().translate(TRANSLIT)
+    # Убираем диакритику, оставшуюся после транслитерации (é -> e)
+    text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^\w]+", " ", text).split())
+
+
+def tokenize(text: str) -> list:
+    return normalize(text).split()
+
+
+class TrackSearchIndex:
+    """Инвертированный индекс по названию и исполнителю треков одного пользователя.
+
+    Термы хранятся в отсортированном списке, поэтому префиксный поиск для
+    набора по мере ввода — это бинарный поиск диапазона, а не обход всех
+    термов. Индекс обновляется по одному треку.
+    """
+
+    __slots__ = ("_terms", "_postings", "_documents")
+
+    def __init__(self):
+        self._terms = []
+        self._postings = {}
+        self._documents = {}
+
+    def add(self, track_folder: str, title: str, artist: str) -> None:
+        """Добавляет или переиндексирует трек."""
+        self.remove(track_folder)
+        for term in self._index(track_folder, title, artist):
+            bisect.insort(self._terms, term)
+
+    def add_many(self, tracks) -> None:
+        """Индексирует пачку (папка, название, исполнитель), сортируя термы один раз."""
+        for track_folder, title, artist in tracks:
+            self.remove(track_folder)
+            self._index(track_folder, title, artist)
+        self._terms = sorted(self._postings)
+
+    def _index(self, track_folder: str, title: str, artist: str) -> list:
+        """Заносит трек в словари и возвращает новые термы."""
+        terms = set(tokenize(title)) | set(tokenize(artist))
+        self._documents[track_folder] = (normalize(f"{title} {artist}"), terms)
+        new_terms = []
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = set()
+                new_terms.append(term)
+            postings.add(track_folder)
+        return new_terms
+
+    def remove(self, track_folder: str) -> None:
+        document = self._documents.pop(track_folder, None)
+        if document is None:
+            return
+        for term in document[1]:
+            postings = self._postings[term]
+            postings.discard(track_folder)
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+
+    def _prefix_matches(self, prefix: str) -> set:
+        start = bisect.bisect_left(self._terms, prefix)
+        end = bisect.bisect_left(self._terms, prefix + "\U0010ffff", start)
+        if end - start == 1:
+            return self._postings[self._terms[start]]
+        matches = set()
+        for term in self._terms[start:end]:
+            matches |= self._postings[term]
+        return matches
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> list:
+        """Возвращает имена папок треков, где каждое слово запроса — префикс какого-то терма."""
+        tokens = sorted(set(tokenize(query)), key=len, reverse=True)
+        if not tokens:
+            return []
+        # Начинаем с самого длинного (обычно самого избирательного) слова
+        result = None
+        for token in tokens:
+            matches = self._prefix_matches(token)
+            result = set(matches) if result is None else result & matches
+            if not result:
+                return []
+        phrase = normalize(query)
+        # Сначала треки, чей текст начинается с запроса, затем по алфавиту
+        return heapq.nsmallest(limit, result, key=lambda folder: (
+            not self._documents[folder][0].startswith(phrase), self._documents[folder][0]
+        ))
+
+    def __len__(self) -> int:
+        return len(self._documents)
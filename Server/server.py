@@ -1,14 +1,34 @@
 import os
 import json
+import time
+import random
+import hashlib
 import logging
-import requests
+import mimetypes
+import posixpath
 import urllib.parse
-import shutil
-from flask import Flask, render_template, send_from_directory, request, jsonify
-from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Request, make_response, render_template, send_from_directory, send_file, request, jsonify, abort, g
+from werkzeug.security import safe_join
+from dotenv import load_dotenv
 import traceback
 import signal
 import sys
+from library_index import LibraryIndex, PlaylistChanged
+from search_index import SEARCH_LIMIT
+from audio_stream import StatCache, stream_file
+from artwork_cache import ArtworkCache, ITUNES_SEARCH_URL, link_or_copy
+from blob_store import BlobStore, HashingUpload
+from covers import COVER_SIZES, DerivedImageCache, generate_thumbnails, snap_size, thumbnail_name
+from storage import create_storage
+from job_queue import JobQueue, QueueFull, PRIORITY_INTERACTIVE, PRIORITY_BACKFILL
+import mp3_info
+from play_queue import QUEUE_MODES, default_seed, make_order
+from auth import AuthError, SessionAuth, INIT_DATA_MAX_AGE, SESSION_TTL
+import metrics
+from reconcile import Reconciler, dir_size
+from assets import StaticAssets, CACHE_CONTROL as ASSET_CACHE_CONTROL
+
+load_dotenv()
 
 def signal_handler(sig, frame):
     print("Завершение бота...")
@@ -27,151 +47,512 @@ DEFAULT_PLAYLIST = "Любимое"
 DEFAULT_COVER = "static/css/standart.png"
 TIMEOUT = 10
 MAX_WORKERS = 5
+LIBRARY_INDEX_MAX_USERS = int(os.getenv("LIBRARY_INDEX_MAX_USERS", 512))
+LIBRARY_INDEX_MAX_TRACKS = int(os.getenv("LIBRARY_INDEX_MAX_TRACKS", 500_000))
+STREAM_MAX_AGE = int(os.getenv("STREAM_MAX_AGE", 86400))
+COVER_CACHE_DIR = "static/cache/covers"
+PUBLIC_STATIC_DIRS = ("css", "js", "build")
+ASSET_BUILD_DIR = "static/build"
+ARTWORK_DIR = os.path.join(PATH, "artwork")
+BLOB_DIR = os.path.join(PATH, "blobs")
+ITUNES_URL = os.getenv("ITUNES_SEARCH_URL", ITUNES_SEARCH_URL)
+COVER_CACHE_MAX_BYTES = int(os.getenv("COVER_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# Миниатюры в списке треков берут самый маленький размер; крупные — плеер и явный параметр size
+COVER_LIST_SIZE = COVER_SIZES[0]
+COVER_FULL_SIZE = COVER_SIZES[-1]
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DB_FILE = os.getenv("DB_FILE", "library.sqlite3")
+JSON_FSYNC = os.getenv("JSON_FSYNC", "data")
+JOURNAL_MAX_OPS = int(os.getenv("JOURNAL_MAX_OPS", 64))
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_SEARCH_LIMIT = 50
+MAX_BATCH_SIZE = 50
+JOB_DB_FILE = os.getenv("JOB_DB_FILE", "jobs.sqlite3")
+JOB_HOST_LIMIT = int(os.getenv("JOB_HOST_LIMIT", 2))
+JOB_MAX_BACKLOG = int(os.getenv("JOB_MAX_BACKLOG", 10_000))
+RECONCILE_DB_FILE = os.getenv("RECONCILE_DB_FILE", "reconcile.sqlite3")
+RECONCILE_GRACE = int(os.getenv("RECONCILE_GRACE", 24 * 3600))
+RECONCILE_BACKGROUND = os.getenv("RECONCILE_BACKGROUND", "1") == "1"
+# Квота на пользователя; 0 — без ограничения
+USER_QUOTA_BYTES = int(os.getenv("USER_QUOTA_BYTES", 0))
+USER_QUOTA_TRACKS = int(os.getenv("USER_QUOTA_TRACKS", 0))
+ITUNES_HOST = urllib.parse.urlparse(ITUNES_URL).hostname
+BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+# Секрет подписи токенов должен быть общим для всех воркеров
+SESSION_SECRET = os.getenv("FLASK_SECRET") or hashlib.sha256(f"session:{BOT_TOKEN}".encode()).hexdigest()
+AUTH_MAX_AGE = int(os.getenv("AUTH_MAX_AGE", INIT_DATA_MAX_AGE))
+SESSION_MAX_AGE = int(os.getenv("SESSION_TTL", SESSION_TTL))
+SESSION_COOKIE = "session"
+# Lax: cookie уходит с аудио и обложками, когда Mini App открыт верхним окном (клиенты Telegram).
+# В iframe Telegram Web нужна None; изменения и так принимают только заголовки, не cookie
+SESSION_COOKIE_SAMESITE = os.getenv("SESSION_COOKIE_SAMESITE", "Lax")
+# Доля запросов, чье содержимое пишется в лог на уровне DEBUG
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.01))
+BOT_RTT_MAX_SAMPLES = 32
+BOT_RTT_ROUTES = ("/playlists", "/create_playlist", "/delete_playlist", "/search", "/add_track", "/add_tracks")
 
 # Инициализация Flask
-app = Flask(__name__, static_folder='static', template_folder='templates')
-executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+# Встроенный маршрут /static отключен: статику отдает serve_static только из публичных папок
+app = Flask(__name__, static_folder=None, template_folder='templates')
+jobs = JobQueue(JOB_DB_FILE, MAX_WORKERS, JOB_HOST_LIMIT, JOB_MAX_BACKLOG)
+stat_cache = StatCache()
+cover_cache = DerivedImageCache(COVER_CACHE_DIR, COVER_CACHE_MAX_BYTES)
+blob_store = BlobStore(BLOB_DIR)
+artwork_cache = ArtworkCache(ARTWORK_DIR, ITUNES_URL, timeout=TIMEOUT)
+storage = create_storage(STORAGE_BACKEND, PATH, DB_FILE, JSON_FSYNC, JOURNAL_MAX_OPS)
+sessions = SessionAuth(BOT_TOKEN, SESSION_SECRET, SESSION_MAX_AGE, AUTH_MAX_AGE)
+static_assets = StaticAssets("static", ASSET_BUILD_DIR)
+static_assets.build()
+app.jinja_env.globals["asset_url"] = static_assets.url
+# Бот действует от имени любого пользователя
+BOT_USER = object()
+
+class UploadRequest(Request):
+    """Запрос, который пишет загружаемые файлы сразу во временный файл хранилища."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return blob_store.open_upload()
+
+app.request_class = UploadRequest
+
+def debug_sample(message: str, *args) -> None:
+    """Пишет содержимое запроса в DEBUG-лог для доли LOG_SAMPLE_RATE запросов; форматирует только выбранные."""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        logger.debug(message, *args)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    elapsed = time.perf_counter() - g.get("request_start", time.perf_counter())
+    metrics.REQUEST_DURATION.observe(elapsed, (route, request.method))
+    metrics.REQUESTS.inc((route, request.method, str(response.status_code)))
+    record_bot_rtt(request.headers)
+    return response
+
+def record_bot_rtt(headers) -> None:
+    """Бот сообщает время своих завершенных запросов в заголовке X-Bot-RTT: "<маршрут>;<секунды>, ...".
+
+    Каждый замер бот передает ровно один раз, поэтому здесь они просто учитываются.
+    """
+    value = headers.get("X-Bot-RTT")
+    if not value or not sessions.is_bot(headers.get("X-Bot-Auth")):
+        return
+    for sample in value.split(",")[:BOT_RTT_MAX_SAMPLES]:
+        route, _, seconds = sample.strip().partition(";")
+        try:
+            rtt = float(seconds)
+        except ValueError:
+            continue
+        if route in BOT_RTT_ROUTES and rtt >= 0:
+            metrics.BOT_RTT.observe(rtt, (route,))
 
 def download_cover(artist: str, track_title: str, save_path: str) -> None:
-    """Скачивает обложку трека с iTunes API или использует стандартную при ошибке."""
-    try:
-        query = urllib.parse.quote(f"{artist} {track_title}")
-        search_url = f"https://itunes.apple.com/search?term={query}&entity=song"
-        logger.info(f"Запрос к iTunes API: {search_url}")
-        
-        with requests.get(search_url, timeout=TIMEOUT) as response:
-            response.raise_for_status()
-            results = response.json().get("results", [])
-            
-            if not results:
-                shutil.copy(DEFAULT_COVER, save_path)
-                logger.info(f"Обложка не найдена для '{track_title}' от '{artist}', используется стандартная")
-                return
-            
-            cover_url = results[0].get("artworkUrl100").replace("100x100", "600x600")
-            logger.info(f"URL обложки: {cover_url}")
-            
-            with requests.get(cover_url, timeout=TIMEOUT) as cover_response:
-                cover_response.raise_for_status()
-                with open(save_path, "wb") as f:
-                    f.write(cover_response.content)
-                logger.info(f"Обложка сохранена: {save_path}")
-    except (requests.RequestException, Exception) as e:
-        shutil.copy(DEFAULT_COVER, save_path)
-        logger.error(f"Ошибка скачивания обложки для '{track_title}' от '{artist}': {e}")
+    """Кладет обложку трека из общего кэша iTunes или стандартную, если обложки нет.
 
-def extract_user_id(data: str) -> int:
-    """Извлекает user_id из переданных данных Telegram."""
+    При ошибке сети до повтора задачи тоже ставится стандартная обложка, а исключение пробрасывается.
+    """
     try:
-        data_dict = dict(item.split('=') for item in data.split('&'))
-        user_data_encoded = data_dict.get('user', '')
-        user_data_decoded = urllib.parse.unquote(user_data_encoded)
-        user_data = json.loads(user_data_decoded)
-        return user_data.get('id')
+        if artwork_cache.fetch_into(artist, track_title, save_path):
+            logger.info(f"Обложка сохранена: {save_path}")
+            return
+        logger.info(f"Обложка не найдена для '{track_title}' от '{artist}', используется стандартная")
     except Exception as e:
-        logger.error(f"Ошибка извлечения user_id: {e}")
+        logger.error(f"Ошибка скачивания обложки для '{track_title}' от '{artist}': {e}")
+        if not os.path.exists(save_path):
+            link_or_copy(DEFAULT_COVER, save_path)
         raise
+    link_or_copy(DEFAULT_COVER, save_path)
 
-def load_playlists(user_dir: str, playlists_file: str) -> list:
-    """Загружает или инициализирует файл плейлистов."""
-    if not os.path.exists(playlists_file):
-        default_playlists = [{"name": DEFAULT_PLAYLIST, "tracks": []}]
-        with open(playlists_file, "w", encoding="utf-8") as f:
-            json.dump(default_playlists, f)
-        logger.info(f"Создан начальный файл плейлистов в {user_dir}")
-        return default_playlists
-    
+def prepare_cover(artist: str, track_title: str, track_dir: str) -> None:
+    """Фоновая обработка обложки: скачивание и создание миниатюр всех размеров."""
     try:
-        with open(playlists_file, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        logger.error(f"Ошибка чтения файла плейлистов: {playlists_file}")
-        return [{"name": DEFAULT_PLAYLIST, "tracks": []}]
+        download_cover(artist, track_title, os.path.join(track_dir, "cover.jpeg"))
+    finally:
+        try:
+            generate_thumbnails(track_dir)
+        except Exception as e:
+            logger.error(f"Ошибка создания миниатюр для {track_dir}: {e}")
+
+def run_cover_job(payload: dict) -> None:
+    with metrics.phase("cover_fetch"):
+        prepare_cover(payload["artist"], payload["title"], payload["track_dir"])
+
+def run_analyze_job(payload: dict) -> None:
+    """Разбирает MP3 сохраненного трека: длительность, битрейт и пики волны дописываются в данные трека.
+
+    Версия библиотеки не меняется: без этих полей плеер берет длительность из самого аудио.
+    """
+    user_id, track_folder = payload["user_id"], payload["track_folder"]
+    track_dir = os.path.join(PATH, f"user_{user_id}", track_folder)
+    audio_path = os.path.join(track_dir, "song.mp3")
+    if not os.path.isfile(audio_path):
+        logger.info(f"Трек удален до разбора аудио: {track_dir}")
+        return
+    with metrics.phase("mp3_analyze"):
+        info = mp3_info.analyze(audio_path)
+    if info is None:
+        logger.warning(f"В файле не найдены кадры MP3: {audio_path}")
+        return
+    mp3_info.write_peaks(os.path.join(track_dir, "peaks.bin"), info.pop("peaks"), info["duration"])
+    track_data = {**payload["track"], **info}
+    storage.save_track(user_id, track_folder, track_data)
+    library.put_track(user_id, track_folder, make_track_entry(user_id, track_folder, track_data))
+
+jobs.register("cover", run_cover_job)
+jobs.register("analyze", run_analyze_job)
+jobs.start()
+
+def request_user(headers, cookies=None):
+    """Возвращает пользователя запроса по токену сессии, BOT_USER для бота или None.
+
+    Cookie сессии учитывается, только если передан cookies: ее принимают лишь
+    GET-маршруты файлов, а POST-маршруты требуют Authorization или X-Bot-Auth,
+    которые чужая страница подставить не может (защита от CSRF).
+    """
+    if sessions.is_bot(headers.get("X-Bot-Auth")):
+        return BOT_USER
+    authorization = headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        return sessions.authenticate(authorization[len("Bearer "):])
+    if cookies is None:
+        return None
+    return sessions.authenticate(cookies.get(SESSION_COOKIE))
+
+def is_allowed(caller, user_id) -> bool:
+    return caller is BOT_USER or (caller is not None and str(caller) == str(user_id))
+
+def check_access(user_id):
+    """Возвращает ответ 401/403, если запрос не от пользователя user_id и не от бота, иначе None."""
+    caller = request_user(request.headers)
+    if caller is None:
+        return jsonify({'error': 'Unauthorized'}), 401
+    if not is_allowed(caller, user_id):
+        return jsonify({'error': 'Forbidden'}), 403
+    return None
+
+def can_read(user_id) -> bool:
+    """Проверка доступа для файловых маршрутов: аудио и обложки браузер запрашивает с cookie сессии."""
+    return is_allowed(request_user(request.headers, request.cookies), user_id)
+
+def ingest_track(user_id, track_id, title: str, artist: str, stream):
+    """Сохраняет аудио трека. Возвращает (папка трека, данные трека) или None.
+
+    MP3 разбирается позже фоновой задачей (enqueue_analysis), чтобы загрузка не ждала обхода кадров.
+    """
+    track_folder = f"track_{track_id}"
+    track_dir = os.path.join(PATH, f"user_{user_id}", track_folder)
+    os.makedirs(track_dir, exist_ok=True)
+    
+    # Сохраняем аудиофайл в общее хранилище, папка трека ссылается на блоб
+    audio_path = os.path.join(track_dir, "song.mp3")
+    with metrics.phase("file_save"):
+        digest = blob_store.ingest(stream, audio_path)
+    if not os.path.exists(audio_path):
+        logger.error(f"Не удалось сохранить аудиофайл: {audio_path}")
+        return None
+    
+    saved_data = {"title": title, "artist": artist, "digest": digest}
+    logger.info(f"Аудиофайл успешно сохранён: {audio_path}")
+    return track_folder, saved_data
+
+def enqueue_analysis(user_id, track_folder: str, track_data: dict, priority: int = PRIORITY_INTERACTIVE) -> None:
+    """Ставит разбор MP3 в фоновую очередь; вызывается, когда данные трека уже записаны.
+
+    С приоритетом ниже интерактивного при переполненной очереди бросает QueueFull.
+    """
+    jobs.enqueue(
+        "analyze", {"user_id": user_id, "track_folder": track_folder, "track": track_data},
+        key=f"analyze:{user_id}:{track_folder}", priority=priority
+    )
+
+def enqueue_cover(user_id, track_folder: str, title: str, artist: str, priority: int = PRIORITY_INTERACTIVE) -> None:
+    """Ставит скачивание обложки и подготовку миниатюр в фоновую очередь.
+
+    С приоритетом ниже интерактивного при переполненной очереди бросает QueueFull.
+    """
+    track_dir = os.path.join(PATH, f"user_{user_id}", track_folder)
+    jobs.enqueue(
+        "cover", {"artist": artist, "title": title, "track_dir": track_dir},
+        key=f"cover:{user_id}:{track_folder}", priority=priority, host=ITUNES_HOST
+    )
+
+def make_track_entry(user_id, track_folder: str, track_data: dict) -> dict:
+    """Формирует описание трека для ответа /playlists."""
+    entry = {
+        "title": track_data.get("title", "Без названия").lower(),
+        "artist": track_data.get("artist", "Неизвестный исполнитель"),
+        "file": f"/stream/{user_id}/{track_folder}",
+        "cover": f"/cover/{user_id}/{track_folder}?size={COVER_LIST_SIZE}",
+        "cover_full": f"/cover/{user_id}/{track_folder}?size={COVER_FULL_SIZE}"
+    }
+    if "duration" in track_data:
+        entry["duration"] = track_data["duration"]
+        entry["bitrate"] = track_data.get("bitrate")
+        entry["peaks"] = f"/peaks/{user_id}/{track_folder}"
+    return entry
+
+def load_user_library(user_id) -> tuple:
+    """Читает из хранилища плейлисты, данные всех треков и версию библиотеки пользователя."""
+    with metrics.phase("load_playlists"):
+        playlists, version = storage.load_versioned(user_id)
+    with metrics.phase("scan_tracks"):
+        track_data_dict = {
+            track_folder: make_track_entry(user_id, track_folder, track_data)
+            for track_folder, track_data in storage.load_tracks(user_id).items()
+        }
+    return playlists, track_data_dict, version
+
+# Версия сверяется с хранилищем на каждом запросе: библиотеку могли изменить другие воркеры
+library = LibraryIndex(load_user_library, LIBRARY_INDEX_MAX_USERS, LIBRARY_INDEX_MAX_TRACKS, storage.version)
+reconciler = Reconciler(PATH, storage, blob_store, RECONCILE_DB_FILE, RECONCILE_GRACE,
+                        USER_QUOTA_BYTES, USER_QUOTA_TRACKS, on_removed=library.invalidate)
+if RECONCILE_BACKGROUND:
+    reconciler.start()
+
+def check_quota(user_id, incoming_bytes: int, incoming_tracks: int):
+    """Возвращает ответ 413, если добавление превысит квоту пользователя, иначе None."""
+    if not reconciler.over_quota(user_id, incoming_bytes, incoming_tracks):
+        return None
+    used_bytes, used_tracks = reconciler.usage(user_id)
+    logger.warning(f"Превышена квота user_{user_id}: {used_bytes} байт, {used_tracks} треков")
+    return jsonify({
+        "error": "Storage quota exceeded",
+        "usage": {"bytes": used_bytes, "tracks": used_tracks},
+        "quota": {"bytes": USER_QUOTA_BYTES, "tracks": USER_QUOTA_TRACKS}
+    }), 413
+
+def upload_size(file) -> int:
+    """Размер принятого файла; у потоковой загрузки бота нет Content-Length, поэтому считается по временному файлу."""
+    stream = file.stream
+    if isinstance(stream, HashingUpload):
+        return stream.size()
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
 
 @app.route('/auth', methods=['POST'])
 def auth():
-    """Аутентификация пользователя через Telegram Web App."""
+    """Проверяет подпись initData Telegram Web App и выдает токен сессии."""
     try:
-        logger.info(f"Получен запрос к /auth: {request.json}")
         tg_data = request.json.get('tgWebAppData')
         if not tg_data:
             return jsonify({'error': 'Missing tgWebAppData'}), 400
-        user_id = extract_user_id(tg_data)
+        user_id, token, expires_in = sessions.login(tg_data)
         logger.info(f"Успешная аутентификация пользователя: {user_id}")
-        return jsonify({'user_id': user_id}), 200
+        response = jsonify({'user_id': user_id, 'token': token, 'expires_in': expires_in})
+        # Cookie нужна для <audio> и <img>, которые не передают заголовок Authorization
+        response.set_cookie(SESSION_COOKIE, token, max_age=expires_in, httponly=True,
+                            secure=True, samesite=SESSION_COOKIE_SAMESITE)
+        return response, 200
+    except (AuthError, ValueError) as e:
+        logger.warning(f"Отказ в аутентификации: {e}")
+        return jsonify({'error': 'Invalid init data'}), 403
     except Exception as e:
         logger.error(f"Ошибка аутентификации: {e}")
         return jsonify({'error': 'Something went wrong'}), 403
 
+# Ответы о библиотеке зависят от того, чей токен в запросе
+LIBRARY_VARY = "Authorization, X-Bot-Auth"
+
+def library_etag(user_id, version: int, variant: str = "") -> str:
+    """ETag представления библиотеки: полные плейлисты, дельта с версии или сводки различаются суффиксом."""
+    return f"{user_id}-{version}-{variant}" if variant else f"{user_id}-{version}"
+
 @app.route('/playlists', methods=['POST'])
 def get_playlists():
-    """Возвращает все плейлисты пользователя."""
+    """Возвращает плейлисты пользователя.
+
+    ETag — версия библиотеки, поэтому 304 отдается без сборки плейлистов.
+    С "since" в теле запроса возвращаются только плейлисты, измененные
+    после этой версии, и порядок имен всех плейлистов для слияния на клиенте;
+    ETag такого ответа включает since.
+    """
     try:
-        logger.info(f"Получен запрос к /playlists: {request.json}")
+        debug_sample("Получен запрос к /playlists: %s", request.json)
         user_id = request.json.get("user_id")
         if not user_id:
             return jsonify({'error': 'Missing user_id'}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
         
-        user_dir = os.path.join(PATH, f"user_{user_id}")
-        playlists_file = os.path.join(user_dir, "playlists.json")
-        os.makedirs(user_dir, exist_ok=True)
+        # Версия хранилища читается один раз на запрос, дальше индекс ей доверяет
+        current = library.version(user_id)
+        since = request.json.get("since")
+        if not isinstance(since, int) or isinstance(since, bool) or not 0 <= since <= current:
+            since = None
+        variant = "" if since is None else f"since{since}"
+        etag = library_etag(user_id, current, variant)
+        if request.if_none_match.contains(etag):
+            logger.info(f"Плейлисты user_{user_id} не изменились")
+            return "", 304, {"ETag": f'"{etag}"', "Vary": LIBRARY_VARY}
         
-        playlists = load_playlists(user_dir, playlists_file)
+        version, playlists = library.resolve(user_id, since, current)
+        with metrics.phase("json_dump"):
+            if since is None:
+                response = jsonify({"version": version, "playlists": playlists})
+            else:
+                response = jsonify({
+                    "version": version, "since": since, "order": library.names(user_id, current),
+                    "playlists": playlists
+                })
+        response.set_etag(library_etag(user_id, version, variant))
+        response.headers["Vary"] = LIBRARY_VARY
         
-        # Загружаем данные о треках
-        track_data_dict = {}
-        for track_folder in os.listdir(user_dir):
-            if not track_folder.startswith("track_"):
-                continue
-            track_path = os.path.join(user_dir, track_folder)
-            if os.path.isdir(track_path):
-                data_file = os.path.join(track_path, "data.txt")
-                with open(data_file, "r", encoding="utf-8") as f:
-                    track_data = json.load(f)
-                track_data_dict[track_folder] = {
-                    "title": track_data.get("title", "Без названия").lower(),
-                    "artist": track_data.get("artist", "Неизвестный исполнитель"),
-                    "file": os.path.join(track_path, "song.mp3"),
-                    "cover": os.path.join(track_path, "cover.jpeg")
-                }
+        logger.info(f"Возвращены плейлисты для user_{user_id}: {len(playlists)} плейлистов, версия {version}")
+        return response, 200
+    except Exception as e:
+        logger.error(f"Ошибка получения плейлистов: {e}\n{traceback.format_exc()}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/playlist_summaries', methods=['POST'])
+def get_playlist_summaries():
+    """Возвращает имена плейлистов, число треков и версии без самих треков."""
+    try:
+        debug_sample("Получен запрос к /playlist_summaries: %s", request.json)
+        user_id = request.json.get("user_id")
+        if not user_id:
+            return jsonify({'error': 'Missing user_id'}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
         
-        # Сортируем треки в плейлистах в соответствии с порядком в playlists.json
-        for playlist in playlists:
-            tracks = []
-            for track_entry in playlist.get("tracks", []):
-                track_id = track_entry.get("id")
-                if track_id in track_data_dict:
-                    tracks.append(track_data_dict[track_id])
-            playlist["tracks"] = tracks
+        current = library.version(user_id)
+        etag = library_etag(user_id, current, "summary")
+        if request.if_none_match.contains(etag):
+            return "", 304, {"ETag": f'"{etag}"', "Vary": LIBRARY_VARY}
         
-        logger.info(f"Возвращены плейлисты для user_{user_id}: {len(playlists)} плейлистов")
-        return jsonify({"playlists": playlists}), 200
+        version, summaries = library.summaries(user_id, current)
+        response = jsonify({"version": version, "playlists": summaries})
+        response.set_etag(library_etag(user_id, version, "summary"))
+        response.headers["Vary"] = LIBRARY_VARY
+        return response, 200
     except Exception as e:
-        logger.error(f"Ошибка получения плейлистов: {e}\n{traceback.format_exc()}")
+        logger.error(f"Ошибка получения списка плейлистов: {e}\n{traceback.format_exc()}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/playlist_tracks', methods=['POST'])
+def get_playlist_tracks():
+    """Возвращает страницу треков плейлиста по курсору.
+
+    Плейлист задается именем, курсор — позицией и версией плейлиста, с
+    которой он получен. Если плейлист с тех пор изменился, возвращается 409
+    с его текущей сводкой, и клиент начинает листать заново.
+    """
+    try:
+        debug_sample("Получен запрос к /playlist_tracks: %s", request.json)
+        user_id = request.json.get("user_id")
+        playlist_name = request.json.get("playlist")
+        cursor = request.json.get("cursor") or 0
+        limit = request.json.get("limit") or PAGE_SIZE
+        playlist_version = request.json.get("version")
+        if not user_id or not isinstance(playlist_name, str):
+            return jsonify({'error': 'Missing user_id or playlist'}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
+        if not isinstance(cursor, int) or not isinstance(limit, int) or cursor < 0 or limit < 1:
+            return jsonify({'error': 'Invalid cursor or limit'}), 400
+        if playlist_version is not None and not isinstance(playlist_version, int):
+            return jsonify({'error': 'Invalid version'}), 400
+        if cursor and playlist_version is None:
+            return jsonify({'error': 'Missing version for cursor'}), 400
+        
+        try:
+            page = library.page(user_id, playlist_name, cursor, min(limit, MAX_PAGE_SIZE), playlist_version)
+        except PlaylistChanged as e:
+            return jsonify({'error': 'Playlist changed', 'playlist': e.summary}), 409
+        if page is None:
+            return jsonify({'error': 'Playlist not found'}), 404
+        return jsonify(page), 200
+    except Exception as e:
+        logger.error(f"Ошибка получения треков плейлиста: {e}\n{traceback.format_exc()}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/queue', methods=['POST'])
+def get_queue():
+    """Возвращает порядок воспроизведения плейлиста: по порядку или перемешанный по seed."""
+    try:
+        debug_sample("Получен запрос к /queue: %s", request.json)
+        user_id = request.json.get("user_id")
+        playlist_name = request.json.get("playlist")
+        mode = request.json.get("mode", "ordered")
+        repeat = request.json.get("repeat", "none")
+        cycle = request.json.get("cycle") or 0
+        start = request.json.get("start")
+        if not user_id or not isinstance(playlist_name, str):
+            return jsonify({'error': 'Missing user_id or playlist'}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
+        if mode not in QUEUE_MODES or repeat not in ("none", "one", "all"):
+            return jsonify({'error': 'Invalid mode or repeat'}), 400
+        if not isinstance(cycle, int) or cycle < 0 or (start is not None and not isinstance(start, int)):
+            return jsonify({'error': 'Invalid cycle or start'}), 400
+        
+        summary = library.summary(user_id, playlist_name)
+        if summary is None:
+            return jsonify({'error': 'Playlist not found'}), 404
+        seed = str(request.json.get("seed") or default_seed(user_id, summary["name"], summary["version"]))
+        order = make_order(summary["count"], mode, seed, cycle, start)
+        return jsonify({
+            **summary, "mode": mode, "seed": seed, "cycle": cycle, "repeat": repeat,
+            # Что делать после последней позиции: следующий круг, повтор трека или остановка
+            "on_end": {"all": "next_cycle", "one": "repeat_track", "none": "stop"}[repeat],
+            "order": order
+        }), 200
+    except Exception as e:
+        logger.error(f"Ошибка построения очереди: {e}\n{traceback.format_exc()}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/search', methods=['POST'])
+def search_tracks():
+    """Ищет треки пользователя по префиксам слов названия и исполнителя."""
+    try:
+        debug_sample("Получен запрос к /search: %s", request.json)
+        user_id = request.json.get("user_id")
+        query = request.json.get("query")
+        limit = request.json.get("limit") or SEARCH_LIMIT
+        if not user_id or not isinstance(query, str):
+            return jsonify({'error': 'Missing user_id or query'}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
+        if not isinstance(limit, int) or limit < 1:
+            return jsonify({'error': 'Invalid limit'}), 400
+        
+        tracks = library.search(user_id, query, min(limit, MAX_SEARCH_LIMIT))
+        logger.debug(f"Поиск для user_{user_id}: {len(tracks)} треков")
+        return jsonify({"tracks": tracks}), 200
+    except Exception as e:
+        logger.error(f"Ошибка поиска: {e}\n{traceback.format_exc()}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/create_playlist', methods=['POST'])
 def create_playlist():
     """Создаёт новый плейлист для пользователя."""
     try:
-        logger.info(f"Получен запрос к /create_playlist: {request.json}")
+        debug_sample("Получен запрос к /create_playlist: %s", request.json)
         user_id = request.json.get("user_id")
         playlist = request.json.get("playlist")
         if not user_id or not playlist or not playlist.get("name"):
             return jsonify({'error': 'Missing user_id or playlist data'}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
         
-        user_dir = os.path.join(PATH, f"user_{user_id}")
-        playlists_file = os.path.join(user_dir, "playlists.json")
-        os.makedirs(user_dir, exist_ok=True)
-        
-        playlists = load_playlists(user_dir, playlists_file)
-        playlists.append({"name": playlist["name"], "tracks": playlist.get("tracks", [])})
-        
-        with open(playlists_file, "w", encoding="utf-8") as f:
-            json.dump(playlists, f)
+        playlists, version = storage.create_playlist(user_id, playlist["name"], playlist.get("tracks", []))
+        library.set_playlists(user_id, playlists, version)
         
         logger.info(f"Создан новый плейлист '{playlist['name']}' для user_{user_id}")
-        return jsonify({"status": "success", "playlists": playlists}), 200
+        return jsonify({"status": "success", "playlists": playlists, "version": version}), 200
     except Exception as e:
         logger.error(f"Ошибка создания плейлиста: {e}\n{traceback.format_exc()}")
         return jsonify({'error': 'Internal server error'}), 500
@@ -180,7 +561,7 @@ def create_playlist():
 def add_track():
     """Добавляет новый трек для пользователя и привязывает его к плейлисту."""
     try:
-        logger.info(f"Получен запрос к /add_track: form={request.form}, files={request.files}")
+        debug_sample("Получен запрос к /add_track: form=%s, files=%s", request.form, request.files)
         track_data = json.loads(request.form.get("track_data", "{}"))
         file = request.files.get("file")
         
@@ -200,98 +581,267 @@ def add_track():
         if not user_id or not track_id:
             logger.error(f"Некорректные данные: user_id={user_id}, track_id={track_id}")
             return jsonify({"error": "Invalid track_data: missing user_id or file_id"}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
+        # Тело запроса уже во временном файле: квота проверяется по его размеру до переноса в хранилище
+        over_quota = check_quota(user_id, upload_size(file), 1)
+        if over_quota:
+            return over_quota
         
-        user_dir = os.path.join(PATH, f"user_{user_id}")
-        track_dir = os.path.join(user_dir, f"track_{track_id}")
-        playlists_file = os.path.join(user_dir, "playlists.json")
-        os.makedirs(user_dir, exist_ok=True)
-        os.makedirs(track_dir, exist_ok=True)
-        
-        # Сохраняем данные трека
-        track_data_path = os.path.join(track_dir, "data.txt")
-        with open(track_data_path, "w", encoding="utf-8") as f:
-            json.dump({"title": title, "artist": artist}, f)
-        logger.info(f"Сохранены данные трека: {track_data_path}")
-        
-        # Сохраняем аудиофайл
-        audio_path = os.path.join(track_dir, "song.mp3")
-        file.save(audio_path)
-        if not os.path.exists(audio_path):
-            logger.error(f"Не удалось сохранить аудиофайл: {audio_path}")
+        ingested = ingest_track(user_id, track_id, title, artist, file.stream)
+        if ingested is None:
             return jsonify({"error": "Failed to save audio file"}), 500
+        track_folder, saved_data = ingested
         
-        logger.info(f"Аудиофайл успешно сохранён: {audio_path}")
+        # Сохраняем данные трека
+        storage.save_track(user_id, track_folder, saved_data)
+        logger.info(f"Сохранены данные трека: {track_folder}")
         
-        # Скачиваем обложку асинхронно
-        cover_save_path = os.path.join(track_dir, "cover.jpeg")
-        executor.submit(download_cover, artist, title, cover_save_path)
+        enqueue_cover(user_id, track_folder, title, artist)
         
         # Обновляем плейлисты
-        playlists = load_playlists(user_dir, playlists_file)
-        playlist_found = False
-        for playlist in playlists:
-            if playlist["name"] == playlist_name:
-                if not any(t["id"] == f"track_{track_id}" for t in playlist["tracks"]):
-                    playlist["tracks"].append({"id": f"track_{track_id}", "title": title, "artist": artist})
-                playlist_found = True
-                break
-        if not playlist_found:
-            playlists.append({"name": playlist_name, "tracks": [{"id": f"track_{track_id}", "title": title, "artist": artist}]})
-            logger.info(f"Создан новый плейлист '{playlist_name}' для трека user_{user_id}")
-        
-        with open(playlists_file, "w", encoding="utf-8") as f:
-            json.dump(playlists, f)
+        playlists, version = storage.add_to_playlist(user_id, playlist_name, {"id": track_folder, "title": title, "artist": artist})
+        library.put_track(user_id, track_folder, make_track_entry(user_id, track_folder, saved_data))
+        library.set_playlists(user_id, playlists, version)
+        reconciler.charge(user_id, dir_size(os.path.join(PATH, f"user_{user_id}", track_folder)))
+        # Разбор ставится последним: его результат не перезапишется данными трека из этого запроса
+        enqueue_analysis(user_id, track_folder, saved_data)
         
         logger.info(f"Трек добавлен в плейлист '{playlist_name}' для user_{user_id}")
-        return jsonify({"status": "success"}), 200
+        return jsonify({"status": "success", "version": version}), 200
     except Exception as e:
         logger.error(f"Ошибка при добавлении трека: {str(e)}\n{traceback.format_exc()}")
         return jsonify({"error": "Internal server error", "details": str(e)}), 500
 
+@app.route('/add_tracks', methods=['POST'])
+def add_tracks():
+    """Добавляет пачку треков (альбом) одним изменением плейлистов.
+
+    Форма: batch_data — JSON {"user_id", "playlist_name", "tracks": [{"file_id", "title", "artist"}, ...]}
+    и файлы "file" в том же порядке. Треки, которые не удалось сохранить,
+    возвращаются в "failed", остальные добавляются.
+    """
+    try:
+        debug_sample("Получен запрос к /add_tracks: form=%s, files=%s", request.form, request.files)
+        batch_data = json.loads(request.form.get("batch_data", "{}"))
+        files = request.files.getlist("file")
+        user_id = batch_data.get("user_id")
+        items = batch_data.get("tracks")
+        if not user_id or not isinstance(items, list) or not items:
+            return jsonify({"error": "Missing user_id or tracks"}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
+        if len(items) != len(files):
+            return jsonify({"error": f"Got {len(files)} files for {len(items)} tracks"}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({"error": f"Too many tracks, max {MAX_BATCH_SIZE}"}), 413
+        over_quota = check_quota(user_id, sum(upload_size(file) for file in files), len(items))
+        if over_quota:
+            return over_quota
+        playlist_name = batch_data.get("playlist_name", DEFAULT_PLAYLIST)
+        
+        added, failed = [], []
+        for item, file in zip(items, files):
+            track_id = item.get("file_id")
+            title = item.get("title", "Без названия")
+            artist = item.get("artist", "Неизвестный исполнитель")
+            if not track_id:
+                failed.append({"file_id": None, "title": title, "error": "Missing file_id"})
+                continue
+            try:
+                ingested = ingest_track(user_id, track_id, title, artist, file.stream)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения трека {track_id}: {e}\n{traceback.format_exc()}")
+                ingested = None
+            if ingested is None:
+                failed.append({"file_id": track_id, "title": title, "error": "Failed to save audio file"})
+                continue
+            added.append((item.get("playlist_name", playlist_name), *ingested))
+        if not added:
+            return jsonify({"error": "Failed to save audio files", "failed": failed}), 500
+        
+        # Данные всех треков и плейлисты записываются одной транзакцией
+        playlists, version = storage.add_tracks(user_id, added)
+        for _, track_folder, saved_data in added:
+            library.put_track(user_id, track_folder, make_track_entry(user_id, track_folder, saved_data))
+        library.set_playlists(user_id, playlists, version)
+        user_dir = os.path.join(PATH, f"user_{user_id}")
+        reconciler.charge(user_id, sum(dir_size(os.path.join(user_dir, folder)) for _, folder, _ in added), len(added))
+        # Обложки и разбор аудио пачки идут после интерактивных загрузок и не копятся сверх лимита очереди
+        covers_skipped = analysis_skipped = 0
+        for _, track_folder, saved_data in added:
+            try:
+                enqueue_cover(user_id, track_folder, saved_data["title"], saved_data["artist"], PRIORITY_BACKFILL)
+            except QueueFull:
+                covers_skipped += 1
+            try:
+                enqueue_analysis(user_id, track_folder, saved_data, PRIORITY_BACKFILL)
+            except QueueFull:
+                analysis_skipped += 1
+        if covers_skipped or analysis_skipped:
+            logger.warning(f"Очередь задач переполнена для user_{user_id}: пропущено обложек {covers_skipped}, "
+                           f"разборов аудио {analysis_skipped}")
+        
+        logger.info(f"Добавлено треков для user_{user_id}: {len(added)}, не удалось: {len(failed)}")
+        return jsonify({
+            "status": "success", "version": version,
+            "added": [track_folder for _, track_folder, _ in added], "failed": failed
+        }), 200
+    except Exception as e:
+        logger.error(f"Ошибка при добавлении пачки треков: {e}\n{traceback.format_exc()}")
+        return jsonify({"error": "Internal server error", "details": str(e)}), 500
+
 @app.route('/delete_playlist', methods=['POST'])
 def delete_playlist():
     """Удаляет плейлист пользователя."""
     try:
-        logger.info(f"Получен запрос к /delete_playlist: {request.json}")
+        debug_sample("Получен запрос к /delete_playlist: %s", request.json)
         data = request.get_json()
         user_id = data.get("user_id")
         playlist_name = data.get("playlist_name")
 
         if not user_id or not playlist_name:
             return jsonify({'error': 'Missing user_id or playlist_name'}), 400
+        denied = check_access(user_id)
+        if denied:
+            return denied
 
-        user_dir = os.path.join(PATH, f"user_{user_id}")
-        playlists_file = os.path.join(user_dir, "playlists.json")
-        os.makedirs(user_dir, exist_ok=True)
-
-        if not os.path.exists(playlists_file):
+        if not storage.has_user(user_id):
             return jsonify({'error': 'Playlists file not found'}), 404
 
-        playlists = load_playlists(user_dir, playlists_file)
-        logger.info(f"Удаление плейлиста: '{playlist_name}'")
-        logger.info(f"Существующие плейлисты: {[p['name'] for p in playlists]}")
-        playlists = [p for p in playlists if not (p["name"] == playlist_name)]
-        logger.info(f"Плейлисты после удаления: {[p['name'] for p in playlists]}")
+        playlists, version = storage.delete_playlist(user_id, playlist_name)
+        debug_sample("Плейлисты после удаления: %s", playlists)
 
-        with open(playlists_file, "w", encoding="utf-8") as f:
-            json.dump(playlists, f)
+        library.set_playlists(user_id, playlists, version)
 
         logger.info(f"Плейлист '{playlist_name}' удален для user_{user_id}")
-        return jsonify({"status": "success", "playlists": playlists}), 200
+        return jsonify({"status": "success", "playlists": playlists, "version": version}), 200
     except Exception as e:
         logger.error(f"Ошибка удаления плейлиста: {e}\n{traceback.format_exc()}")
         return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
 
+@app.route('/stream/<int:user_id>/<track>', methods=['GET', 'HEAD'])
+def stream_track(user_id, track):
+    """Отдает аудиофайл трека с поддержкой частичных и условных запросов."""
+    if not track.startswith("track_"):
+        abort(404)
+    if not can_read(user_id):
+        abort(403)
+    audio_path = safe_join(PATH, f"user_{user_id}", track, "song.mp3")
+    if audio_path is None:
+        abort(404)
+    try:
+        response = stream_file(audio_path, request, app.response_class, stat_cache, max_age=STREAM_MAX_AGE)
+    except FileNotFoundError:
+        abort(404)
+    if request.method == "GET" and response.status_code in (200, 206):
+        # Для sendfile байты не считаются по кускам: учитывается объявленная длина ответа
+        metrics.STREAM_BYTES.inc(("wsgi",), response.content_length or 0)
+    return response
+
+@app.route('/peaks/<int:user_id>/<track>')
+def get_peaks(user_id, track):
+    """Отдает пики волны трека в двоичном формате mp3_info (PEAKS_HEADER и по байту на значение)."""
+    if not track.startswith("track_"):
+        abort(404)
+    if not can_read(user_id):
+        abort(403)
+    track_dir = safe_join(PATH, f"user_{user_id}", track)
+    if track_dir is None or not os.path.isfile(os.path.join(track_dir, "peaks.bin")):
+        abort(404)
+    peaks_path = os.path.join(track_dir, "peaks.bin")
+    return send_file(peaks_path, mimetype="application/octet-stream", conditional=True, max_age=STREAM_MAX_AGE)
+
+@app.route('/cover/<int:user_id>/<track>')
+def get_cover(user_id, track):
+    """Отдает обложку трека нужного размера в JPEG или WebP."""
+    if not track.startswith("track_"):
+        abort(404)
+    if not can_read(user_id):
+        abort(403)
+    track_dir = safe_join(PATH, f"user_{user_id}", track)
+    if track_dir is None or not os.path.isdir(track_dir):
+        abort(404)
+
+    size = snap_size(request.args.get("size", COVER_FULL_SIZE, type=int))
+    fmt = "webp" if request.accept_mimetypes["image/webp"] else "jpeg"
+
+    cover_path = os.path.join(track_dir, thumbnail_name(size, fmt))
+    if not os.path.exists(cover_path):
+        source_path = os.path.join(track_dir, "cover.jpeg")
+        if not os.path.exists(source_path):
+            source_path = DEFAULT_COVER
+        cover_path = cover_cache.get(source_path, size, fmt)
+
+    response = send_file(cover_path, mimetype=f"image/{fmt}", conditional=True, max_age=STREAM_MAX_AGE)
+    response.vary.add("Accept")
+    return response
+
+@app.route('/jobs/status')
+def jobs_status():
+    """Возвращает глубину и задержку очереди фоновых задач."""
+    return jsonify(jobs.stats()), 200
+
+@app.route('/metrics')
+def get_metrics():
+    """Метрики процесса в текстовом формате Prometheus."""
+    stats = jobs.stats()
+    for status in ("depth", "running", "failed"):
+        metrics.JOB_QUEUE_JOBS.set((status,), stats[status])
+    metrics.JOB_QUEUE_LAG.set((), stats["lag"])
+    for name, cache in (("library", library), ("stat", stat_cache), ("cover", cover_cache), ("artwork", artwork_cache)):
+        metrics.CACHE_REQUESTS.set_total((name, "hit"), cache.hits)
+        metrics.CACHE_REQUESTS.set_total((name, "miss"), cache.misses)
+    return metrics.REGISTRY.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
 @app.route('/')
 def index():
-    """Отображает главную страницу."""
-    logger.info("Запрос к /")
-    return render_template('index.html')
+    """Отображает главную страницу.
+
+    Страница проверяется при каждом визите по ETag, а ресурсы из нее
+    берутся из кэша браузера без запросов, пока не сменится их отпечаток.
+    """
+    response = make_response(render_template('index.html'))
+    response.add_etag()
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+@app.route('/sw.js')
+def service_worker():
+    """Service worker плеера: отдается из корня, чтобы его область охватывала /stream, /cover и /peaks."""
+    response = send_from_directory('static/js', 'sw.js', mimetype='application/javascript', max_age=0)
+    # Браузер проверяет обновление воркера при каждой навигации
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route('/assets/<path:path>')
+def serve_asset(path):
+    """Отдает собранную статику с отпечатком: заранее сжатый вариант по Accept-Encoding, кэш навсегда."""
+    resolved = static_assets.resolve(path, request.headers.get("Accept-Encoding"))
+    if resolved is None:
+        abort(404)
+    file_path, encoding = resolved
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    response = send_file(file_path, mimetype=mimetype, conditional=True)
+    response.headers["Cache-Control"] = ASSET_CACHE_CONTROL
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+def is_public_static(path: str) -> bool:
+    """Папки static, которые можно отдавать без авторизации; static/DB и кэши — только через проверяемые маршруты."""
+    # Путь нормализуется так же, как в safe_join: css/../DB/... не должен пройти проверку
+    normalized = posixpath.normpath(path.replace("\\", "/"))
+    return normalized.split("/", 1)[0] in PUBLIC_STATIC_DIRS
 
 @app.route('/static/<path:path>')
 def serve_static(path):
     """Отдает статические файлы."""
-    logger.info(f"Запрос к /static/{path}")
+    if not is_public_static(path):
+        return jsonify({'error': 'Not found'}), 404
     return send_from_directory('static', path)
 
 if __name__ == '__main__':
@@ -3,14 +3,27 @@ const tgWebAppData = urlParams.get('tgWebAppData');
 
 // Константы
 const TIMEOUT = 10000;
-const DEFAULT_PLAYLIST = { name: "Любимое", tracks: [] };
+const DEFAULT_PLAYLIST = { name: "Любимое", count: 0, version: 0 };
+const PAGE_SIZE = 50;
+const PREFETCH_MARGIN = 10; // за сколько треков до края окна подгружается следующая страница
+const WINDOW_PAGES = 2; // сколько страниц держать в памяти по обе стороны от текущей
+const MEDIA_OWNER_KEY = 'media-cache-user'; // чьи аудио и обложки сейчас лежат в кэше service worker
+// Адрес стандартной обложки с отпечатком сборки приходит из шаблона
+const DEFAULT_COVER = document.getElementById('cover')?.dataset.defaultCover || '/static/css/standart.png';
 
 // Состояние приложения
 const state = {
     userId: null,
-    playlists: [DEFAULT_PLAYLIST],
+    token: null, // токен сессии из /auth
+    playlists: [DEFAULT_PLAYLIST], // только имена, число треков и версии
+    tracks: new Map(), // загруженное окно активного плейлиста: позиция в плейлисте -> трек
+    trackCount: 0,
+    order: null, // порядок воспроизведения из /queue в режиме перемешивания
+    queueCycle: 0, // номер круга перемешивания при повторе всего плейлиста
+    pageRequests: new Map(),
     currentPlaylistIndex: 0,
     currentTrackIndex: 0,
+    skippedTracks: 0, // подряд пропущенные позиции без трека
     isShuffle: false,
     repeatMode: 'none',
     isQuietMode: false
@@ -30,11 +43,35 @@ const elements = {
     title: document.getElementById('title'),
     artist: document.getElementById('artist'),
     cover: document.getElementById('cover'),
+    waveform: document.querySelector('.waveform'),
     playlistDropdown: document.getElementById('playlist-dropdown')
 };
 
-// Инициализация аудио
-const audio = new Audio();
+// Инициализация аудио: второй элемент заранее буферизует следующий трек
+let audio = new Audio();
+let nextAudio = new Audio();
+nextAudio.preload = 'auto';
+
+// Запрос с таймаутом и токеном сессии; при 401 (токен истек) сессия обновляется один раз
+async function authorizedFetch(url, options = {}, retry = true) {
+    const headers = { ...(options.headers || {}) };
+    if (state.token) {
+        headers['Authorization'] = `Bearer ${state.token}`;
+    }
+
+    const controller = new AbortController();
+    const timeoutId = setTimeout(() => controller.abort(), TIMEOUT);
+    try {
+        const response = await fetch(url, { ...options, headers, signal: controller.signal });
+        if (response.status === 401 && retry && state.token) {
+            await authenticate();
+            return authorizedFetch(url, options, false);
+        }
+        return response;
+    } finally {
+        clearTimeout(timeoutId);
+    }
+}
 
 async function fetchWithTimeout(url, options = {}) {
     const headers = {
@@ -43,16 +80,7 @@ async function fetchWithTimeout(url, options = {}) {
     };
     
     try {
-        const controller = new AbortController();
-        const timeoutId = setTimeout(() => controller.abort(), TIMEOUT);
-        
-        const response = await fetch(url, { 
-            ...options, 
-            headers, 
-            signal: controller.signal 
-        });
-        
-        clearTimeout(timeoutId);
+        const response = await authorizedFetch(url, { ...options, headers });
         
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
@@ -65,17 +93,246 @@ async function fetchWithTimeout(url, options = {}) {
     }
 }
 
-async function preloadCovers() {
-    const preloadContainer = document.createElement('div');
-    preloadContainer.className = 'preload-images';
-    state.playlists.forEach(playlist => {
-        playlist.tracks.forEach(track => {
-            const img = document.createElement('img');
-            img.src = track.cover || '/static/css/standart.png';
-            preloadContainer.appendChild(img);
+// Проверка initData на сервере: токен для запросов и cookie для аудио и обложек
+async function authenticate() {
+    state.token = null;
+    const response = await authorizedFetch('/auth', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ tgWebAppData })
+    }, false);
+    if (response.status === 401 || response.status === 403) {
+        // Сессия не подтверждена: медиа прошлого пользователя удаляется с устройства
+        clearMediaCache();
+    }
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    const authData = await response.json();
+    claimMediaCache(authData.user_id);
+    state.userId = authData.user_id;
+    state.token = authData.token;
+}
+
+function loadCachedSummaries(userId) {
+    try {
+        return JSON.parse(localStorage.getItem(`playlists:${userId}`));
+    } catch (error) {
+        return null;
+    }
+}
+
+function saveCachedSummaries(userId, version, playlists) {
+    try {
+        localStorage.setItem(`playlists:${userId}`, JSON.stringify({ version, playlists }));
+    } catch (error) {
+        console.warn('Не удалось сохранить плейлисты в localStorage:', error);
+    }
+}
+
+// Загружает список плейлистов без треков; 304, если версия библиотеки не изменилась
+async function syncSummaries(userId) {
+    const cached = loadCachedSummaries(userId);
+    const headers = { 'Content-Type': 'application/json' };
+    if (cached && Number.isInteger(cached.version)) {
+        headers['If-None-Match'] = `"${userId}-${cached.version}-summary"`;
+    }
+
+    const response = await authorizedFetch('/playlist_summaries', {
+        method: 'POST',
+        headers,
+        body: JSON.stringify({ user_id: userId })
+    });
+
+    if (response.status === 304) {
+        console.log("Плейлисты не изменились, версия", cached.version);
+        return cached.playlists;
+    }
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+
+    const data = await response.json();
+    saveCachedSummaries(userId, data.version, data.playlists);
+    return data.playlists;
+}
+
+function currentPlaylist() {
+    return state.playlists[state.currentPlaylistIndex];
+}
+
+// Плейлист изменился на сервере (409 на странице): сводки перечитываются, листание начинается заново
+async function refreshPlaylists() {
+    const name = currentPlaylist().name;
+    const playlists = await syncSummaries(state.userId);
+    state.playlists = playlists && playlists.length ? playlists : [DEFAULT_PLAYLIST];
+    const index = state.playlists.findIndex(playlist => playlist.name === name);
+    state.currentPlaylistIndex = index >= 0 ? index : 0;
+    resetTracks();
+    populatePlaylistDropdown();
+}
+
+function resetTracks() {
+    state.tracks = new Map();
+    state.pageRequests = new Map();
+    state.order = null;
+    state.queueCycle = 0;
+    state.trackCount = currentPlaylist().count;
+}
+
+// Порядок воспроизведения строит сервер: перемешивание по seed одинаково на всех устройствах
+async function loadQueue(cycle = 0, start = undefined) {
+    const manifest = await fetchWithTimeout('/queue', {
+        method: 'POST',
+        body: JSON.stringify({
+            user_id: state.userId,
+            playlist: currentPlaylist().name,
+            mode: 'shuffle',
+            repeat: state.repeatMode,
+            cycle,
+            start
+        })
+    });
+    state.order = manifest.order;
+    state.queueCycle = manifest.cycle;
+    state.trackCount = manifest.count;
+}
+
+function queueLength() {
+    return state.order ? state.order.length : state.trackCount;
+}
+
+// Следующая позиция без перехода на новый круг; null в конце очереди
+function nextPosition() {
+    const next = state.currentTrackIndex + 1;
+    if (next < queueLength()) return next;
+    return !state.order && state.repeatMode === 'all' ? 0 : null;
+}
+
+// Начинает буферизовать следующий трек во втором аудиоэлементе
+async function prepareNext() {
+    const position = nextPosition();
+    if (position === null || state.repeatMode === 'one') return;
+    try {
+        const track = await ensureTrack(trackIndexAt(position));
+        if (!track || nextAudio.dataset.track === track.file) return;
+        nextAudio.src = track.file;
+        nextAudio.dataset.track = track.file;
+        nextAudio.load();
+        prefetchMedia([track.cover_full, track.peaks]);
+    } catch (error) {
+        console.warn('Ошибка предзагрузки следующего трека:', error);
+    }
+}
+
+function trackIndexAt(position) {
+    return state.order ? state.order[position] : position;
+}
+
+async function fetchPage(playlist, cursor) {
+    const response = await authorizedFetch('/playlist_tracks', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            user_id: state.userId, playlist: playlist.name, version: playlist.version, cursor, limit: PAGE_SIZE
+        })
+    });
+    if (response.status === 409) return null;
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    return response.json();
+}
+
+// Возвращает трек по позиции в плейлисте, подгружая содержащую его страницу.
+// Позиции без данных трека на странице отсутствуют: для них возвращается undefined
+async function ensureTrack(index, retry = true) {
+    if (state.tracks.has(index)) return state.tracks.get(index);
+    const cursor = Math.floor(index / PAGE_SIZE) * PAGE_SIZE;
+    let request = state.pageRequests.get(cursor);
+    if (!request) {
+        const tracks = state.tracks;
+        request = fetchPage(currentPlaylist(), cursor).then(page => {
+            // Пока страница грузилась, пользователь мог переключить плейлист
+            if (tracks !== state.tracks || page === null) return page !== null;
+            page.tracks.forEach(track => tracks.set(track.position, track));
+            preloadCovers(page.tracks);
+            return true;
+        }).finally(() => {
+            if (tracks === state.tracks) state.pageRequests.delete(cursor);
         });
+        state.pageRequests.set(cursor, request);
+    }
+    if (!await request) {
+        if (!retry) return undefined;
+        await refreshPlaylists();
+        return ensureTrack(Math.min(index, Math.max(state.trackCount - 1, 0)), false);
+    }
+    return state.tracks.get(index);
+}
+
+// Держит в памяти только окно страниц вокруг текущего трека
+function trimWindow(index) {
+    const currentPage = Math.floor(index / PAGE_SIZE);
+    for (const position of state.tracks.keys()) {
+        if (Math.abs(Math.floor(position / PAGE_SIZE) - currentPage) > WINDOW_PAGES) {
+            state.tracks.delete(position);
+        }
+    }
+}
+
+// Заранее подгружает страницы, к которым подходят nextTrack/prevTrack
+function prefetchAround(position) {
+    const count = state.trackCount;
+    if (count === 0) return;
+    const positions = [(position + PREFETCH_MARGIN) % count, (position - PREFETCH_MARGIN + count) % count];
+    if (state.order) positions.push((position + 1) % count);
+    positions.forEach(p => {
+        ensureTrack(trackIndexAt(p)).catch(error => console.warn('Ошибка предзагрузки треков:', error));
+    });
+}
+
+function preloadCovers(tracks) {
+    tracks.forEach(track => {
+        const img = new Image();
+        img.src = track.cover || DEFAULT_COVER;
     });
-    document.body.appendChild(preloadContainer);
+}
+
+// Пики волны в формате сервера: "PKS1", uint16 число значений, uint32 длительность в мс, затем по байту на значение
+async function drawWaveform(track) {
+    const canvas = elements.waveform;
+    const context = canvas.getContext('2d');
+    canvas.width = canvas.clientWidth * window.devicePixelRatio;
+    canvas.height = canvas.clientHeight * window.devicePixelRatio;
+    context.clearRect(0, 0, canvas.width, canvas.height);
+    canvas.dataset.track = track.file;
+    if (!track.peaks) return;
+
+    try {
+        const response = await fetch(track.peaks);
+        if (!response.ok) return;
+        const buffer = await response.arrayBuffer();
+        const view = new DataView(buffer);
+        if (canvas.dataset.track !== track.file || buffer.byteLength < 10) return;
+        if (String.fromCharCode(...new Uint8Array(buffer, 0, 4)) !== 'PKS1') return;
+        const peaks = new Uint8Array(buffer, 10, view.getUint16(4));
+        const barWidth = canvas.width / peaks.length;
+        context.fillStyle = 'rgba(255, 255, 255, 0.35)';
+        peaks.forEach((peak, i) => {
+            const height = Math.max(1, (peak / 255) * canvas.height);
+            context.fillRect(i * barWidth, (canvas.height - height) / 2, Math.max(1, barWidth - 1), height);
+        });
+    } catch (error) {
+        console.warn('Не удалось загрузить волну трека:', error);
+    }
+}
+
+// Длительность известна из метаданных трека ещё до загрузки аудио
+function currentDuration() {
+    if (Number.isFinite(audio.duration)) return audio.duration;
+    const track = state.tracks.get(trackIndexAt(state.currentTrackIndex));
+    return (track && track.duration) || 0;
 }
 
 function populatePlaylistDropdown() {
@@ -96,7 +353,9 @@ async function changePlaylist() {
     if (newIndex === state.currentPlaylistIndex) return;
     state.currentPlaylistIndex = newIndex;
     state.currentTrackIndex = 0;
-    if (state.playlists[state.currentPlaylistIndex].tracks.length > 0) {
+    resetTracks();
+    if (state.trackCount > 0) {
+        if (state.isShuffle) await loadQueue();
         await loadTrack(state.currentTrackIndex);
     } else {
         showEmptyPlaylistMessage();
@@ -106,38 +365,71 @@ async function changePlaylist() {
     }
 }
 
+// Service worker кэширует аудио, обложки и пики: повторное прослушивание не идет в сеть
+function registerServiceWorker() {
+    if (!('serviceWorker' in navigator)) return;
+    navigator.serviceWorker.register('/sw.js').catch(error => console.warn('Service worker не зарегистрирован:', error));
+}
+
+function clearMediaCache() {
+    try {
+        localStorage.removeItem(MEDIA_OWNER_KEY);
+    } catch (error) {
+        // localStorage недоступен: владельца кэша не запоминаем
+    }
+    if (!('serviceWorker' in navigator)) return;
+    navigator.serviceWorker.ready
+        .then(registration => registration.active && registration.active.postMessage({ type: 'clear-media' }))
+        .catch(error => console.warn('Не удалось очистить кэш медиа:', error));
+}
+
+// Кэш медиа принадлежит одному пользователю: при входе другого (или неизвестного владельца) он очищается
+function claimMediaCache(userId) {
+    const owner = String(userId);
+    let previous = null;
+    try {
+        previous = localStorage.getItem(MEDIA_OWNER_KEY);
+    } catch (error) {
+        // без localStorage владелец неизвестен
+    }
+    if (previous === owner) return;
+    clearMediaCache();
+    try {
+        localStorage.setItem(MEDIA_OWNER_KEY, owner);
+    } catch (error) {
+        console.warn('Не удалось запомнить владельца кэша медиа:', error);
+    }
+}
+
+function prefetchMedia(urls) {
+    const controller = navigator.serviceWorker && navigator.serviceWorker.controller;
+    if (controller) controller.postMessage({ type: 'prefetch', urls: urls.filter(Boolean) });
+}
+
 async function initPlayer() {
     const overlay = document.createElement('div');
     overlay.className = 'overlay';
     document.body.appendChild(overlay);
 
     elements.loader.classList.add('active');
-    
+    registerServiceWorker();
+
     try {
         console.log("Запрос авторизации...");
-        const authData = await fetchWithTimeout('/auth', {
-            method: 'POST',
-            body: JSON.stringify({ tgWebAppData })
-        });
-        
-        state.userId = authData.user_id;
+        await authenticate();
         console.log("Авторизация успешна, user_id:", state.userId);
 
         console.log("Запрос плейлистов...");
-        const playlistData = await fetchWithTimeout('/playlists', {
-            method: 'POST',
-            body: JSON.stringify({ user_id: state.userId })
-        });
+        const playlists = await syncSummaries(state.userId);
         
-        state.playlists = playlistData.playlists || [DEFAULT_PLAYLIST];
+        state.playlists = playlists && playlists.length ? playlists : [DEFAULT_PLAYLIST];
         console.log("Плейлисты получены:", state.playlists);
-
-        await preloadCovers();
+        resetTracks();
 
         // Заполняем выпадающий список плейлистов
         populatePlaylistDropdown();
 
-        if (state.playlists[state.currentPlaylistIndex].tracks.length > 0) {
+        if (state.trackCount > 0) {
             await loadTrack(state.currentTrackIndex);
         } else {
             showEmptyPlaylistMessage();
@@ -160,7 +452,7 @@ function showEmptyPlaylistMessage() {
     const coverImg = document.getElementById('cover');
     title.textContent = "Этот плейлист пуст";
     artist.textContent = "Добавьте треки через бота!";
-    coverImg.src = '/static/css/standart.png';
+    coverImg.src = DEFAULT_COVER;
     audio.pause();
     elements.playButton.innerHTML = '<i class="fas fa-play"></i>';
     elements.playButton.classList.remove('playing');
@@ -174,14 +466,27 @@ function showEmptyPlaylistMessage() {
 
 async function loadTrack(index, direction = 'next') {
     try {
-        const tracks = state.playlists[state.currentPlaylistIndex].tracks;
-        if (!tracks || tracks.length === 0) {
+        if (state.trackCount === 0) {
             showEmptyPlaylistMessage();
             return;
         }
 
         state.currentTrackIndex = index;
-        const track = tracks[index];
+        const trackIndex = trackIndexAt(index);
+        const track = await ensureTrack(trackIndex);
+        if (state.currentTrackIndex !== index) return;
+        if (!track) {
+            // Трек на этой позиции удален: переходим к соседнему, но не по кругу бесконечно
+            if (state.repeatMode !== 'one' && state.skippedTracks++ < queueLength()) {
+                await (direction === 'next' ? nextTrack(true) : prevTrack());
+            }
+            return;
+        }
+        state.skippedTracks = 0;
+        trimWindow(trackIndex);
+        prefetchAround(index);
+        elements.progressBar.style.width = '0%';
+        drawWaveform(track);
         const coverImg = document.getElementById('cover');
         const title = document.getElementById('title');
         const artist = document.getElementById('artist');
@@ -194,7 +499,7 @@ async function loadTrack(index, direction = 'next') {
         artist.classList.add('exit');
 
         setTimeout(() => {
-            coverImg.src = track.cover || '/static/css/standart.png';
+            coverImg.src = track.cover_full || track.cover || DEFAULT_COVER;
             coverImg.classList.remove('exit-next', 'exit-prev');
             coverImg.classList.add('active');
             title.textContent = track.title;
@@ -206,17 +511,28 @@ async function loadTrack(index, direction = 'next') {
         }, 300);
 
         audio.pause();
-        audio.src = track.file;
+        if (nextAudio.dataset.track === track.file) {
+            // Трек уже буферизован вторым элементом: меняем элементы местами без новой загрузки
+            [audio, nextAudio] = [nextAudio, audio];
+            audio.currentTime = 0;
+        } else {
+            audio.src = track.file;
+        }
+        audio.dataset.track = track.file;
+        nextAudio.removeAttribute('data-track');
         audio.muted = state.isQuietMode;
 
-        await new Promise((resolve) => {
-            audio.addEventListener('loadedmetadata', resolve, { once: true });
-        });
+        if (audio.readyState < HTMLMediaElement.HAVE_METADATA) {
+            await new Promise((resolve) => {
+                audio.addEventListener('loadedmetadata', resolve, { once: true });
+            });
+        }
 
         await audio.play();
 
         elements.playButton.innerHTML = '<i class="fas fa-pause"></i>';
         elements.playButton.classList.add('playing');
+        prepareNext();
     } catch (error) {
         console.error('Ошибка загрузки трека:', error);
         elements.playButton.innerHTML = '<i class="fas fa-play"></i>';
@@ -225,18 +541,10 @@ async function loadTrack(index, direction = 'next') {
 }
 
 async function shuffleTracks() {
-    const tracks = state.playlists[state.currentPlaylistIndex].tracks;
-    if (!tracks || tracks.length === 0) return;
-    return new Promise((resolve) => {
-        setTimeout(() => {
-            for (let i = tracks.length - 1; i > 0; i--) {
-                const j = Math.floor(Math.random() * (i + 1));
-                [tracks[i], tracks[j]] = [tracks[j], tracks[i]];
-            }
-            state.currentTrackIndex = 0;
-            resolve();
-        }, 0);
-    });
+    if (state.trackCount === 0) return;
+    // Текущий трек сервер ставит первым, поэтому воспроизведение не прерывается
+    await loadQueue(0, trackIndexAt(state.currentTrackIndex));
+    state.currentTrackIndex = 0;
 }
 
 function toggleQuietMode() {
@@ -246,7 +554,10 @@ function toggleQuietMode() {
 }
 
 function updateProgress(e) {
-    const { duration, currentTime } = e.srcElement;
+    if (e.target !== audio) return;
+    const { currentTime } = e.target;
+    const duration = currentDuration();
+    if (!duration) return;
     const progressPercent = (currentTime / duration) * 100;
     elements.progressBar.style.width = `${progressPercent}%`;
 }
@@ -254,7 +565,7 @@ function updateProgress(e) {
 async function setProgress(e) {
     const width = elements.progressContainer.clientWidth;
     const clickX = e.type.includes('touch') ? e.touches[0].clientX - elements.progressContainer.getBoundingClientRect().left : e.offsetX;
-    const duration = audio.duration || 0;
+    const duration = currentDuration();
     audio.currentTime = (clickX / width) * duration;
 }
 
@@ -264,7 +575,7 @@ async function dragProgress(e) {
     const rect = elements.progressContainer.getBoundingClientRect();
     const offsetX = e.type.includes('touch') ? e.touches[0].clientX - rect.left : e.clientX - rect.left;
     const progressPercent = Math.max(0, Math.min(1, offsetX / width));
-    const duration = audio.duration || 0;
+    const duration = currentDuration();
     audio.currentTime = progressPercent * duration;
     elements.progressBar.style.width = `${progressPercent * 100}%`;
 }
@@ -272,6 +583,7 @@ async function dragProgress(e) {
 function toggleRepeat() {
     const repeatModes = ['none', 'one', 'all'];
     state.repeatMode = repeatModes[(repeatModes.indexOf(state.repeatMode) + 1) % repeatModes.length];
+    prepareNext();
     
     if (state.repeatMode === 'none') {
         elements.repeatButton.innerHTML = '<i class="fas fa-arrow-right"></i>';
@@ -293,35 +605,46 @@ async function toggleShuffle() {
     
     if (state.isShuffle) {
         await shuffleTracks();
-        await loadTrack(state.currentTrackIndex);
+    } else if (state.order) {
+        state.currentTrackIndex = trackIndexAt(state.currentTrackIndex);
+        state.order = null;
     }
+    prepareNext();
 }
 
-async function nextTrack() {
-    const tracks = state.playlists[state.currentPlaylistIndex].tracks;
-    if (tracks.length === 0) return;
+// auto — переход по окончании трека: без повтора очередь на последнем треке останавливается
+async function nextTrack(auto = false) {
+    const count = queueLength();
+    if (count === 0) return;
     if (state.repeatMode === 'one') {
         audio.currentTime = 0;
         await audio.play();
         return;
     }
-    if (state.isShuffle) {
-        state.currentTrackIndex = Math.floor(Math.random() * tracks.length);
+    if (state.currentTrackIndex + 1 < count) {
+        state.currentTrackIndex += 1;
+    } else if (auto && state.repeatMode === 'none') {
+        audio.pause();
+        elements.playButton.innerHTML = '<i class="fas fa-play"></i>';
+        elements.playButton.classList.remove('playing');
+        return;
     } else {
-        state.currentTrackIndex = (state.currentTrackIndex + 1) % tracks.length;
+        // Новый круг: в режиме перемешивания сервер отдаёт следующую перестановку
+        if (state.order) await loadQueue(state.queueCycle + 1);
+        state.currentTrackIndex = 0;
     }
     await loadTrack(state.currentTrackIndex, 'next');
 }
 
 async function prevTrack() {
-    const tracks = state.playlists[state.currentPlaylistIndex].tracks;
-    if (tracks.length === 0) return;
+    const count = queueLength();
+    if (count === 0) return;
     if (state.repeatMode === 'one') {
         audio.currentTime = 0;
         await audio.play();
         return;
     }
-    state.currentTrackIndex = (state.currentTrackIndex - 1 + tracks.length) % tracks.length;
+    state.currentTrackIndex = (state.currentTrackIndex - 1 + count) % count;
     await loadTrack(state.currentTrackIndex, 'prev');
 }
 
@@ -375,24 +698,27 @@ elements.playButton.addEventListener('click', async () => {
 
 elements.shuffleButton.addEventListener('click', toggleShuffle);
 elements.repeatButton.addEventListener('click', toggleRepeat);
-document.getElementById('next').addEventListener('click', nextTrack);
+document.getElementById('next').addEventListener('click', () => nextTrack());
 document.getElementById('prev').addEventListener('click', prevTrack);
 elements.progressContainer.addEventListener('click', setProgress);
-audio.addEventListener('timeupdate', updateProgress);
-
-audio.addEventListener('ended', async () => {
+async function handleEnded(e) {
+    if (e.target !== audio) return;
     if (state.repeatMode === 'one') {
         audio.currentTime = 0;
         await audio.play();
     } else {
-        await nextTrack();
+        await nextTrack(true);
     }
+}
+
+[audio, nextAudio].forEach(element => {
+    element.addEventListener('timeupdate', updateProgress);
+    element.addEventListener('ended', handleEnded);
 });
 
 elements.shareButton.addEventListener('click', async () => {
-    const tracks = state.playlists[state.currentPlaylistIndex].tracks;
-    if (tracks.length === 0) return;
-    const track = tracks[state.currentTrackIndex];
+    const track = state.tracks.get(trackIndexAt(state.currentTrackIndex));
+    if (!track) return;
     const shareData = {
         title: track.title,
         text: `Слушаю "${track.title}" от ${track.artist}`,
@@ -0,0 +1,259 @@
+// Service worker плеера: аудио, обложки и пики волны в Cache Storage с вытеснением давно не слушанного (LRU).
+// Повторное прослушивание не идет в сеть, запросы Range отдаются кусками из кэша.
+
+const CACHE_VERSION = 1; // увеличить при смене формата кэша: старые кэши удаляются при активации
+const CACHE_NAME = `player-media-v${CACHE_VERSION}`;
+const META_URL = '/sw-cache-meta'; // служебная запись с размерами и временем обращения
+const MAX_CACHE_BYTES = 300 * 1024 * 1024;
+const QUOTA_SHARE = 0.5; // не больше половины квоты хранилища, если она меньше MAX_CACHE_BYTES
+const LOW_WATER = 0.9; // вытеснение освобождает место до 90% предела
+const REVALIDATE_AFTER = 6 * 3600 * 1000; // как часто сверять ETag закэшированного файла с сервером
+const META_SAVE_DELAY = 2000;
+const MEDIA_PATH = /^\/(stream|cover|peaks)\//;
+
+// url -> { size, used, etag, checked }
+let meta = null;
+let metaTimer = null;
+let evicting = null;
+let generation = 0; // растет при очистке кэша: загрузки, начатые до нее, в кэше не остаются
+const inflight = new Map(); // url -> промис полной загрузки в кэш
+
+self.addEventListener('install', () => self.skipWaiting());
+
+self.addEventListener('activate', event => {
+    event.waitUntil((async () => {
+        const names = await caches.keys();
+        await Promise.all(names.filter(name => name.startsWith('player-media-') && name !== CACHE_NAME)
+            .map(name => caches.delete(name)));
+        await self.clients.claim();
+    })());
+});
+
+async function loadMeta() {
+    if (meta) return meta;
+    const cache = await caches.open(CACHE_NAME);
+    const stored = await cache.match(META_URL);
+    meta = stored ? await stored.json().catch(() => ({})) : {};
+    return meta;
+}
+
+function scheduleMetaSave() {
+    if (metaTimer) return;
+    metaTimer = setTimeout(async () => {
+        metaTimer = null;
+        const cache = await caches.open(CACHE_NAME);
+        await cache.put(META_URL, new Response(JSON.stringify(meta), { headers: { 'Content-Type': 'application/json' } }));
+    }, META_SAVE_DELAY);
+}
+
+async function cacheLimit() {
+    if (!navigator.storage || !navigator.storage.estimate) return MAX_CACHE_BYTES;
+    const { quota } = await navigator.storage.estimate();
+    return quota ? Math.min(MAX_CACHE_BYTES, quota * QUOTA_SHARE) : MAX_CACHE_BYTES;
+}
+
+// Удаляет самые давно использованные записи, пока кэш больше предела
+async function evict() {
+    if (evicting) return evicting;
+    evicting = (async () => {
+        const entries = await loadMeta();
+        const limit = await cacheLimit();
+        let total = Object.values(entries).reduce((sum, entry) => sum + entry.size, 0);
+        if (total <= limit) return;
+        const cache = await caches.open(CACHE_NAME);
+        const byAge = Object.entries(entries).sort((a, b) => a[1].used - b[1].used);
+        for (const [url, entry] of byAge) {
+            if (total <= limit * LOW_WATER) break;
+            await cache.delete(url);
+            delete entries[url];
+            total -= entry.size;
+        }
+        scheduleMetaSave();
+    })().finally(() => { evicting = null; });
+    return evicting;
+}
+
+// Выход или смена пользователя: медиа прошлой сессии не должно оставаться на устройстве
+async function clearMedia() {
+    generation += 1;
+    clearTimeout(metaTimer);
+    metaTimer = null;
+    meta = {};
+    await caches.delete(CACHE_NAME);
+}
+
+async function remember(url, response, size) {
+    const entries = await loadMeta();
+    const now = Date.now();
+    entries[url] = { size, used: now, etag: response.headers.get('ETag'), checked: now };
+    scheduleMetaSave();
+    await evict();
+}
+
+async function forget(url) {
+    const entries = await loadMeta();
+    const cache = await caches.open(CACHE_NAME);
+    await cache.delete(url);
+    delete entries[url];
+    scheduleMetaSave();
+}
+
+// Скачивает файл целиком (без Range) и кладет в кэш; повторные вызовы для того же url ждут первую загрузку
+function download(url) {
+    if (inflight.has(url)) return inflight.get(url);
+    const promise = (async () => {
+        const started = generation;
+        const response = await fetch(url, { credentials: 'same-origin' });
+        if (response.status !== 200) return;
+        const body = await response.blob();
+        const cache = await caches.open(CACHE_NAME);
+        await cache.put(url, new Response(body, { status: 200, headers: response.headers }));
+        if (started !== generation) return forget(url);
+        await remember(url, response, body.size);
+    })().finally(() => inflight.delete(url));
+    inflight.set(url, promise);
+    return promise;
+}
+
+// Ответ сети для страницы и одновременно запись того же потока в кэш, без второй загрузки
+async function fetchAndCache(event, url, range) {
+    const started = generation;
+    const response = await fetch(url, { credentials: 'same-origin' });
+    if (response.status !== 200 || !response.body) return response;
+    const [forPage, forCache] = response.body.tee();
+    const stored = (async () => {
+        const cache = await caches.open(CACHE_NAME);
+        await cache.put(url, new Response(forCache, { status: 200, headers: response.headers }));
+        if (started !== generation) return forget(url);
+        const size = Number(response.headers.get('Content-Length')) || (await (await cache.match(url)).blob()).size;
+        await remember(url, response, size);
+    })().catch(error => console.warn('Не удалось сохранить в кэш:', url, error))
+        .finally(() => inflight.delete(url));
+    inflight.set(url, stored);
+    event.waitUntil(stored);
+
+    const length = Number(response.headers.get('Content-Length'));
+    if (!range || !length) {
+        return new Response(forPage, { status: 200, headers: response.headers });
+    }
+    // Аудиоэлемент спросил Range bytes=0-: отвечаем 206 на весь файл, как сервер
+    const headers = new Headers(response.headers);
+    headers.set('Content-Range', `bytes 0-${length - 1}/${length}`);
+    headers.set('Content-Length', String(length));
+    return new Response(forPage, { status: 206, headers });
+}
+
+// "bytes=start-end" или "bytes=-suffix" -> { start, end }; null, если диапазон невыполним
+function parseRange(header, size) {
+    const match = /^bytes=(\d*)-(\d*)$/.exec(header.trim());
+    if (!match || (!match[1] && !match[2])) return null;
+    let start, end;
+    if (!match[1]) {
+        start = Math.max(0, size - Number(match[2]));
+        end = size - 1;
+    } else {
+        start = Number(match[1]);
+        end = match[2] ? Math.min(Number(match[2]), size - 1) : size - 1;
+    }
+    return start <= end && start < size ? { start, end } : null;
+}
+
+async function respondFromCache(cached, rangeHeader) {
+    if (!rangeHeader) return cached;
+    const body = await cached.blob();
+    const range = parseRange(rangeHeader, body.size);
+    const headers = new Headers(cached.headers);
+    if (!range) {
+        headers.set('Content-Range', `bytes */${body.size}`);
+        return new Response(null, { status: 416, headers });
+    }
+    headers.set('Content-Range', `bytes ${range.start}-${range.end}/${body.size}`);
+    headers.set('Content-Length', String(range.end - range.start + 1));
+    return new Response(body.slice(range.start, range.end + 1), { status: 206, headers });
+}
+
+// Сверяет ETag записи с сервером: 304 ничего не стоит, новый файл заменяет старый, удаленный (404) уходит из кэша.
+// На 401/403 (истекла сессия) запись остается
+async function revalidate(url, entry) {
+    const started = generation;
+    entry.checked = Date.now();
+    scheduleMetaSave();
+    try {
+        const headers = entry.etag ? { 'If-None-Match': entry.etag } : {};
+        const response = await fetch(url, { credentials: 'same-origin', headers, cache: 'no-store' });
+        if (response.status === 404) {
+            await forget(url);
+        } else if (response.status === 200 && response.headers.get('ETag') !== entry.etag) {
+            const body = await response.blob();
+            const cache = await caches.open(CACHE_NAME);
+            await cache.put(url, new Response(body, { status: 200, headers: response.headers }));
+            if (started !== generation) return forget(url);
+            await remember(url, response, body.size);
+        } else if (response.body) {
+            await response.body.cancel();
+        }
+    } catch (error) {
+        // Нет сети: остаемся на закэшированной версии
+    }
+}
+
+async function handleMedia(event) {
+    const request = event.request;
+    const url = new URL(request.url);
+    const key = url.pathname + url.search;
+    const rangeHeader = request.headers.get('Range');
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(key);
+    const entries = await loadMeta();
+
+    if (cached) {
+        const now = Date.now();
+        // Запись без метаданных: воркер остановили раньше, чем они сохранились
+        const entry = entries[key] || (entries[key] = {
+            size: Number(cached.headers.get('Content-Length')) || 0, etag: cached.headers.get('ETag'), checked: now
+        });
+        entry.used = now;
+        scheduleMetaSave();
+        if (now - entry.checked > REVALIDATE_AFTER) {
+            event.waitUntil(revalidate(key, entry));
+        }
+        return respondFromCache(cached, rangeHeader);
+    }
+
+    // Целиком качаем только запрос без Range или с bytes=0-; проба bytes=0-1 и перемотка до конца загрузки идут в сеть
+    const wholeFile = !rangeHeader || /^bytes=0-$/.test(rangeHeader.trim());
+    if (inflight.has(key) || !wholeFile) {
+        return fetch(request);
+    }
+    try {
+        return await fetchAndCache(event, key, Boolean(rangeHeader));
+    } catch (error) {
+        return fetch(request);
+    }
+}
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') return;
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin || !MEDIA_PATH.test(url.pathname)) return;
+    event.respondWith(handleMedia(event));
+});
+
+// Страница сообщает, что скоро понадобится (обложка и пики следующего трека) или что сессия сменилась
+self.addEventListener('message', event => {
+    const data = event.data || {};
+    if (data.type === 'clear-media') {
+        event.waitUntil(clearMedia());
+        return;
+    }
+    if (data.type !== 'prefetch' || !Array.isArray(data.urls)) return;
+    event.waitUntil((async () => {
+        const cache = await caches.open(CACHE_NAME);
+        for (const url of data.urls) {
+            if (!url || !MEDIA_PATH.test(new URL(url, self.location.origin).pathname)) continue;
+            if (await cache.match(url)) continue;
+            await download(url).catch(error => console.warn('Не удалось предзагрузить:', url, error));
+        }
+    })());
+});
@@ -0,0 +1,684 @@
+import os
+import sys
+import json
+import zlib
+import fcntl
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLAYLIST = "Любимое"
+FSYNC_POLICIES = ("never", "data", "always")
+JOURNAL_MAX_OPS = 64
+LOCK_STRIPES = 256
+
+
+def fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write_json(path: str, data, fsync: str = "data") -> None:
+    """Пишет JSON во временный файл и атомарно переименовывает его поверх path.
+
+    fsync: "never" — без fsync, "data" — fsync файла перед переименованием,
+    "always" — дополнительно fsync каталога после переименования.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+        if fsync != "never":
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if fsync == "always":
+        fsync_dir(os.path.dirname(path) or ".")
+
+
+class UserLocks:
+    """Блокировки на пользователя между потоками (полосы) и процессами (flock)."""
+
+    def __init__(self, stripes: int = LOCK_STRIPES):
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def hold(self, user_dir: str):
+        stripe = self._stripes[zlib.crc32(user_dir.encode()) % len(self._stripes)]
+        with stripe, open(os.path.join(user_dir, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_playlists(user_dir: str, playlists_file: str, fsync: str = "data") -> list:
+    """Загружает или инициализирует файл плейлистов."""
+    if not os.path.exists(playlists_file):
+        default_playlists = [{"name": DEFAULT_PLAYLIST, "tracks": []}]
+        atomic_write_json(playlists_file, default_playlists, fsync)
+        logger.info(f"Создан начальный файл плейлистов в {user_dir}")
+        return default_playlists
+
+    try:
+        with open(playlists_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        logger.error(f"Ошибка чтения файла плейлистов: {playlists_file}")
+        return [{"name": DEFAULT_PLAYLIST, "tracks": []}]
+
+
+class Storage(ABC):
+    """Хранилище метаданных: плейлисты и данные треков пользователей.
+
+    Плейлист — {"name": ..., "version": ..., "tracks": [{"id": "track_...", "title": ..., "artist": ...}]},
+    данные трека — {"title": ..., "artist": ..., "digest": ...} по имени папки трека.
+    У пользователя есть счетчик версий: каждое изменение увеличивает его и
+    записывает новую версию в затронутый плейлист. Методы изменения
+    возвращают (плейлисты, версия).
+    """
+
+    @abstractmethod
+    def has_user(self, user_id) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_versioned(self, user_id) -> tuple:
+        """Возвращает (плейлисты, версия), создавая плейлист по умолчанию для нового пользователя."""
+        raise NotImplementedError
+
+    def load_playlists(self, user_id, strict: bool = False) -> list:
+        """Плейлисты пользователя. strict: ValueError вместо плейлиста по умолчанию, если их не удалось прочитать."""
+        return self.load_versioned(user_id)[0]
+
+    def version(self, user_id) -> int:
+        return self.load_versioned(user_id)[1]
+
+    @abstractmethod
+    def load_tracks(self, user_id, skip_corrupt: bool = True) -> dict:
+        """Возвращает данные всех треков пользователя по имени папки.
+
+        skip_corrupt: пропускать треки, чьи данные не удалось прочитать, вместо исключения.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_track(self, user_id, track_folder: str, track_data: dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_to_playlist(self, user_id, playlist_name: str, track_entry: dict) -> tuple:
+        """Добавляет трек в плейлист, создавая плейлист при необходимости."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_tracks(self, user_id, tracks: list) -> tuple:
+        """Сохраняет пачку треков [(плейлист, папка, данные трека)] и добавляет их в плейлисты одним изменением.
+
+        Версия пользователя увеличивается один раз на всю пачку.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_tracks(self, user_id, track_folders: list) -> int:
+        """Забывает данные треков, чьи папки удалены, и возвращает версию пользователя.
+
+        Записи в плейлистах остаются (позиции — курсоры страниц), но такие
+        треки пропадают из ответов, поэтому затронутые плейлисты и пользователь
+        получают новую версию.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_playlist(self, user_id, playlist_name: str, tracks: list) -> tuple:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_playlist(self, user_id, playlist_name: str) -> tuple:
+        """Удаляет плейлист; если плейлиста с таким именем нет, версия не меняется."""
+        raise NotImplementedError
+
+
+class JsonStorage(Storage):
+    """Совместимое хранилище: playlists.json и data.txt в папках пользователей.
+
+    Изменения одного пользователя сериализуются блокировкой, файлы пишутся
+    атомарно. Добавления треков дописываются в журнал playlists.journal, а
+    playlists.json переписывается один раз на пачку из journal_max_ops
+    добавлений или при создании и удалении плейлиста. Версия пользователя
+    хранится в version.json и в записях журнала.
+    """
+
+    def __init__(self, root: str, fsync: str = "data", journal_max_ops: int = JOURNAL_MAX_OPS):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Неизвестная политика fsync: {fsync}")
+        self._root = root
+        self._fsync = fsync
+        self._journal_max_ops = journal_max_ops
+        self._locks = UserLocks()
+
+    def _user_dir(self, user_id) -> str:
+        user_dir = os.path.join(self._root, f"user_{user_id}")
+        os.makedirs(user_dir, exist_ok=True)
+        return user_dir
+
+    def _read(self, user_dir: str, strict: bool = False) -> tuple:
+        """Читает playlists.json и применяет журнал.
+
+        Возвращает (плейлисты, число записей журнала, crc32 playlists.json, версия).
+        Поврежденный playlists.json заменяется плейлистом по умолчанию, а при strict — ValueError.
+        Записи журнала помечены crc32 файла, поверх которого они сделаны, поэтому
+        журнал, оставшийся после сбоя посреди переписывания, не применяется повторно.
+        """
+        playlists_file = os.path.join(user_dir, "playlists.json")
+        if not os.path.exists(playlists_file):
+            load_playlists(user_dir, playlists_file, self._fsync)
+        with open(playlists_file, "rb") as f:
+            raw = f.read()
+        base = zlib.crc32(raw)
+        try:
+            playlists = json.loads(raw)
+            if not isinstance(playlists, list) or not all(isinstance(p, dict) and "name" in p for p in playlists):
+                raise ValueError(f"Неверный формат файла плейлистов: {playlists_file}")
+        except ValueError:
+            if strict:
+                raise
+            logger.error(f"Ошибка чтения файла плейлистов: {playlists_file}")
+            playlists = [{"name": DEFAULT_PLAYLIST, "tracks": []}]
+
+        # Версия не меньше сохраненной, чем у любого плейлиста и любой записи журнала,
+        # поэтому сбой между записью version.json и playlists.json ее не откатывает
+        version = max([p.get("version", 0) for p in playlists] + [self._read_version(user_dir)])
+        journal_file = os.path.join(user_dir, "playlists.journal")
+        ops = 0
+        try:
+            with open(journal_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Недописанная при сбое последняя строка
+                        logger.error(f"Пропущена поврежденная запись журнала: {journal_file}")
+                        continue
+                    if op.get("base") != base:
+                        continue
+                    append_track(playlists, op["playlist"], op["track"], op["version"])
+                    version = max(version, op["version"])
+                    ops += 1
+        except FileNotFoundError:
+            pass
+        return playlists, ops, base, version
+
+    def _read_version(self, user_dir: str) -> int:
+        try:
+            with open(os.path.join(user_dir, "version.json"), "r", encoding="utf-8") as f:
+                return json.load(f).get("version", 0)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return 0
+
+    def _append_journal(self, user_dir: str, op: dict) -> None:
+        with open(os.path.join(user_dir, "playlists.journal"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(op) + "\n")
+            if self._fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _compact(self, user_dir: str, playlists: list, version: int) -> None:
+        """Переписывает version.json и playlists.json целиком и очищает журнал."""
+        atomic_write_json(os.path.join(user_dir, "version.json"), {"version": version}, self._fsync)
+        atomic_write_json(os.path.join(user_dir, "playlists.json"), playlists, self._fsync)
+        try:
+            os.remove(os.path.join(user_dir, "playlists.journal"))
+        except FileNotFoundError:
+            pass
+
+    def has_user(self, user_id) -> bool:
+        return os.path.exists(os.path.join(self._root, f"user_{user_id}", "playlists.json"))
+
+    def load_versioned(self, user_id) -> tuple:
+        playlists, _, _, version = self._read(self._user_dir(user_id))
+        return playlists, version
+
+    def load_playlists(self, user_id, strict: bool = False) -> list:
+        return self._read(self._user_dir(user_id), strict)[0]
+
+    def version(self, user_id) -> int:
+        """Версия без чтения playlists.json: version.json и записи журнала.
+
+        Перезапись пишет version.json раньше playlists.json, поэтому записи
+        устаревшего журнала не бывают новее version.json.
+        """
+        user_dir = os.path.join(self._root, f"user_{user_id}")
+        version = self._read_version(user_dir)
+        try:
+            with open(os.path.join(user_dir, "playlists.journal"), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        version = max(version, json.loads(line)["version"])
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        return version
+
+    def load_tracks(self, user_id, skip_corrupt: bool = True) -> dict:
+        user_dir = self._user_dir(user_id)
+        tracks = {}
+        for track_folder in os.listdir(user_dir):
+            if not track_folder.startswith("track_"):
+                continue
+            track_path = os.path.join(user_dir, track_folder)
+            if os.path.isdir(track_path):
+                data_file = os.path.join(track_path, "data.txt")
+                try:
+                    with open(data_file, "r", encoding="utf-8") as f:
+                        tracks[track_folder] = json.load(f)
+                except (OSError, json.JSONDecodeError):
+                    if not skip_corrupt:
+                        raise
+                    logger.error(f"Пропущен трек с поврежденным data.txt: {track_path}")
+        return tracks
+
+    def save_track(self, user_id, track_folder: str, track_data: dict) -> None:
+        track_data_path = os.path.join(self._user_dir(user_id), track_folder, "data.txt")
+        atomic_write_json(track_data_path, track_data, self._fsync)
+
+    def add_to_playlist(self, user_id, playlist_name: str, track_entry: dict) -> tuple:
+        user_dir = self._user_dir(user_id)
+        with self._locks.hold(user_dir):
+            playlists, ops, base, version = self._read(user_dir)
+            version += 1
+            if not any(p["name"] == playlist_name for p in playlists):
+                logger.info(f"Создан новый плейлист '{playlist_name}' для трека user_{user_id}")
+            append_track(playlists, playlist_name, track_entry, version)
+            if ops + 1 >= self._journal_max_ops:
+                self._compact(user_dir, playlists, version)
+            else:
+                self._append_journal(user_dir, {
+                    "base": base, "version": version, "playlist": playlist_name, "track": track_entry
+                })
+            return playlists, version
+
+    def add_tracks(self, user_id, tracks: list) -> tuple:
+        user_dir = self._user_dir(user_id)
+        for _, track_folder, track_data in tracks:
+            self.save_track(user_id, track_folder, track_data)
+        with self._locks.hold(user_dir):
+            playlists, _, _, version = self._read(user_dir)
+            version += 1
+            for playlist_name, track_folder, track_data in tracks:
+                append_track(playlists, playlist_name, make_playlist_entry(track_folder, track_data), version)
+            # Одна перезапись playlists.json на пачку вместо записи журнала на каждый трек
+            self._compact(user_dir, playlists, version)
+            return playlists, version
+
+    def delete_tracks(self, user_id, track_folders: list) -> int:
+        # Данные трека лежат в data.txt внутри удаленной папки, остается только сменить версию
+        user_dir = self._user_dir(user_id)
+        folders = set(track_folders)
+        with self._locks.hold(user_dir):
+            playlists, _, _, version = self._read(user_dir)
+            touched = [p for p in playlists if any(t.get("id") in folders for t in p.get("tracks", []))]
+            if not touched:
+                return version
+            version += 1
+            for playlist in touched:
+                playlist["version"] = version
+            self._compact(user_dir, playlists, version)
+            return version
+
+    def create_playlist(self, user_id, playlist_name: str, tracks: list) -> tuple:
+        user_dir = self._user_dir(user_id)
+        with self._locks.hold(user_dir):
+            playlists, _, _, version = self._read(user_dir)
+            version += 1
+            playlists.append({"name": playlist_name, "version": version, "tracks": tracks})
+            self._compact(user_dir, playlists, version)
+            return playlists, version
+
+    def delete_playlist(self, user_id, playlist_name: str) -> tuple:
+        user_dir = self._user_dir(user_id)
+        with self._locks.hold(user_dir):
+            playlists, _, _, version = self._read(user_dir)
+            remaining = [p for p in playlists if not (p["name"] == playlist_name)]
+            if len(remaining) == len(playlists):
+                return playlists, version
+            version += 1
+            self._compact(user_dir, remaining, version)
+            return remaining, version
+
+
+def make_playlist_entry(track_folder: str, track_data: dict) -> dict:
+    """Запись трека в плейлисте по данным трека."""
+    return {"id": track_folder, "title": track_data["title"], "artist": track_data["artist"]}
+
+
+def append_track(playlists: list, playlist_name: str, track_entry: dict, version: int) -> None:
+    """Добавляет трек в первый плейлист с таким именем (или в новый) и помечает плейлист версией."""
+    for playlist in playlists:
+        if playlist["name"] == playlist_name:
+            if not any(t["id"] == track_entry["id"] for t in playlist["tracks"]):
+                playlist["tracks"].append(track_entry)
+            playlist["version"] = version
+            return
+    playlists.append({"name": playlist_name, "version": version, "tracks": [track_entry]})
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    folder TEXT NOT NULL,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    digest TEXT,
+    duration REAL,
+    bitrate INTEGER,
+    sample_rate INTEGER,
+    PRIMARY KEY (user_id, folder)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS playlists (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS playlists_by_user ON playlists(user_id, position);
+CREATE INDEX IF NOT EXISTS playlists_by_name ON playlists(user_id, name);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_id INTEGER NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    track_folder TEXT NOT NULL,
+    PRIMARY KEY (playlist_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS playlist_tracks_by_track ON playlist_tracks(playlist_id, track_folder);
+"""
+
+# Колонки, добавленные после первой версии схемы
+SCHEMA_UPGRADES = (
+    ("users", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("playlists", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("tracks", "duration", "REAL"),
+    ("tracks", "bitrate", "INTEGER"),
+    ("tracks", "sample_rate", "INTEGER"),
+)
+# Необязательные сведения о треке, которые пишутся при разборе аудио
+AUDIO_FIELDS = ("duration", "bitrate", "sample_rate")
+
+SQL_HAS_USER = "SELECT 1 FROM users WHERE id = ?"
+SQL_SELECT_VERSION = "SELECT version FROM users WHERE id = ?"
+SQL_BUMP_VERSION = "UPDATE users SET version = version + 1 WHERE id = ?"
+SQL_INSERT_USER = "INSERT OR IGNORE INTO users (id) VALUES (?)"
+SQL_SELECT_PLAYLISTS = "SELECT id, name, version FROM playlists WHERE user_id = ? ORDER BY position"
+SQL_SELECT_PLAYLIST_TRACKS = (
+    "SELECT pt.playlist_id, pt.track_folder, t.title, t.artist "
+    "FROM playlists p "
+    "JOIN playlist_tracks pt ON pt.playlist_id = p.id "
+    "LEFT JOIN tracks t ON t.user_id = p.user_id AND t.folder = pt.track_folder "
+    "WHERE p.user_id = ? ORDER BY pt.playlist_id, pt.position"
+)
+SQL_SELECT_TRACKS = (
+    "SELECT folder, title, artist, digest, duration, bitrate, sample_rate FROM tracks WHERE user_id = ?"
+)
+SQL_UPSERT_TRACK = (
+    "INSERT INTO tracks (user_id, folder, title, artist, digest, duration, bitrate, sample_rate) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (user_id, folder) DO UPDATE SET title = excluded.title, artist = excluded.artist, "
+    "digest = excluded.digest, duration = excluded.duration, bitrate = excluded.bitrate, "
+    "sample_rate = excluded.sample_rate"
+)
+SQL_FIND_PLAYLIST = "SELECT id FROM playlists WHERE user_id = ? AND name = ? ORDER BY position LIMIT 1"
+SQL_INSERT_PLAYLIST = (
+    "INSERT INTO playlists (user_id, name, version, position) "
+    "SELECT ?, ?, ?, COALESCE(MAX(position) + 1, 0) FROM playlists WHERE user_id = ?"
+)
+SQL_TOUCH_PLAYLIST = "UPDATE playlists SET version = ? WHERE id = ?"
+SQL_HAS_PLAYLIST_TRACK = "SELECT 1 FROM playlist_tracks WHERE playlist_id = ? AND track_folder = ?"
+SQL_INSERT_PLAYLIST_TRACK = (
+    "INSERT INTO playlist_tracks (playlist_id, position, track_folder) "
+    "SELECT ?, COALESCE(MAX(position) + 1, 0), ? FROM playlist_tracks WHERE playlist_id = ?"
+)
+SQL_DELETE_PLAYLIST = "DELETE FROM playlists WHERE user_id = ? AND name = ?"
+SQL_DELETE_TRACK = "DELETE FROM tracks WHERE user_id = ? AND folder = ?"
+SQL_FIND_TRACK_PLAYLISTS = (
+    "SELECT DISTINCT p.id FROM playlists p JOIN playlist_tracks pt ON pt.playlist_id = p.id "
+    "WHERE p.user_id = ? AND pt.track_folder = ?"
+)
+
+
+class SqliteStorage(Storage):
+    """Хранилище метаданных во встроенной SQLite в режиме WAL.
+
+    У каждого потока свое соединение; запросы — постоянные параметризованные
+    строки, поэтому sqlite3 переиспользует подготовленные выражения из кэша.
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        for table, column, declaration in SCHEMA_UPGRADES:
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self, mode: str = "IMMEDIATE"):
+        conn = self._conn()
+        conn.execute(f"BEGIN {mode}")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _ensure_user(self, conn: sqlite3.Connection, user_id) -> None:
+        # Новому пользователю, как и в JSON-хранилище, достается плейлист по умолчанию
+        if conn.execute(SQL_INSERT_USER, (user_id,)).rowcount:
+            conn.execute(SQL_INSERT_PLAYLIST, (user_id, DEFAULT_PLAYLIST, 0, user_id))
+            logger.info(f"Создан начальный плейлист для user_{user_id}")
+
+    def _bump(self, conn: sqlite3.Connection, user_id) -> int:
+        conn.execute(SQL_BUMP_VERSION, (user_id,))
+        return conn.execute(SQL_SELECT_VERSION, (user_id,)).fetchone()[0]
+
+    def _select_playlists(self, conn: sqlite3.Connection, user_id) -> list:
+        playlists = {}
+        for playlist_id, name, version in conn.execute(SQL_SELECT_PLAYLISTS, (user_id,)):
+            playlists[playlist_id] = {"name": name, "version": version, "tracks": []}
+        for playlist_id, track_folder, title, artist in conn.execute(SQL_SELECT_PLAYLIST_TRACKS, (user_id,)):
+            playlists[playlist_id]["tracks"].append({"id": track_folder, "title": title, "artist": artist})
+        return list(playlists.values())
+
+    def has_user(self, user_id) -> bool:
+        return self._conn().execute(SQL_HAS_USER, (user_id,)).fetchone() is not None
+
+    def load_versioned(self, user_id) -> tuple:
+        if not self.has_user(user_id):
+            with self._transaction() as conn:
+                self._ensure_user(conn, user_id)
+        # Плейлисты и версия читаются одним снимком, без блокировки записи
+        with self._transaction("DEFERRED") as conn:
+            return self._select_playlists(conn, user_id), conn.execute(SQL_SELECT_VERSION, (user_id,)).fetchone()[0]
+
+    def version(self, user_id) -> int:
+        row = self._conn().execute(SQL_SELECT_VERSION, (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def load_tracks(self, user_id, skip_corrupt: bool = True) -> dict:
+        # Строки таблицы читаются целиком, пропускать нечего: skip_corrupt только для совместимости
+        tracks = {}
+        for folder, title, artist, digest, *audio in self._conn().execute(SQL_SELECT_TRACKS, (user_id,)):
+            track = {"title": title, "artist": artist, "digest": digest}
+            track.update((field, value) for field, value in zip(AUDIO_FIELDS, audio) if value is not None)
+            tracks[folder] = track
+        return tracks
+
+    def save_track(self, user_id, track_folder: str, track_data: dict) -> None:
+        with self._transaction() as conn:
+            self._ensure_user(conn, user_id)
+            self._upsert_track(conn, user_id, track_folder, track_data)
+
+    def _upsert_track(self, conn: sqlite3.Connection, user_id, track_folder: str, track_data: dict) -> None:
+        conn.execute(SQL_UPSERT_TRACK, (
+            user_id, track_folder, track_data["title"], track_data["artist"], track_data.get("digest"),
+            *(track_data.get(field) for field in AUDIO_FIELDS)
+        ))
+
+    def _append_track(self, conn: sqlite3.Connection, playlist_id: int, track_folder: str) -> None:
+        if conn.execute(SQL_HAS_PLAYLIST_TRACK, (playlist_id, track_folder)).fetchone() is None:
+            conn.execute(SQL_INSERT_PLAYLIST_TRACK, (playlist_id, track_folder, playlist_id))
+
+    def _touch_playlist(self, conn: sqlite3.Connection, user_id, playlist_name: str, version: int) -> int:
+        """Возвращает id плейлиста с новой версией, создавая плейлист при необходимости."""
+        row = conn.execute(SQL_FIND_PLAYLIST, (user_id, playlist_name)).fetchone()
+        if row is None:
+            logger.info(f"Создан новый плейлист '{playlist_name}' для трека user_{user_id}")
+            return conn.execute(SQL_INSERT_PLAYLIST, (user_id, playlist_name, version, user_id)).lastrowid
+        conn.execute(SQL_TOUCH_PLAYLIST, (version, row[0]))
+        return row[0]
+
+    def add_to_playlist(self, user_id, playlist_name: str, track_entry: dict) -> tuple:
+        with self._transaction() as conn:
+            self._ensure_user(conn, user_id)
+            version = self._bump(conn, user_id)
+            playlist_id = self._touch_playlist(conn, user_id, playlist_name, version)
+            self._append_track(conn, playlist_id, track_entry["id"])
+            return self._select_playlists(conn, user_id), version
+
+    def add_tracks(self, user_id, tracks: list) -> tuple:
+        with self._transaction() as conn:
+            self._ensure_user(conn, user_id)
+            version = self._bump(conn, user_id)
+            playlist_ids = {}
+            for playlist_name, track_folder, track_data in tracks:
+                self._upsert_track(conn, user_id, track_folder, track_data)
+                if playlist_name not in playlist_ids:
+                    playlist_ids[playlist_name] = self._touch_playlist(conn, user_id, playlist_name, version)
+                self._append_track(conn, playlist_ids[playlist_name], track_folder)
+            return self._select_playlists(conn, user_id), version
+
+    def delete_tracks(self, user_id, track_folders: list) -> int:
+        with self._transaction() as conn:
+            conn.executemany(SQL_DELETE_TRACK, [(user_id, track_folder) for track_folder in track_folders])
+            playlist_ids = {
+                row[0] for track_folder in track_folders
+                for row in conn.execute(SQL_FIND_TRACK_PLAYLISTS, (user_id, track_folder))
+            }
+            if not playlist_ids:
+                row = conn.execute(SQL_SELECT_VERSION, (user_id,)).fetchone()
+                return row[0] if row else 0
+            version = self._bump(conn, user_id)
+            conn.executemany(SQL_TOUCH_PLAYLIST, [(version, playlist_id) for playlist_id in playlist_ids])
+            return version
+
+    def create_playlist(self, user_id, playlist_name: str, tracks: list) -> tuple:
+        with self._transaction() as conn:
+            self._ensure_user(conn, user_id)
+            version = self._bump(conn, user_id)
+            playlist_id = conn.execute(SQL_INSERT_PLAYLIST, (user_id, playlist_name, version, user_id)).lastrowid
+            for track_entry in tracks:
+                self._append_track(conn, playlist_id, track_entry["id"])
+            return self._select_playlists(conn, user_id), version
+
+    def delete_playlist(self, user_id, playlist_name: str) -> tuple:
+        with self._transaction() as conn:
+            if conn.execute(SQL_DELETE_PLAYLIST, (user_id, playlist_name)).rowcount:
+                version = self._bump(conn, user_id)
+            else:
+                # Нечего удалять: версия и ETag клиентов остаются прежними
+                row = conn.execute(SQL_SELECT_VERSION, (user_id,)).fetchone()
+                version = row[0] if row else 0
+            return self._select_playlists(conn, user_id), version
+
+    def import_user(self, user_id, playlists: list, tracks: dict, version: int = 0) -> bool:
+        """Переносит библиотеку пользователя целиком одной транзакцией. False, если он уже есть."""
+        with self._transaction() as conn:
+            if not conn.execute(SQL_INSERT_USER, (user_id,)).rowcount:
+                return False
+            conn.execute("UPDATE users SET version = ? WHERE id = ?", (version, user_id))
+            for track_folder, track_data in tracks.items():
+                conn.execute(SQL_UPSERT_TRACK, (
+                    user_id, track_folder,
+                    track_data.get("title", "Без названия"),
+                    track_data.get("artist", "Неизвестный исполнитель"),
+                    track_data.get("digest"),
+                    *(track_data.get(field) for field in AUDIO_FIELDS)
+                ))
+            for playlist in playlists:
+                playlist_id = conn.execute(
+                    SQL_INSERT_PLAYLIST, (user_id, playlist["name"], playlist.get("version", 0), user_id)
+                ).lastrowid
+                for track_entry in playlist.get("tracks", []):
+                    self._append_track(conn, playlist_id, track_entry["id"])
+        return True
+
+    def migrate_from_json(self, root: str) -> int:
+        """Однократно переносит существующее дерево static/DB. Возвращает число перенесенных пользователей."""
+        if self._conn().execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return 0
+        source = JsonStorage(root)
+        migrated = 0
+        for user_folder in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+            if not user_folder.startswith("user_"):
+                continue
+            user_id = user_folder[len("user_"):]
+            if not os.path.exists(os.path.join(root, user_folder, "playlists.json")):
+                continue
+            playlists, version = source.load_versioned(user_id)
+            tracks = source.load_tracks(user_id, skip_corrupt=True)
+            if self.import_user(user_id, playlists, tracks, version):
+                migrated += 1
+                logger.info(f"user_{user_id} перенесен в SQLite: {len(playlists)} плейлистов, {len(tracks)} треков")
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', '1')")
+        return migrated
+
+
+def create_storage(backend: str, root: str, db_path: str, fsync: str = "data",
+                   journal_max_ops: int = JOURNAL_MAX_OPS) -> Storage:
+    """Создает хранилище по имени бэкенда: "sqlite" (по умолчанию) или "json"."""
+    if backend == "json":
+        return JsonStorage(root, fsync, journal_max_ops)
+    if backend != "sqlite":
+        raise ValueError(f"Неизвестный бэкенд хранилища: {backend}")
+    storage = SqliteStorage(db_path)
+    migrated = storage.migrate_from_json(root)
+    if migrated:
+        logger.info(f"Перенесено пользователей из JSON в SQLite: {migrated}")
+    return storage
+
+
+if __name__ == '__main__':
+    # Явный перенос: python storage.py static/DB library.sqlite3
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    db_root = sys.argv[1] if len(sys.argv) > 1 else "static/DB"
+    db_file = sys.argv[2] if len(sys.argv) > 2 else "library.sqlite3"
+    print(SqliteStorage(db_file).migrate_from_json(db_root))
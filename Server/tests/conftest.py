@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули сервера импортируются по имени, как в server.py: python -m pytest Server/tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,104 @@
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("requests")
+
+from artwork_cache import ArtworkCache, normalize_key
+
+ARTWORK_URL = "https://example.com/cover/100x100bb.jpg"
+
+
+class FakeTransport:
+    def __init__(self, artwork_url=ARTWORK_URL, gate=None):
+        self.artwork_url = artwork_url
+        self.gate = gate
+        self.searches = 0
+        self.downloads = []
+
+    def get_json(self, url, params, timeout):
+        self.searches += 1
+        if self.gate is not None:
+            self.gate.wait(5)
+        return {"results": [{"artworkUrl100": self.artwork_url}] if self.artwork_url else []}
+
+    def get_bytes(self, url, timeout):
+        self.downloads.append(url)
+        return b"jpeg"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ArtworkCache(str(tmp_path / "artwork"))
+    cache.transport = FakeTransport()
+    return cache
+
+
+def test_normalize_key():
+    assert normalize_key("Кино", "Группа крови!") == normalize_key("  кино ", "группа   КРОВИ")
+    assert normalize_key("Ёлка", "Прованс") == normalize_key("Елка", "Прованс")
+    assert normalize_key("A", "B C") != normalize_key("A B", "C")
+
+
+def test_lookup_caches_hits(cache, tmp_path):
+    path = cache.lookup("Кино", "Кукушка")
+    assert path is not None and open(path, "rb").read() == b"jpeg"
+    assert cache.transport.downloads == ["https://example.com/cover/600x600bb.jpg"]
+    assert cache.lookup("кино", "кукушка") == path
+    assert (cache.hits, cache.misses, cache.transport.searches) == (1, 1, 1)
+    # Тот же URL обложки у другого трека не скачивается повторно
+    cache.lookup("Кино", "Звезда")
+    assert len(cache.transport.downloads) == 1
+
+
+def test_negative_results_are_cached(cache):
+    cache.transport.artwork_url = None
+    assert cache.lookup("Никто", "Ничего") is None
+    assert cache.lookup("Никто", "Ничего") is None
+    assert cache.transport.searches == 1
+
+
+def test_expired_entries_are_fetched_again(tmp_path):
+    cache = ArtworkCache(str(tmp_path / "artwork"), hit_ttl=0, negative_ttl=0)
+    cache.transport = FakeTransport(artwork_url=None)
+    cache.lookup("Никто", "Ничего")
+    cache.lookup("Никто", "Ничего")
+    assert cache.transport.searches == 2
+
+
+def test_missing_file_is_a_miss(cache):
+    path = cache.lookup("Кино", "Кукушка")
+    os.remove(path)
+    assert cache.lookup("Кино", "Кукушка") == path
+    assert os.path.exists(path)
+    assert cache.transport.searches == 2
+
+
+def test_fetch_into_replaces_existing_cover(cache, tmp_path):
+    target = tmp_path / "cover.jpeg"
+    target.write_bytes(b"old")
+    assert cache.fetch_into("Кино", "Кукушка", str(target))
+    path = cache.lookup("Кино", "Кукушка")
+    assert target.read_bytes() == b"jpeg"
+    # Старая обложка трека удаляется, а не перезаписывается поверх общего файла
+    assert open(path, "rb").read() == b"jpeg"
+    assert cache.fetch_into("Кино", "Кукушка", str(target))
+    cache.transport.artwork_url = None
+    assert not cache.fetch_into("Никто", "Ничего", str(tmp_path / "none.jpeg"))
+
+
+def test_concurrent_lookups_share_one_request(cache):
+    gate = threading.Event()
+    cache.transport.gate = gate
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.lookup("Кино", "Кукушка"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while cache.transport.searches == 0:
+        pass
+    gate.set()
+    for thread in threads:
+        thread.join()
+    assert len(set(results)) == 1 and results[0] is not None
+    assert cache.transport.searches == 1
@@ -0,0 +1,118 @@
+import pytest
+
+pytest.importorskip("werkzeug")
+
+import os
+import time
+from email.utils import formatdate
+
+from audio_stream import make_etag, parse_range, plan_response
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, SIZE - 1)),
+    ("bytes=-100", (SIZE - 100, SIZE - 1)),
+    ("bytes=990-5000", (990, SIZE - 1)),
+    ("bytes=-5000", (0, SIZE - 1)),
+    ("bytes=999-999", (999, 999)),
+    ("Bytes = 0-0", (0, 0)),
+])
+def test_parse_range_satisfiable(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=1000-",
+    "bytes=1000-1001",
+    "bytes=500-100",
+    "bytes=-0",
+])
+def test_parse_range_unsatisfiable(header):
+    assert parse_range(header, SIZE) is False
+
+
+@pytest.mark.parametrize("header", [
+    "items=0-1",
+    "bytes=",
+    "bytes=abc-def",
+    "bytes=10",
+    "bytes=1-x",
+    "bytes=0-1,5-10",
+    "bytes=5000-6000,0-1",
+])
+def test_parse_range_ignored(header):
+    assert parse_range(header, SIZE) is None
+
+
+def test_parse_range_empty_file():
+    assert parse_range("bytes=0-", 0) is False
+    assert parse_range("bytes=-10", 0) is False
+
+
+@pytest.fixture
+def st(tmp_path):
+    path = tmp_path / "song.mp3"
+    path.write_bytes(b"x" * SIZE)
+    return os.stat(path)
+
+
+def test_plan_full_file(st):
+    status, headers, start, length = plan_response(st, {}, "GET")
+    assert (status, start, length) == (200, 0, SIZE)
+    assert headers["ETag"] == make_etag(st)
+    assert headers["Accept-Ranges"] == "bytes"
+    assert "Content-Range" not in headers
+
+
+def test_plan_single_range(st):
+    status, headers, start, length = plan_response(st, {"Range": "bytes=100-199"}, "GET")
+    assert (status, start, length) == (206, 100, 100)
+    assert headers["Content-Range"] == f"bytes 100-199/{SIZE}"
+
+
+def test_plan_unsatisfiable_range(st):
+    status, headers, _, length = plan_response(st, {"Range": f"bytes={SIZE}-"}, "GET")
+    assert (status, length) == (416, 0)
+    assert headers["Content-Range"] == f"bytes */{SIZE}"
+
+
+def test_plan_multi_range_sends_whole_file(st):
+    status, headers, start, length = plan_response(st, {"Range": "bytes=0-1,5-10"}, "GET")
+    assert (status, start, length) == (200, 0, SIZE)
+    assert "Content-Range" not in headers
+
+
+def test_plan_range_ignored_for_head(st):
+    status, _, _, length = plan_response(st, {"Range": "bytes=0-9"}, "HEAD")
+    assert (status, length) == (200, SIZE)
+
+
+@pytest.mark.parametrize("validator", ["etag", "date"])
+def test_plan_if_range_matching(st, validator):
+    if_range = make_etag(st) if validator == "etag" else formatdate(st.st_mtime, usegmt=True)
+    status, _, start, length = plan_response(st, {"Range": "bytes=10-19", "If-Range": if_range}, "GET")
+    assert (status, start, length) == (206, 10, 10)
+
+
+@pytest.mark.parametrize("if_range", ['"stale-etag"', 'W/"weak"', formatdate(time.time() - 86400 * 30, usegmt=True)])
+def test_plan_if_range_stale(st, if_range):
+    # Файл изменился: вместо части нового файла отдается он целиком
+    status, headers, start, length = plan_response(st, {"Range": "bytes=10-19", "If-Range": if_range}, "GET")
+    assert (status, start, length) == (200, 0, SIZE)
+    assert "Content-Range" not in headers
+
+
+@pytest.mark.parametrize("if_none_match", ["etag", "*", 'W/etag', '"other", etag'])
+def test_plan_if_none_match(st, if_none_match):
+    if_none_match = if_none_match.replace("etag", make_etag(st))
+    status, headers, _, length = plan_response(st, {"If-None-Match": if_none_match, "Range": "bytes=0-9"}, "GET")
+    assert (status, length) == (304, 0)
+    assert headers["ETag"] == make_etag(st)
+
+
+def test_plan_if_none_match_other(st):
+    status, _, _, _ = plan_response(st, {"If-None-Match": '"other"'}, "GET")
+    assert status == 200
@@ -0,0 +1,74 @@
+import hmac
+import json
+import time
+import hashlib
+import urllib.parse
+
+import pytest
+
+from auth import AuthError, CLOCK_SKEW, verify_init_data
+
+BOT_TOKEN = "123456:test-token"
+USER = {"id": 42, "first_name": "Тест"}
+
+
+def sign(fields: dict, bot_token: str = BOT_TOKEN) -> str:
+    """Собирает initData так же, как Telegram Web App."""
+    data_check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    received_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urllib.parse.urlencode(dict(fields, hash=received_hash))
+
+
+def init_data(auth_date: float = None, user: dict = USER, **extra) -> str:
+    fields = {"auth_date": str(int(time.time() if auth_date is None else auth_date)),
+              "user": json.dumps(user), **extra}
+    return sign(fields)
+
+
+def test_valid_init_data():
+    assert verify_init_data(init_data(query_id="AAE"), BOT_TOKEN) == USER
+
+
+def test_wrong_bot_token():
+    with pytest.raises(AuthError):
+        verify_init_data(init_data(), "654321:other-token")
+
+
+def test_tampered_field():
+    fields = dict(urllib.parse.parse_qsl(init_data()))
+    fields["user"] = json.dumps({"id": 1, "first_name": "Тест"})
+    with pytest.raises(AuthError, match="подпись"):
+        verify_init_data(urllib.parse.urlencode(fields), BOT_TOKEN)
+
+
+def test_added_field():
+    with pytest.raises(AuthError, match="подпись"):
+        verify_init_data(init_data() + "&start_param=x", BOT_TOKEN)
+
+
+def test_missing_hash():
+    fields = dict(urllib.parse.parse_qsl(init_data()))
+    del fields["hash"]
+    with pytest.raises(AuthError, match="hash"):
+        verify_init_data(urllib.parse.urlencode(fields), BOT_TOKEN)
+
+
+def test_expired():
+    with pytest.raises(AuthError, match="устарели"):
+        verify_init_data(init_data(time.time() - 3600), BOT_TOKEN, max_age=600)
+
+
+def test_from_future():
+    with pytest.raises(AuthError, match="устарели"):
+        verify_init_data(init_data(time.time() + CLOCK_SKEW + 600), BOT_TOKEN)
+
+
+def test_signed_but_without_user_id():
+    with pytest.raises(AuthError, match="id"):
+        verify_init_data(init_data(user={"first_name": "Тест"}), BOT_TOKEN)
+
+
+def test_malformed():
+    with pytest.raises(AuthError):
+        verify_init_data("not init data", BOT_TOKEN)
@@ -0,0 +1,70 @@
+import io
+import os
+
+import pytest
+
+from blob_store import BlobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(str(tmp_path / "blobs"))
+
+
+def track_path(tmp_path, user_id, folder):
+    track_dir = tmp_path / f"user_{user_id}" / folder
+    track_dir.mkdir(parents=True)
+    return str(track_dir / "song.mp3")
+
+
+def test_ingest_dedupes_identical_uploads(store, tmp_path):
+    first = track_path(tmp_path, 1, "track_1")
+    second = track_path(tmp_path, 2, "track_1")
+    digest = store.ingest(io.BytesIO(b"audio"), first)
+    assert store.ingest(io.BytesIO(b"audio"), second) == digest
+    assert store.refcount(digest) == 2
+    assert os.stat(first).st_ino == os.stat(second).st_ino == os.stat(store.blob_path(digest)).st_ino
+    with open(second, "rb") as f:
+        assert f.read() == b"audio"
+
+
+def test_streaming_upload(store, tmp_path):
+    target = track_path(tmp_path, 1, "track_1")
+    upload = store.open_upload()
+    upload.write(b"aud")
+    upload.write(b"io")
+    assert upload.size() == 5
+    digest = store.ingest(upload, target)
+    assert digest == store.ingest(io.BytesIO(b"audio"), track_path(tmp_path, 2, "track_1"))
+    assert not os.path.exists(upload.path)
+    assert store.refcount(digest) == 2
+
+
+def test_release_removes_blob_with_last_reference(store, tmp_path):
+    first = track_path(tmp_path, 1, "track_1")
+    second = track_path(tmp_path, 2, "track_1")
+    digest = store.ingest(io.BytesIO(b"audio"), first)
+    store.ingest(io.BytesIO(b"audio"), second)
+
+    store.release(first, digest)
+    assert not os.path.exists(first)
+    assert store.refcount(digest) == 1
+    # Без digest блоб ищется по inode
+    store.release(second)
+    assert not os.path.exists(store.blob_path(digest))
+    assert store.refcount(digest) == 0
+
+
+def test_collect_removes_only_unreferenced_blobs(store, tmp_path):
+    kept = store.ingest(io.BytesIO(b"kept"), track_path(tmp_path, 1, "track_1"))
+    orphan_path = track_path(tmp_path, 1, "track_2")
+    orphan = store.ingest(io.BytesIO(b"orphan"), orphan_path)
+    # Папку трека удалили мимо release, блоб остался без ссылок
+    os.remove(orphan_path)
+
+    assert store.collect(dry_run=True) == [store.blob_path(orphan)]
+    assert os.path.exists(store.blob_path(orphan))
+    assert store.collect() == [store.blob_path(orphan)]
+    assert not os.path.exists(store.blob_path(orphan))
+    assert store.refcount(kept) == 1
+    assert store.collect() == []
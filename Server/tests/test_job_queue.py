@@ -0,0 +1,171 @@
+import time
+import sqlite3
+import threading
+
+import pytest
+
+import job_queue
+from job_queue import JobQueue, QueueFull, PRIORITY_BACKFILL, PRIORITY_INTERACTIVE, retry_delay
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "jobs.sqlite3")
+
+
+@pytest.fixture
+def queue(db_path):
+    return JobQueue(db_path, workers=0, host_limit=1, max_backlog=3, max_attempts=2)
+
+
+def job_row(db_path: str, key: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    return dict(conn.execute("SELECT * FROM jobs WHERE key = ?", (key,)).fetchone())
+
+
+def claim_key(queue: JobQueue):
+    job = queue._claim()
+    return None if job is None else job[2]["key"]
+
+
+def test_priority_then_fifo(queue):
+    queue.enqueue("cover", {"key": "b1"}, "b1", PRIORITY_BACKFILL)
+    queue.enqueue("cover", {"key": "i1"}, "i1")
+    queue.enqueue("cover", {"key": "b2"}, "b2", PRIORITY_BACKFILL)
+    queue.enqueue("cover", {"key": "i2"}, "i2")
+    assert [claim_key(queue) for _ in range(5)] == ["i1", "i2", "b1", "b2", None]
+
+
+def test_enqueue_is_idempotent_and_raises_priority(queue, db_path):
+    queue.enqueue("cover", {"key": "a"}, "a", PRIORITY_BACKFILL)
+    queue.enqueue("cover", {"key": "a"}, "a")
+    assert job_row(db_path, "a")["priority"] == PRIORITY_INTERACTIVE
+    assert queue.stats()["depth"] == 1
+
+
+def test_backfill_backpressure(queue):
+    for n in range(3):
+        queue.enqueue("cover", {"key": n}, f"b{n}", PRIORITY_BACKFILL)
+    with pytest.raises(QueueFull):
+        queue.enqueue("cover", {}, "b3", PRIORITY_BACKFILL)
+    # Интерактивные задачи принимаются всегда
+    queue.enqueue("cover", {}, "i", PRIORITY_INTERACTIVE)
+
+
+def test_host_limit(queue):
+    queue.enqueue("cover", {"key": "h1"}, "h1", host="itunes")
+    queue.enqueue("cover", {"key": "h2"}, "h2", host="itunes")
+    queue.enqueue("cover", {"key": "other"}, "other", host="example")
+    assert claim_key(queue) == "h1"
+    # Второй запрос к itunes ждет, пока первый не завершится
+    assert claim_key(queue) == "other"
+    assert claim_key(queue) is None
+
+
+def test_done(queue, db_path):
+    calls = []
+    queue.register("cover", calls.append)
+    queue.enqueue("cover", {"key": "a"}, "a")
+    queue._execute(*queue._claim())
+    assert calls == [{"key": "a"}]
+    row = job_row(db_path, "a")
+    assert row["status"] == "done" and row["locked_by"] is None
+    # Выполненная задача повторно не ставится
+    queue.enqueue("cover", {"key": "a"}, "a")
+    assert queue._claim() is None
+
+
+def test_retry_with_backoff_then_failed(queue, db_path, monkeypatch):
+    monkeypatch.setattr(job_queue, "retry_delay", lambda attempt: 60.0)
+
+    def broken(payload):
+        raise OSError("нет сети")
+
+    queue.register("cover", broken)
+    queue.enqueue("cover", {"key": "a"}, "a")
+    before = time.time()
+    queue._execute(*queue._claim())
+    row = job_row(db_path, "a")
+    assert row["status"] == "pending" and row["attempts"] == 1
+    assert row["run_at"] >= before + 60
+    assert "нет сети" in row["last_error"]
+    assert queue._claim() is None
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("UPDATE jobs SET run_at = 0")
+    queue._execute(*queue._claim())
+    assert job_row(db_path, "a")["status"] == "failed"
+    assert queue.stats()["failed"] == 1
+    # Упавшая задача ставится заново
+    queue.enqueue("cover", {"key": "a"}, "a")
+    assert job_row(db_path, "a")["status"] == "pending"
+
+
+def test_retry_delay_is_capped_full_jitter():
+    for attempt in range(1, 20):
+        assert 0 <= retry_delay(attempt, base=1.0, cap=30.0) <= min(30.0, 2 ** (attempt - 1))
+
+
+def test_expired_lease_is_reclaimed(db_path):
+    first = JobQueue(db_path, workers=0, lease=0.05)
+    second = JobQueue(db_path, workers=0, lease=60)
+    first.enqueue("cover", {"key": "a"}, "a")
+    assert first._claim() is not None
+    assert second._claim() is None
+    time.sleep(0.1)
+    job = second._claim()
+    assert job is not None and job[3] == 2
+
+
+def test_lost_lease_does_not_finish_job(db_path):
+    stale = JobQueue(db_path, workers=0, lease=60)
+    fresh = JobQueue(db_path, workers=0, lease=60)
+    stale.enqueue("cover", {"key": "a"}, "a")
+    job = stale._claim()
+    # Аренда истекла, задачу забрал другой обработчик
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("UPDATE jobs SET locked_until = 0")
+    assert fresh._claim() is not None
+
+    stale.register("cover", lambda payload: None)
+    stale._execute(*job)
+    assert stale.lost_leases == 1
+    row = job_row(db_path, "a")
+    assert row["status"] == "running" and row["attempts"] == 2
+
+
+def test_heartbeat_extends_lease(db_path):
+    queue = JobQueue(db_path, workers=0, lease=0.3)
+    other = JobQueue(db_path, workers=0, lease=60)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(payload):
+        started.set()
+        release.wait(5)
+
+    queue.register("cover", slow)
+    queue.enqueue("cover", {"key": "a"}, "a")
+    job = queue._claim()
+    worker = threading.Thread(target=queue._execute, args=job)
+    worker.start()
+    started.wait(5)
+    time.sleep(0.6)
+    # Аренда старше lease, но продлевается, поэтому задачу не перехватывают
+    assert other._claim() is None
+    release.set()
+    worker.join(5)
+    assert job_row(db_path, "a")["status"] == "done"
+    assert queue.lost_leases == 0
+
+
+def test_workers_run_jobs(db_path):
+    queue = JobQueue(db_path, workers=2)
+    done = threading.Event()
+    queue.register("cover", lambda payload: done.set())
+    queue.start()
+    try:
+        queue.enqueue("cover", {}, "a")
+        assert done.wait(5)
+    finally:
+        queue.stop()
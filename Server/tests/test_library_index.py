@@ -0,0 +1,166 @@
+import threading
+
+import pytest
+
+from library_index import LibraryIndex, PlaylistChanged
+
+
+class FakeStore:
+    """Загрузчик и версии библиотек в памяти с подсчетом обращений."""
+
+    def __init__(self):
+        self.libraries = {}
+        self.loads = 0
+        self.version_reads = 0
+
+    def add(self, user_id, playlists: list, tracks: dict, version: int) -> None:
+        self.libraries[str(user_id)] = (playlists, tracks, version)
+
+    def load(self, user_id) -> tuple:
+        self.loads += 1
+        playlists, tracks, version = self.libraries[str(user_id)]
+        return [dict(p, tracks=list(p["tracks"])) for p in playlists], dict(tracks), version
+
+    def version(self, user_id) -> int:
+        self.version_reads += 1
+        return self.libraries[str(user_id)][2]
+
+
+def entries(*folders) -> list:
+    return [{"id": folder} for folder in folders]
+
+
+def data(*folders) -> dict:
+    return {folder: {"title": folder, "artist": "Исполнитель"} for folder in folders}
+
+
+@pytest.fixture
+def store():
+    store = FakeStore()
+    folders = [f"track_{n}" for n in range(10)]
+    # track_3 и track_7 остались в плейлисте, но их данных нет
+    store.add(1, [{"name": "Любимое", "version": 2, "tracks": entries(*folders)},
+                  {"name": "Рок", "version": 1, "tracks": entries("track_0")}],
+              data(*(f for f in folders if f not in ("track_3", "track_7"))), 2)
+    return store
+
+
+@pytest.fixture
+def index(store):
+    return LibraryIndex(store.load, version_of=store.version)
+
+
+def test_page_skips_missing_tracks_without_shifting_positions(index):
+    page = index.page(1, "Любимое", 0, 4)
+    assert [t["position"] for t in page["tracks"]] == [0, 1, 2, 4]
+    assert page["count"] == 10
+    assert page["next_cursor"] == 5
+
+    page = index.page(1, "Любимое", page["next_cursor"], 4, playlist_version=page["version"])
+    assert [t["title"] for t in page["tracks"]] == ["track_5", "track_6", "track_8", "track_9"]
+    assert [t["position"] for t in page["tracks"]] == [5, 6, 8, 9]
+    assert page["next_cursor"] is None
+
+
+def test_pages_cover_every_track_once(index):
+    seen, cursor = [], 0
+    while cursor is not None:
+        page = index.page(1, "Любимое", cursor, 3, playlist_version=2)
+        seen += [t["position"] for t in page["tracks"]]
+        cursor = page["next_cursor"]
+    assert seen == [0, 1, 2, 4, 5, 6, 8, 9]
+
+
+def test_stale_cursor_raises(index, store):
+    index.page(1, "Любимое", 0, 4)
+    playlists, tracks, _ = store.libraries["1"]
+    store.add(1, [dict(playlists[0], version=3, tracks=playlists[0]["tracks"][2:]), playlists[1]], tracks, 3)
+    with pytest.raises(PlaylistChanged) as e:
+        index.page(1, "Любимое", 4, 4, playlist_version=2)
+    assert e.value.summary == {"name": "Любимое", "count": 8, "version": 3}
+
+
+def test_playlists_are_addressed_by_name(index):
+    assert index.page(1, "Рок", 0, 10)["tracks"][0]["position"] == 0
+    assert index.page(1, "Нет такого", 0, 10) is None
+    assert index.summary(1, "Рок") == {"name": "Рок", "count": 1, "version": 1}
+    assert index.summary(1, "Нет такого") is None
+
+
+def test_resolve_and_summaries(index):
+    version, playlists = index.resolve(1)
+    assert version == 2
+    assert [t["title"] for t in playlists[0]["tracks"]] == \
+        [f"track_{n}" for n in range(10) if n not in (3, 7)]
+    _, changed = index.resolve(1, since=1)
+    assert [p["name"] for p in changed] == ["Любимое"]
+    assert index.summaries(1) == (2, [{"name": "Любимое", "count": 10, "version": 2},
+                                      {"name": "Рок", "count": 1, "version": 1}])
+
+
+def test_reloads_when_storage_version_changes(index, store):
+    index.get(1)
+    index.get(1)
+    assert store.loads == 1
+    playlists, tracks, _ = store.libraries["1"]
+    store.add(1, playlists + [{"name": "Новый", "version": 3, "tracks": []}], tracks, 3)
+    assert index.names(1) == ["Любимое", "Рок", "Новый"]
+    assert store.loads == 2
+
+
+def test_local_updates(index):
+    index.get(1)
+    index.put_track(1, "track_3", {"title": "track_3", "artist": "Исполнитель"})
+    assert [t["position"] for t in index.page(1, "Любимое", 3, 1)["tracks"]] == [3]
+    index.set_playlists(1, [{"name": "Другой", "version": 5, "tracks": []}], 5)
+    assert index.get(1).version == 5
+
+
+def test_concurrent_misses_load_once(store):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_load(user_id):
+        started.set()
+        release.wait(5)
+        return store.load(user_id)
+
+    index = LibraryIndex(slow_load)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(index.get(1))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert store.loads == 1
+    assert len(results) == 4 and all(library is results[0] for library in results)
+
+
+def test_eviction_by_users_and_tracks(store):
+    for user_id in (2, 3):
+        store.add(user_id, [{"name": "Любимое", "tracks": []}], data("track_a", "track_b"), 0)
+    index = LibraryIndex(store.load, max_users=2)
+    for user_id in (1, 2, 3):
+        index.get(user_id)
+    index.get(2)
+    assert store.loads == 3
+    index.get(1)
+    assert store.loads == 4
+
+    # 2 + 8 треков превышают лимит: user_2 вытесняется и читается заново
+    index = LibraryIndex(store.load, max_tracks=9)
+    index.get(2)
+    index.get(1)
+    index.get(2)
+    assert store.loads == 7
+
+
+def test_known_version_skips_storage_reads(index, store):
+    # /playlists: версия читается один раз, сборка ответа ей доверяет
+    current = index.version(1)
+    index.resolve(1, None, current)
+    index.names(1, current)
+    index.summaries(1, current)
+    assert store.version_reads == 1
+    assert store.loads == 1
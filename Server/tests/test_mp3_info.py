@@ -0,0 +1,106 @@
+import os
+import struct
+import threading
+
+import mp3_info
+
+FRAME_LENGTH = 144 * 128000 // 44100
+
+
+def side_info(gain: int) -> bytes:
+    """Side info MPEG-1 стерео: 20 бит общих полей и 4 блока гранула/канал по 59 бит."""
+    bits = "0" * 20
+    for _ in range(4):
+        bits += format(100, "012b") + "0" * 9 + format(gain, "08b") + "0" * 30
+    return int(bits, 2).to_bytes(32, "big")
+
+
+def frame(gain: int, crc: bool = False, body: bytes = b"") -> bytes:
+    """Кадр MPEG-1 Layer III, 128 кбит/с, 44.1 кГц, стерео; с crc бит protection сброшен."""
+    header = b"\xff\xfa\x90\x00" if crc else b"\xff\xfb\x90\x00"
+    data = header + (b"\x12\x34" if crc else b"") + (body or side_info(gain))
+    return data.ljust(FRAME_LENGTH, b"\x00")
+
+
+def xing_frame(frames: int, crc: bool = False) -> bytes:
+    return frame(0, crc, bytes(32) + b"Xing" + struct.pack(">II", 1, frames))
+
+
+def write(tmp_path, data: bytes) -> str:
+    path = tmp_path / "song.mp3"
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_parse_header():
+    header = mp3_info.parse_header(frame(0), 0)
+    assert (header.mpeg1, header.layer, header.bitrate, header.sample_rate) == (True, 3, 128000, 44100)
+    assert (header.length, header.samples, header.side_info, header.crc) == (FRAME_LENGTH, 1152, 32, 0)
+    assert mp3_info.parse_header(frame(0, crc=True), 0).crc == 2
+    assert mp3_info.parse_header(b"\x00" * 4, 0) is None
+
+
+def test_analyze_counts_frames(tmp_path):
+    info = mp3_info.analyze(write(tmp_path, b"".join(frame(gain) for gain in (100, 200) * 5)))
+    assert info["duration"] == round(10 * 1152 / 44100, 3)
+    assert info["sample_rate"] == 44100
+    assert abs(info["bitrate"] - 128000) < 1000
+    assert info["peaks"] == bytes([16, 255] * 5)
+
+
+def test_crc_precedes_side_info(tmp_path):
+    plain = mp3_info.analyze(write(tmp_path, b"".join(frame(gain) for gain in (100, 200) * 5)))
+    protected = mp3_info.analyze(write(tmp_path, b"".join(frame(gain, crc=True) for gain in (100, 200) * 5)))
+    assert protected["peaks"] == plain["peaks"]
+
+
+def test_xing_header(tmp_path):
+    for crc in (False, True):
+        info = mp3_info.analyze(write(tmp_path, xing_frame(1000, crc) + frame(100, crc) * 3))
+        assert info["duration"] == round(1000 * 1152 / 44100, 3)
+        # Кадр Xing не содержит звука и не попадает в пики
+        assert len(info["peaks"]) == 3
+
+
+def test_skips_id3v2_and_garbage(tmp_path):
+    tag = b"ID3\x04\x00\x00\x00\x00\x00\x0a" + bytes(10)
+    info = mp3_info.analyze(write(tmp_path, tag + b"junk" + frame(100) * 4))
+    assert info["duration"] == round(4 * 1152 / 44100, 3)
+
+
+def test_no_frames(tmp_path):
+    assert mp3_info.analyze(write(tmp_path, b"")) is None
+    assert mp3_info.analyze(write(tmp_path, b"not an mp3 file" * 100)) is None
+
+
+def test_write_peaks(tmp_path):
+    path = str(tmp_path / "peaks.bin")
+    mp3_info.write_peaks(path, b"\x10\xff", 12.5)
+    with open(path, "rb") as f:
+        data = f.read()
+    assert mp3_info.PEAKS_HEADER.unpack_from(data) == (mp3_info.PEAKS_MAGIC, 2, 12500)
+    assert data[mp3_info.PEAKS_HEADER.size:] == b"\x10\xff"
+    assert os.listdir(tmp_path) == ["peaks.bin"]
+
+
+def test_concurrent_write_peaks(tmp_path):
+    path = str(tmp_path / "peaks.bin")
+    errors = []
+
+    def writer(value):
+        try:
+            for _ in range(50):
+                mp3_info.write_peaks(path, bytes([value]) * 64, 1.0)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(value,)) for value in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    with open(path, "rb") as f:
+        data = f.read()
+    assert len(set(data[mp3_info.PEAKS_HEADER.size:])) == 1
+    assert os.listdir(tmp_path) == ["peaks.bin"]
@@ -0,0 +1,39 @@
+from play_queue import default_seed, make_order
+
+
+def test_ordered():
+    assert make_order(5) == [0, 1, 2, 3, 4]
+    assert make_order(5, start=3) == [3, 4, 0, 1, 2]
+    assert make_order(5, start=7) == [0, 1, 2, 3, 4]
+    assert make_order(0) == []
+
+
+def test_shuffle_is_reproducible_permutation():
+    order = make_order(50, "shuffle", "seed")
+    assert sorted(order) == list(range(50))
+    assert order != list(range(50))
+    assert make_order(50, "shuffle", "seed") == order
+    assert make_order(50, "shuffle", "other") != order
+
+
+def test_each_cycle_is_shuffled_anew():
+    first = make_order(50, "shuffle", "seed", cycle=0)
+    second = make_order(50, "shuffle", "seed", cycle=1)
+    assert first != second
+    assert make_order(50, "shuffle", "seed", cycle=1) == second
+
+
+def test_shuffle_keeps_current_track_first():
+    base = make_order(20, "shuffle", "seed")
+    order = make_order(20, "shuffle", "seed", start=base[5])
+    assert order[0] == base[5]
+    assert order[1:] == [position for position in base if position != base[5]]
+
+
+def test_default_seed():
+    seed = default_seed(1, "Любимое", 3)
+    assert seed == default_seed(1, "Любимое", 3)
+    assert len(seed) == 16
+    assert seed != default_seed(1, "Любимое", 4)
+    assert seed != default_seed(2, "Любимое", 3)
+    assert seed != default_seed(1, "Другое", 3)
@@ -0,0 +1,134 @@
+import io
+import os
+import sys
+import sqlite3
+import subprocess
+
+import pytest
+
+from blob_store import BlobStore
+from reconcile import Reconciler
+from storage import JsonStorage, SqliteStorage
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def root(tmp_path):
+    """Библиотека user_1: целый трек, трек без data.txt, трек без аудио и папка вне плейлистов."""
+    root = str(tmp_path / "DB")
+    storage = JsonStorage(root, fsync="never")
+    blob_store = BlobStore(os.path.join(root, "blobs"))
+    user_dir = os.path.join(root, "user_1")
+    tracks = {}
+    for folder, audio in (("track_ok", b"ok"), ("track_nodata", b"nodata"), ("track_corrupt", None),
+                          ("track_orphan", b"orphan")):
+        os.makedirs(os.path.join(user_dir, folder))
+        tracks[folder] = {"title": folder, "artist": "Исполнитель"}
+        if audio is not None:
+            tracks[folder]["digest"] = blob_store.ingest(io.BytesIO(audio), os.path.join(user_dir, folder, "song.mp3"))
+    storage.add_tracks(1, [("Любимое", folder, data) for folder, data in tracks.items() if folder != "track_orphan"])
+    storage.save_track(1, "track_orphan", tracks["track_orphan"])
+    os.remove(os.path.join(user_dir, "track_nodata", "data.txt"))
+    return root
+
+
+def snapshot(root: str) -> dict:
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name == ".lock":
+                continue
+            path = os.path.join(dirpath, name)
+            st = os.stat(path)
+            files[os.path.relpath(path, root)] = (st.st_size, st.st_mtime_ns, st.st_nlink)
+    return files
+
+
+def make_reconciler(root: str, tmp_path) -> Reconciler:
+    return Reconciler(root, JsonStorage(root, fsync="never"), BlobStore(os.path.join(root, "blobs")),
+                      str(tmp_path / "reconcile.sqlite3"), grace=0, track_pause=0, user_pause=0)
+
+
+def test_dry_run_changes_nothing(root, tmp_path):
+    before = snapshot(root)
+    reconciler = make_reconciler(root, tmp_path)
+    summary = reconciler.run_pass(dry_run=True)
+
+    assert summary["removed"] == 2
+    assert summary["repaired"] == 1
+    assert summary["blobs"] == 0
+    report, = summary["reports"]
+    assert report["orphan"] == ["track_orphan"]
+    assert report["corrupt"] == ["track_corrupt"]
+    assert sorted(report["removed"]) == ["track_corrupt", "track_orphan"]
+    assert snapshot(root) == before
+    assert reconciler.usage(1) == (0, 0)
+    conn = sqlite3.connect(str(tmp_path / "reconcile.sqlite3"))
+    assert conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0] == 0
+    assert conn.execute("SELECT value FROM meta WHERE key = 'cursor'").fetchone() is None
+
+
+def test_pass_removes_and_repairs(root, tmp_path):
+    storage = JsonStorage(root, fsync="never")
+    version = storage.version(1)
+    orphan_blob = storage.load_tracks(1)["track_orphan"]["digest"]
+    reconciler = make_reconciler(root, tmp_path)
+    summary = reconciler.run_pass()
+
+    assert summary["removed"] == 2
+    user_dir = os.path.join(root, "user_1")
+    assert sorted(name for name in os.listdir(user_dir) if name.startswith("track_")) == ["track_nodata", "track_ok"]
+    assert storage.load_tracks(1)["track_nodata"]["title"] == "track_nodata"
+    assert not os.path.exists(BlobStore(os.path.join(root, "blobs")).blob_path(orphan_blob))
+    # Поврежденный трек был в плейлисте, поэтому версия сменилась
+    assert storage.version(1) == version + 1
+    assert reconciler.usage(1)[1] == 2
+
+
+def test_grace_period_keeps_fresh_folders(root, tmp_path):
+    before = snapshot(root)
+    reconciler = Reconciler(root, JsonStorage(root, fsync="never"), BlobStore(os.path.join(root, "blobs")),
+                            str(tmp_path / "reconcile.sqlite3"), grace=3600, track_pause=0, user_pause=0)
+    report = reconciler.reconcile_user(1)
+    assert report["removed"] == []
+    assert sorted(report["pending"]) == ["track_corrupt", "track_orphan"]
+    assert {path for path in snapshot(root) if "track_nodata" not in path} == \
+        {path for path in before if "track_nodata" not in path}
+
+
+def test_cli_dry_run(root, tmp_path):
+    before = snapshot(root)
+    result = subprocess.run(
+        [sys.executable, "reconcile.py", "--dry-run", "--grace", "0", "--backend", "json", "--root", root,
+         "--reconcile-db", str(tmp_path / "reconcile.sqlite3")],
+        cwd=SERVER_DIR, capture_output=True, text=True, check=True
+    )
+    assert "user_1\torphan\ttrack_orphan" in result.stdout
+    assert "user_1\tremoved\ttrack_corrupt" in result.stdout
+    assert snapshot(root) == before
+
+
+def test_corrupt_playlists_skip_user(root, tmp_path):
+    with open(os.path.join(root, "user_1", "playlists.json"), "w", encoding="utf-8") as f:
+        f.write('[{"name": "Любимое", "tracks": [')
+    before = snapshot(root)
+    reconciler = make_reconciler(root, tmp_path)
+    summary = reconciler.run_pass()
+
+    assert summary["skipped"] == 1
+    assert summary["removed"] == 0
+    assert summary["blobs"] == 0
+    assert snapshot(root) == before
+
+
+def test_user_missing_from_storage_is_skipped(root, tmp_path):
+    before = snapshot(root)
+    # Пустая SQLite: пользователь не перенесен, но его папки на диске
+    reconciler = Reconciler(root, SqliteStorage(str(tmp_path / "library.sqlite3")),
+                            BlobStore(os.path.join(root, "blobs")), str(tmp_path / "reconcile.sqlite3"),
+                            grace=0, track_pause=0, user_pause=0)
+    report = reconciler.reconcile_user(1)
+    assert report["skipped"]
+    assert report["orphan"] == report["removed"] == []
+    assert snapshot(root) == before
@@ -0,0 +1,64 @@
+from search_index import TrackSearchIndex, normalize, tokenize
+
+
+def test_normalize():
+    assert normalize("Кино — Группа крови!") == "kino gruppa krovi"
+    assert normalize("Ёлка") == normalize("елка") == "elka"
+    assert normalize("Café  Del Mar") == "cafe del mar"
+    assert normalize(None) == ""
+    assert tokenize("Щука, Юла") == ["schuka", "yula"]
+
+
+def test_transliterated_query_finds_both_scripts():
+    index = TrackSearchIndex()
+    index.add("track_1", "Кукушка", "Кино")
+    index.add("track_2", "Blood Type", "Kino")
+    assert set(index.search("кино")) == {"track_1", "track_2"}
+    assert set(index.search("kino")) == {"track_1", "track_2"}
+    assert index.search("kukushka") == ["track_1"]
+
+
+def test_every_word_is_a_prefix():
+    index = TrackSearchIndex()
+    index.add("track_1", "Группа крови", "Кино")
+    index.add("track_2", "Звезда по имени Солнце", "Кино")
+    index.add("track_3", "Группа", "Другие")
+    assert index.search("гру") == ["track_3", "track_1"]
+    assert index.search("гр кин") == ["track_1"]
+    assert index.search("кино звез") == ["track_2"]
+    assert index.search("гру нет") == []
+    assert index.search("  ,! ") == []
+
+
+def test_phrase_prefix_ranks_first_and_limit():
+    index = TrackSearchIndex()
+    index.add("track_1", "Вечная молодость", "Секрет")
+    index.add("track_2", "Молодость", "Гости")
+    index.add("track_3", "Молоко", "Гости")
+    assert index.search("молод") == ["track_2", "track_1"]
+    assert index.search("мол", limit=2) == ["track_2", "track_3"]
+
+
+def test_reindex_and_remove():
+    index = TrackSearchIndex()
+    index.add("track_1", "Старое", "Исполнитель")
+    index.add("track_1", "Новое", "Исполнитель")
+    assert len(index) == 1
+    assert index.search("стар") == []
+    assert index.search("нов") == ["track_1"]
+    index.remove("track_1")
+    index.remove("track_missing")
+    assert len(index) == 0
+    assert index.search("исп") == []
+    assert index._terms == [] and index._postings == {}
+
+
+def test_add_many_matches_add():
+    tracks = [("track_1", "Кукушка", "Кино"), ("track_2", "Кукла", "Кто-то"), ("track_3", "Sky", "Kino")]
+    one, batch = TrackSearchIndex(), TrackSearchIndex()
+    for track in tracks:
+        one.add(*track)
+    batch.add_many(tracks)
+    assert batch._terms == one._terms
+    for query in ("ку", "кино", "k", "sky"):
+        assert batch.search(query) == one.search(query)
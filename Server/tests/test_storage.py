@@ -0,0 +1,141 @@
+import inspect
+
+import pytest
+
+from storage import DEFAULT_PLAYLIST, JsonStorage, SqliteStorage, Storage, make_playlist_entry
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "json":
+        # Маленький журнал, чтобы проверить и записи журнала, и перезапись playlists.json
+        return JsonStorage(str(tmp_path / "DB"), fsync="never", journal_max_ops=3)
+    return SqliteStorage(str(tmp_path / "library.sqlite3"))
+
+
+@pytest.fixture
+def track(tmp_path):
+    def make(n: int, user_id: int = 1) -> tuple:
+        # Папку трека создает сервер вместе с аудио, data.txt JSON-хранилища пишется в нее
+        (tmp_path / "DB" / f"user_{user_id}" / f"track_{n}").mkdir(parents=True, exist_ok=True)
+        return f"track_{n}", {"title": f"Песня {n}", "artist": "Исполнитель"}
+    return make
+
+
+def names(playlists: list) -> list:
+    return [p["name"] for p in playlists]
+
+
+def track_ids(playlists: list, name: str) -> list:
+    return [t["id"] for p in playlists if p["name"] == name for t in p["tracks"]]
+
+
+def test_backends_match_interface():
+    with pytest.raises(TypeError):
+        Storage()
+    for name in Storage.__abstractmethods__:
+        expected = inspect.signature(getattr(Storage, name))
+        for backend in (JsonStorage, SqliteStorage):
+            assert inspect.signature(getattr(backend, name)) == expected, (backend.__name__, name)
+
+
+def test_new_user_gets_default_playlist(storage):
+    assert not storage.has_user(1)
+    playlists, version = storage.load_versioned(1)
+    assert names(playlists) == [DEFAULT_PLAYLIST]
+    assert version == 0
+    assert storage.has_user(1)
+
+
+def test_tracks_round_trip(storage, track):
+    folder, data = track(1)
+    storage.save_track(1, folder, dict(data, digest="abc"))
+    assert storage.load_tracks(1)[folder] == dict(data, digest="abc")
+
+
+def test_add_to_playlist_bumps_versions(storage, track):
+    storage.load_versioned(1)
+    for n in range(1, 6):
+        folder, data = track(n)
+        storage.save_track(1, folder, data)
+        playlists, version = storage.add_to_playlist(1, "Рок", make_playlist_entry(folder, data))
+        assert version == n
+    playlists, version = storage.load_versioned(1)
+    assert version == storage.version(1) == 5
+    assert names(playlists) == [DEFAULT_PLAYLIST, "Рок"]
+    assert track_ids(playlists, "Рок") == [f"track_{n}" for n in range(1, 6)]
+    assert [p.get("version", 0) for p in playlists] == [0, 5]
+
+
+def test_add_tracks_is_one_version(storage, track):
+    storage.load_versioned(1)
+    batch = [("Альбом", *track(1)), ("Альбом", *track(2)), (DEFAULT_PLAYLIST, *track(3))]
+    playlists, version = storage.add_tracks(1, batch)
+    assert version == 1
+    assert track_ids(playlists, "Альбом") == ["track_1", "track_2"]
+    assert track_ids(playlists, DEFAULT_PLAYLIST) == ["track_3"]
+    assert set(storage.load_tracks(1)) == {"track_1", "track_2", "track_3"}
+
+
+def test_create_and_delete_playlist(storage):
+    storage.load_versioned(1)
+    playlists, version = storage.create_playlist(1, "Новый", [])
+    assert version == 1
+    assert names(playlists) == [DEFAULT_PLAYLIST, "Новый"]
+
+    playlists, version = storage.delete_playlist(1, "Нет такого")
+    assert version == 1
+    assert names(playlists) == [DEFAULT_PLAYLIST, "Новый"]
+
+    playlists, version = storage.delete_playlist(1, "Новый")
+    assert version == 2
+    assert names(playlists) == [DEFAULT_PLAYLIST]
+    assert storage.version(1) == 2
+
+
+def test_delete_tracks_bumps_only_referenced(storage, track):
+    storage.load_versioned(1)
+    storage.add_tracks(1, [("Рок", *track(1))])
+    storage.save_track(1, *track(2))
+    # Папка не в плейлисте: ответы /playlists не меняются
+    assert storage.delete_tracks(1, ["track_2"]) == 1
+    assert storage.delete_tracks(1, ["track_1"]) == 2
+    playlists, version = storage.load_versioned(1)
+    assert version == 2
+    assert [p.get("version", 0) for p in playlists if p["name"] == "Рок"] == [2]
+
+
+def test_users_are_isolated(storage, track):
+    storage.add_tracks(1, [("Рок", *track(1))])
+    playlists, version = storage.load_versioned(2)
+    assert names(playlists) == [DEFAULT_PLAYLIST]
+    assert version == 0
+
+
+def test_migrate_from_json(tmp_path, track):
+    root = str(tmp_path / "DB")
+    source = JsonStorage(root, fsync="never", journal_max_ops=10)
+    source.add_tracks(1, [("Рок", *track(1)), ("Рок", *track(2))])
+    folder, data = track(3)
+    source.save_track(1, folder, data)
+    source.add_to_playlist(1, DEFAULT_PLAYLIST, make_playlist_entry(folder, data))
+    source.create_playlist(2, "Пустой", [])
+    expected = {user_id: source.load_versioned(user_id) for user_id in ("1", "2")}
+
+    target = SqliteStorage(str(tmp_path / "library.sqlite3"))
+    assert target.migrate_from_json(root) == 2
+    for user_id, (playlists, version) in expected.items():
+        migrated, migrated_version = target.load_versioned(user_id)
+        assert migrated_version == version
+        assert names(migrated) == names(playlists)
+        for name in names(playlists):
+            assert track_ids(migrated, name) == track_ids(playlists, name)
+    # SQLite возвращает digest и у треков, загруженных до хранилища блобов
+    assert target.load_tracks("1") == {
+        folder: dict(data, digest=None) for folder, data in source.load_tracks("1").items()
+    }
+
+    # Повторный перенос ничего не делает
+    source.create_playlist(3, "Поздний", [])
+    assert target.migrate_from_json(root) == 0
+    assert not target.has_user("3")
@@ -0,0 +1,151 @@
+"""Локальные заглушки Telegram Bot API, iTunes Search и сервера плеера для бенчмарков.
+
+Отвечают с настраиваемой задержкой, чтобы сетевое время внешних
+сервисов было одинаковым от прогона к прогону.
+"""
+import time
+import asyncio
+import hashlib
+from aiohttp import web
+
+
+class FakeService:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self.base_url = None
+        self._runner = None
+
+    def routes(self) -> list:
+        raise NotImplementedError
+
+    async def _delay(self) -> None:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def start(self, host: str = "127.0.0.1") -> str:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeTelegram(FakeService):
+    """Bot API: getFile и скачивание файла отдают синтетический MP3, остальные методы — пустое сообщение."""
+
+    def __init__(self, audio: bytes, latency: float = 0.0):
+        super().__init__(latency)
+        self.audio = audio
+        self.sent_messages = 0
+        self.failed_replies = 0
+        self._message_id = 0
+
+    def routes(self) -> list:
+        return [
+            web.get("/file/bot{token}/{path:.+}", self.download),
+            web.route("*", "/bot{token}/{method}", self.api_method),
+        ]
+
+    async def api_method(self, request: web.Request) -> web.Response:
+        await self._delay()
+        params = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.post())
+        method = request.match_info["method"]
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            return web.json_response({"ok": True, "result": {
+                "file_id": file_id, "file_unique_id": file_id[:16], "file_size": len(self.audio),
+                "file_path": f"music/{file_id}.mp3"
+            }})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"
+            }})
+        self.sent_messages += 1
+        if str(params.get("text", "")).startswith("❌"):
+            self.failed_replies += 1
+        self._message_id += 1
+        chat_id = int(params.get("chat_id", 0) or 0)
+        return web.json_response({"ok": True, "result": {
+            "message_id": self._message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": str(params.get("text", ""))
+        }})
+
+    async def download(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.Response(body=self.audio, content_type="audio/mpeg")
+
+
+class FakeItunes(FakeService):
+    """iTunes Search: на каждый запрос своя обложка, чтобы общий кэш обложек не скрывал сетевой путь."""
+
+    def __init__(self, artwork: bytes, latency: float = 0.0):
+        super().__init__(latency)
+        self.artwork = artwork
+
+    def routes(self) -> list:
+        return [web.get("/search", self.search), web.get("/art/{key}/{size}", self.art)]
+
+    async def search(self, request: web.Request) -> web.Response:
+        await self._delay()
+        key = hashlib.sha1(request.query.get("term", "").encode()).hexdigest()
+        return web.json_response({"resultCount": 1, "results": [
+            {"artworkUrl100": f"{self.base_url}/art/{key}/100x100bb.jpg"}
+        ]}, content_type="text/javascript")
+
+    async def art(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.Response(body=self.artwork, content_type="image/jpeg")
+
+
+class FakeMusicServer(FakeService):
+    """Сервер плеера для прогона бота без диска: плейлисты в памяти, create/delete_playlist считаются."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.playlists = {}
+        self.created = 0
+
+    def routes(self) -> list:
+        return [
+            web.post("/playlists", self.list_playlists),
+            web.post("/create_playlist", self.create_playlist),
+            web.post("/delete_playlist", self.delete_playlist),
+        ]
+
+    def _user_playlists(self, user_id) -> list:
+        return self.playlists.setdefault(user_id, [{"name": "Любимое", "tracks": []}])
+
+    async def list_playlists(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = await request.json()
+        return web.json_response({"playlists": self._user_playlists(data["user_id"])})
+
+    async def create_playlist(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = await request.json()
+        playlists = self._user_playlists(data["user_id"])
+        name = data["playlist"]["name"]
+        if any(playlist["name"] == name for playlist in playlists):
+            return web.json_response({"error": "Плейлист уже существует"}, status=400)
+        playlists.append({"name": name, "tracks": []})
+        self.created += 1
+        return web.json_response({"playlists": playlists})
+
+    async def delete_playlist(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = await request.json()
+        playlists = self._user_playlists(data["user_id"])
+        playlists[:] = [playlist for playlist in playlists if playlist["name"] != data["playlist_name"]]
+        return web.json_response({"playlists": playlists})
@@ -0,0 +1,86 @@
+"""Синтетическая библиотека для бенчмарков: дерево static/DB в формате JSON-хранилища.
+
+SQLite-хранилище переносит такое дерево при первом запуске сервера,
+поэтому одно дерево подходит для обоих бэкендов.
+"""
+import os
+import json
+import random
+import shutil
+
+# Кадр MPEG-1 Layer III, 128 кбит/с, 44100 Гц, без паддинга: 144 * 128000 / 44100 = 417 байт
+FRAME_HEADER = bytes((0xFF, 0xFB, 0x90, 0x00))
+FRAME_LENGTH = 417
+FRAME_SAMPLES = 1152
+SAMPLE_RATE = 44100
+
+WORDS = (
+    "love", "night", "city", "summer", "dream", "fire", "river", "light", "heart", "road",
+    "кино", "звезда", "лето", "группа", "крови", "море", "ночь", "город", "песня", "ветер",
+)
+
+
+def make_mp3(seconds: float) -> bytes:
+    """Возвращает поток кадров MP3 нужной длительности (тишина, но заголовки корректны)."""
+    frames = max(1, int(seconds * SAMPLE_RATE / FRAME_SAMPLES))
+    frame = FRAME_HEADER + bytes(FRAME_LENGTH - len(FRAME_HEADER))
+    return frame * frames
+
+
+def track_title(rng: random.Random) -> tuple:
+    title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+    artist = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 2))).title()
+    return title, artist
+
+
+def build_tree(db_root: str, users: int, tracks: int, playlists: int, audio_seconds: float = 30.0,
+               seed: int = 1) -> dict:
+    """Создает users пользователей по tracks треков, разложенных по playlists плейлистам.
+
+    Аудио у всех треков одно (жесткие ссылки на один файл), поэтому дерево
+    на десятки тысяч треков занимает мегабайты. Возвращает описание дерева
+    для сценариев: {"users": [...], "tracks": {user_id: [папки]}, "audio_size": ...}.
+    """
+    rng = random.Random(seed)
+    os.makedirs(db_root, exist_ok=True)
+    audio_path = os.path.join(db_root, "bench_audio.mp3")
+    with open(audio_path, "wb") as f:
+        f.write(make_mp3(audio_seconds))
+
+    layout = {"users": [], "tracks": {}, "audio_size": os.path.getsize(audio_path)}
+    for user_index in range(users):
+        user_id = 100_000 + user_index
+        user_dir = os.path.join(db_root, f"user_{user_id}")
+        os.makedirs(user_dir, exist_ok=True)
+        names = ["Любимое"] + [f"Плейлист {i}" for i in range(1, playlists)]
+        entries = {name: [] for name in names}
+        folders = []
+        for track_index in range(tracks):
+            track_folder = f"track_bench{user_id}_{track_index}"
+            track_dir = os.path.join(user_dir, track_folder)
+            os.makedirs(track_dir, exist_ok=True)
+            os.link(audio_path, os.path.join(track_dir, "song.mp3"))
+            title, artist = track_title(rng)
+            with open(os.path.join(track_dir, "data.txt"), "w", encoding="utf-8") as f:
+                json.dump({"title": title, "artist": artist, "duration": audio_seconds, "bitrate": 128000,
+                           "sample_rate": SAMPLE_RATE}, f, ensure_ascii=False)
+            entries[rng.choice(names)].append({"id": track_folder, "title": title, "artist": artist})
+            folders.append(track_folder)
+        with open(os.path.join(user_dir, "playlists.json"), "w", encoding="utf-8") as f:
+            json.dump([{"name": name, "tracks": entries[name], "version": 1} for name in names], f,
+                      ensure_ascii=False, indent=4)
+        with open(os.path.join(user_dir, "version.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": 1}, f)
+        layout["users"].append(user_id)
+        layout["tracks"][user_id] = folders
+    return layout
+
+
+def prepare_workdir(workdir: str, server_dir: str, users: int, tracks: int, playlists: int,
+                    audio_seconds: float) -> dict:
+    """Готовит рабочий каталог сервера: static/DB, CSS, JS и стандартную обложку по относительным путям server.py."""
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    for folder in ("css", "js"):
+        shutil.copytree(os.path.join(server_dir, "static", folder), os.path.join(workdir, "static", folder))
+    return build_tree(os.path.join(workdir, "static", "DB"), users, tracks, playlists, audio_seconds)
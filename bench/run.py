@@ -0,0 +1,451 @@
+"""Нагрузочный бенчмарк сервера и бота на синтетической библиотеке.
+
+Собирает дерево static/DB из N пользователей по M треков в K плейлистах,
+поднимает заглушки Telegram Bot API и iTunes Search, запускает сервер
+отдельным процессом и гоняет сценарии: /playlists (холодный, теплый, 304),
+чтение аудио по Range, /add_track, пачки /add_tracks и обработку аудио
+ботом (handle_audio).
+Для каждого сценария считаются пропускная способность, p50/p99 задержки
+и ошибки, для сервера — RSS. Результат сохраняется в JSON и сравнивается
+с прошлым прогоном:
+
+    python bench/run.py --users 20 --tracks 500 --save bench/results/base.json
+    python bench/run.py --users 20 --tracks 500 --compare bench/results/base.json
+
+Нужны зависимости и сервера (Server/requirements.txt), и бота (aiogram).
+Сравнивать имеет смысл прогоны с одинаковыми параметрами на одной машине.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import asyncio
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+import aiohttp
+
+from fakes import FakeItunes, FakeTelegram
+from fixtures import make_mp3, prepare_workdir, track_title
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(ROOT_DIR, "Server")
+BOT_DIR = os.path.join(ROOT_DIR, "Bot")
+sys.path.insert(0, SERVER_DIR)
+from auth import bot_auth_key  # noqa: E402
+
+BENCH_TOKEN = "123456:bench-token-not-for-telegram"
+HOST = "127.0.0.1"
+RANGE_SIZE = 64 * 1024
+READY_TIMEOUT = 300
+SCENARIOS = (
+    "playlists_cold", "playlists_warm", "playlists_304", "stream_range", "add_track", "add_tracks", "bot_handle_audio"
+)
+
+logger = logging.getLogger("bench")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def process_rss(pid: int):
+    """RSS процесса вместе с дочерними (воркеры gunicorn/uvicorn) в байтах; None вне Linux."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status", encoding="ascii") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            with open(f"/proc/{current}/task/{current}/children", encoding="ascii") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            if current == pid:
+                return None
+    return total
+
+
+def own_peak_rss() -> int:
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def percentile(sorted_values: list, percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # Метод ближайшего ранга
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def server_command(args, port: int) -> list:
+    if args.server == "uvicorn":
+        return [args.python, "-m", "uvicorn", "asgi:app", "--app-dir", SERVER_DIR, "--host", HOST,
+                "--port", str(port), "--workers", str(args.workers), "--log-level", "warning"]
+    if args.server == "gunicorn":
+        return [args.python, "-m", "gunicorn", "--pythonpath", SERVER_DIR, "-b", f"{HOST}:{port}",
+                "-w", str(args.workers), "--threads", "8", "--log-level", "warning", "server:app"]
+    return [args.python, "-c", (
+        "import server; from werkzeug.serving import run_simple; "
+        f"run_simple('{HOST}', {port}, server.app, threaded=True)"
+    )]
+
+
+async def wait_ready(session: aiohttp.ClientSession, base_url: str, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился с кодом {process.returncode}, см. server.log")
+        try:
+            async with session.get(f"{base_url}/jobs/status") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Сервер не ответил за отведенное время")
+
+
+async def run_load(name: str, request, total: int, concurrency: int) -> dict:
+    """Выполняет total вызовов request(i) не более чем concurrency одновременно."""
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                ok = await request(i)
+            except Exception as e:
+                logger.debug("%s #%d: %s", name, i, e)
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, total))))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    result = {
+        "requests": total,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round((total - errors) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round((latencies[-1] if latencies else 0) * 1000, 3),
+    }
+    logger.info("%-18s %6d запросов, %4d ошибок, %9.1f/с, p50 %8.2f мс, p99 %8.2f мс", name, total, errors,
+                result["throughput"], result["p50_ms"], result["p99_ms"])
+    return result
+
+
+class ServerScenarios:
+    """Сценарии HTTP-запросов к серверу от имени бота (заголовок X-Bot-Auth)."""
+
+    def __init__(self, session: aiohttp.ClientSession, base_url: str, layout: dict, rng: random.Random,
+                 audio: bytes, batch_size: int):
+        self.session = session
+        self.base_url = base_url
+        self.layout = layout
+        self.rng = rng
+        self.audio = audio
+        self.batch_size = batch_size
+        self.headers = {"X-Bot-Auth": bot_auth_key(BENCH_TOKEN)}
+        self.etags = {}
+
+    async def playlists(self, user_id, revalidate: bool = False) -> bool:
+        headers = dict(self.headers)
+        if revalidate and user_id in self.etags:
+            headers["If-None-Match"] = self.etags[user_id]
+        async with self.session.post(f"{self.base_url}/playlists", json={"user_id": user_id},
+                                     headers=headers) as response:
+            await response.read()
+            if response.status == 200:
+                self.etags[user_id] = response.headers.get("ETag")
+            return response.status in ((200, 304) if revalidate else (200,))
+
+    async def playlists_cold(self, i: int) -> bool:
+        return await self.playlists(self.layout["users"][i])
+
+    async def playlists_warm(self, i: int) -> bool:
+        return await self.playlists(self.rng.choice(self.layout["users"]))
+
+    async def playlists_304(self, i: int) -> bool:
+        return await self.playlists(self.rng.choice(self.layout["users"]), revalidate=True)
+
+    async def stream_range(self, i: int) -> bool:
+        user_id = self.rng.choice(self.layout["users"])
+        track_folder = self.rng.choice(self.layout["tracks"][user_id])
+        start = self.rng.randrange(0, max(1, self.layout["audio_size"] - RANGE_SIZE))
+        headers = {**self.headers, "Range": f"bytes={start}-{start + RANGE_SIZE - 1}"}
+        async with self.session.get(f"{self.base_url}/stream/{user_id}/{track_folder}",
+                                    headers=headers) as response:
+            body = await response.read()
+            return response.status == 206 and len(body) == min(RANGE_SIZE, self.layout["audio_size"] - start)
+
+    async def add_track(self, i: int) -> bool:
+        user_id = self.layout["users"][i % len(self.layout["users"])]
+        title, artist = track_title(self.rng)
+        form = aiohttp.FormData()
+        form.add_field("track_data", json.dumps({
+            "user_id": user_id, "file_id": f"benchadd{i}", "title": title, "artist": artist,
+            "playlist_name": "Любимое"
+        }), content_type="application/json")
+        form.add_field("file", self.audio, filename="track.mp3", content_type="audio/mpeg")
+        async with self.session.post(f"{self.base_url}/add_track", data=form, headers=self.headers) as response:
+            await response.read()
+            return response.status == 200
+
+    async def add_tracks(self, i: int) -> bool:
+        user_id = self.layout["users"][i % len(self.layout["users"])]
+        form = aiohttp.FormData()
+        tracks = []
+        for j in range(self.batch_size):
+            title, artist = track_title(self.rng)
+            tracks.append({"file_id": f"benchbatch{i}_{j}", "title": title, "artist": artist})
+        form.add_field("batch_data", json.dumps({"user_id": user_id, "playlist_name": "Любимое", "tracks": tracks}),
+                       content_type="application/json")
+        for _ in tracks:
+            form.add_field("file", self.audio, filename="track.mp3", content_type="audio/mpeg")
+        async with self.session.post(f"{self.base_url}/add_tracks", data=form, headers=self.headers) as response:
+            result = await response.json() if response.status == 200 else {}
+            return len(result.get("added", [])) == self.batch_size
+
+
+class BotScenario:
+    """Прогон handle_audio из Bot/bot.py: скачивание из заглушки Telegram и выгрузка на сервер."""
+
+    def __init__(self, server_url: str, telegram: FakeTelegram, layout: dict, rng: random.Random,
+                 batch_window: float, workdir: str):
+        os.environ.update(BOT_TOKEN=BENCH_TOKEN, SERVER_URL=server_url, TELEGRAM_API_URL=telegram.base_url,
+                          AUDIO_BATCH_WINDOW=str(batch_window), FSM_DIR=os.path.join(workdir, "fsm"))
+        sys.path.insert(0, BOT_DIR)
+        import bot as bot_module
+        from aiogram import Bot, Dispatcher
+        Bot.set_current(bot_module.bot)
+        Dispatcher.set_current(bot_module.dp)
+        self.module = bot_module
+        self.telegram = telegram
+        self.layout = layout
+        self.rng = rng
+
+    async def handle_audio(self, i: int) -> bool:
+        from aiogram import types
+        user_id = self.layout["users"][i % len(self.layout["users"])]
+        title, artist = track_title(self.rng)
+        message = types.Message.to_object({
+            "message_id": i + 1, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "audio": {
+                "file_id": f"benchbot{i}", "file_unique_id": f"benchbot{i}", "duration": 30,
+                "title": title, "performer": artist, "file_name": "track.mp3", "mime_type": "audio/mpeg",
+                "file_size": len(self.telegram.audio)
+            }
+        })
+        state = self.module.dp.current_state(chat=user_id, user=user_id)
+        failed_before = self.telegram.failed_replies
+        await self.module.handle_audio(message, state)
+        # Ошибки handle_audio перехватывает сам и отвечает пользователю "❌ ..."
+        return self.telegram.failed_replies == failed_before
+
+    async def close(self) -> None:
+        if self.module.http_session is not None:
+            await self.module.http_session.close()
+        session = await self.module.bot.get_session()
+        await session.close()
+
+
+async def run(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="music-bench-")
+    logger.info("Синтетическая библиотека: %d пользователей x %d треков x %d плейлистов в %s",
+                args.users, args.tracks, args.playlists, workdir)
+    started = time.perf_counter()
+    layout = prepare_workdir(workdir, SERVER_DIR, args.users, args.tracks, args.playlists, args.audio_seconds)
+    build_seconds = time.perf_counter() - started
+    audio = make_mp3(args.audio_seconds)
+    with open(os.path.join(SERVER_DIR, "static", "css", "standart.png"), "rb") as f:
+        artwork = f.read()
+
+    telegram = FakeTelegram(audio, args.fake_latency)
+    itunes = FakeItunes(artwork, args.fake_latency)
+    await telegram.start()
+    await itunes.start()
+
+    port = free_port()
+    base_url = f"http://{HOST}:{port}"
+    env = {
+        **os.environ, "BOT_TOKEN": BENCH_TOKEN, "ITUNES_SEARCH_URL": f"{itunes.base_url}/search",
+        "STORAGE_BACKEND": args.backend, "PYTHONPATH": SERVER_DIR, "LOG_SAMPLE_RATE": "0",
+    }
+    with open(os.path.join(workdir, "server.log"), "wb") as server_log:
+        process = subprocess.Popen(server_command(args, port), cwd=workdir, env=env,
+                                   stdout=server_log, stderr=subprocess.STDOUT)
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    results = {}
+    rss = {}
+    connector = aiohttp.TCPConnector(limit=args.concurrency * 2)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+            started = time.perf_counter()
+            await wait_ready(session, base_url, process)
+            startup_seconds = time.perf_counter() - started
+            rss["server_start"] = process_rss(process.pid)
+
+            rng = random.Random(args.seed)
+            server = ServerScenarios(session, base_url, layout, rng, audio, args.batch_size)
+            loads = {
+                "playlists_cold": (server.playlists_cold, len(layout["users"])),
+                "playlists_warm": (server.playlists_warm, args.requests),
+                "playlists_304": (server.playlists_304, args.requests),
+                "stream_range": (server.stream_range, args.requests),
+                "add_track": (server.add_track, args.uploads),
+                "add_tracks": (server.add_tracks, max(1, args.uploads // args.batch_size)),
+            }
+            for name in scenarios:
+                if name == "bot_handle_audio":
+                    bot_scenario = BotScenario(base_url, telegram, layout, rng, args.batch_window, workdir)
+                    try:
+                        results[name] = await run_load(name, bot_scenario.handle_audio, args.uploads, args.concurrency)
+                    finally:
+                        await bot_scenario.close()
+                elif name in loads:
+                    request, total = loads[name]
+                    results[name] = await run_load(name, request, total, args.concurrency)
+                else:
+                    raise SystemExit(f"Неизвестный сценарий: {name}")
+                rss[f"server_after_{name}"] = process_rss(process.pid)
+
+            async with session.get(f"{base_url}/jobs/status") as response:
+                jobs = await response.json()
+    finally:
+        process.terminate()
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        await telegram.stop()
+        await itunes.stop()
+
+    rss["server_peak"] = max((value for value in rss.values() if value), default=None)
+    rss["bench_peak"] = own_peak_rss()
+    return {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "workdir": workdir,
+        },
+        "params": {key: getattr(args, key) for key in (
+            "users", "tracks", "playlists", "audio_seconds", "requests", "uploads", "concurrency",
+            "batch_size", "batch_window", "backend", "server", "workers", "fake_latency", "seed"
+        )},
+        "setup": {"build_seconds": round(build_seconds, 3), "startup_seconds": round(startup_seconds, 3)},
+        "scenarios": results,
+        "rss": rss,
+        "jobs": jobs,
+        "fakes": {"telegram_requests": telegram.requests, "itunes_requests": itunes.requests},
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """Печатает сравнение с базовым прогоном и возвращает список регрессий."""
+    if current["params"] != baseline["params"]:
+        print("Внимание: параметры прогонов различаются, сравнение приблизительное")
+    regressions = []
+    print(f"{'сценарий':<18} {'было/с':>10} {'стало/с':>10} {'p99 было':>10} {'p99 стало':>10}")
+    for name, result in current["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        print(f"{name:<18} {base['throughput']:>10.1f} {result['throughput']:>10.1f} "
+              f"{base['p99_ms']:>10.2f} {result['p99_ms']:>10.2f}")
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: пропускная способность {base['throughput']} -> {result['throughput']}/с")
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {base['p99_ms']} -> {result['p99_ms']} мс")
+        if result["errors"] > base["errors"]:
+            regressions.append(f"{name}: ошибок {base['errors']} -> {result['errors']}")
+    base_peak, peak = baseline["rss"].get("server_peak"), current["rss"].get("server_peak")
+    if base_peak and peak and peak > base_peak * (1 + tolerance):
+        regressions.append(f"RSS сервера {base_peak // 2 ** 20} -> {peak // 2 ** 20} МБ")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--tracks", type=int, default=200, help="треков на пользователя")
+    parser.add_argument("--playlists", type=int, default=5, help="плейлистов на пользователя")
+    parser.add_argument("--audio-seconds", type=float, default=30.0, help="длительность синтетического MP3")
+    parser.add_argument("--requests", type=int, default=1000, help="запросов в сценариях чтения")
+    parser.add_argument("--uploads", type=int, default=50, help="загрузок в /add_track и handle_audio")
+    parser.add_argument("--batch-size", type=int, default=10, help="треков в одном запросе /add_tracks")
+    parser.add_argument("--batch-window", type=float, default=0.05,
+                        help="окно сборки пачек аудио в боте (AUDIO_BATCH_WINDOW), входит в задержку handle_audio")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--backend", choices=("sqlite", "json"), default="sqlite")
+    parser.add_argument("--server", choices=("werkzeug", "gunicorn", "uvicorn"), default="werkzeug")
+    parser.add_argument("--workers", type=int, default=2, help="воркеров gunicorn/uvicorn")
+    parser.add_argument("--python", default=sys.executable, help="интерпретатор с зависимостями сервера")
+    parser.add_argument("--fake-latency", type=float, default=0.0, help="задержка заглушек Telegram и iTunes, с")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="каталог для дерева и логов (по умолчанию временный)")
+    parser.add_argument("--save", help="сохранить результат в JSON")
+    parser.add_argument("--compare", help="сравнить с сохраненным результатом")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение, доля")
+    return parser.parse_args()
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    # Журналы сервера и бота в консоль бенчмарка не нужны
+    logging.getLogger().handlers[0].addFilter(lambda record: record.name == "bench")
+    args = parse_args()
+    result = asyncio.run(run(args))
+    print(json.dumps({"scenarios": result["scenarios"], "rss": result["rss"]}, ensure_ascii=False, indent=2))
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        logger.info("Результат сохранен: %s", args.save)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"РЕГРЕССИЯ: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""Нагрузка на вебхук бота (Bot/webhook.py) локальным отправителем апдейтов.
+
+Поднимает заглушки Telegram Bot API и сервера плеера, запускает вебхук
+с заданным числом воркеров и шлет ему апдейты так, как их шлет Telegram:
+у каждого пользователя по порядку, у разных пользователей — параллельно.
+Каждый пользователь rounds раз создает плейлист ("Создать плейлист",
+затем название), поэтому нарушение порядка или потеря состояния FSM
+видны по числу созданных плейлистов:
+
+    python bench/send_updates.py --users 200 --rounds 5 --workers 4
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+
+from fakes import FakeMusicServer, FakeTelegram
+from run import BENCH_TOKEN, BOT_DIR, HOST, free_port, percentile
+
+SECRET = "bench-webhook-secret"
+READY_TIMEOUT = 120
+SETTLE_TIMEOUT = 120
+
+logger = logging.getLogger("bench")
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "bench"}
+    }}
+
+
+async def wait_ready(session: aiohttp.ClientSession, base_url: str, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Вебхук завершился с кодом {process.returncode}, см. webhook.log")
+        try:
+            async with session.get(f"{base_url}/healthz") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Вебхук не ответил за отведенное время")
+
+
+async def run(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bot-webhook-bench-")
+    telegram = FakeTelegram(b"", args.fake_latency)
+    server = FakeMusicServer(args.fake_latency)
+    await telegram.start()
+    await server.start()
+
+    port = free_port()
+    base_url = f"http://{HOST}:{port}"
+    env = dict(os.environ, BOT_TOKEN=BENCH_TOKEN, SERVER_URL=server.base_url, TELEGRAM_API_URL=telegram.base_url,
+               WEBHOOK_SECRET=SECRET, FSM_DIR=os.path.join(workdir, "fsm"), WEBHOOK_URL="",
+               WEBHOOK_SPOOL_FILE=os.path.join(workdir, "webhook_spool.sqlite3"))
+    with open(os.path.join(workdir, "webhook.log"), "wb") as webhook_log:
+        process = subprocess.Popen([args.python, os.path.join(BOT_DIR, "webhook.py"), "--workers", str(args.workers),
+                                    "--host", HOST, "--port", str(port)],
+                                   cwd=BOT_DIR, env=env, stdout=webhook_log, stderr=subprocess.STDOUT)
+    latencies = []
+    errors = 0
+    update_ids = iter(range(1, args.users * args.rounds * 2 + 1))
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_ready(session, base_url, process)
+
+            async def user_session(user_id: int) -> None:
+                nonlocal errors
+                # Апдейты одного пользователя Telegram доставляет по одному, дожидаясь ответа
+                for round_index in range(args.rounds):
+                    for text in ("Создать плейлист", f"Плейлист {round_index}"):
+                        update = message_update(next(update_ids), user_id, text)
+                        started = time.perf_counter()
+                        async with session.post(f"{base_url}/webhook", json=update, headers=headers) as response:
+                            if response.status != 200:
+                                errors += 1
+                        latencies.append(time.perf_counter() - started)
+
+            logger.info("Отправка: %d пользователей x %d плейлистов, воркеров: %d", args.users, args.rounds,
+                        args.workers)
+            started = time.perf_counter()
+            await asyncio.gather(*(user_session(100000 + i) for i in range(args.users)))
+            expected = args.users * args.rounds
+            deadline = time.monotonic() + SETTLE_TIMEOUT
+            while server.created < expected and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started
+    finally:
+        process.terminate()
+        process.wait(timeout=60)
+        await telegram.stop()
+        await server.stop()
+
+    latencies.sort()
+    return {
+        "updates": len(latencies),
+        "errors": errors,
+        "playlists_expected": expected,
+        "playlists_created": server.created,
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "ack_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "ack_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "bot_replies": telegram.sent_messages,
+        "workdir": workdir,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3, help="плейлистов, создаваемых каждым пользователем")
+    parser.add_argument("--workers", type=int, default=2, help="процессов-воркеров вебхука")
+    parser.add_argument("--python", default=sys.executable, help="интерпретатор с зависимостями бота")
+    parser.add_argument("--fake-latency", type=float, default=0.0, help="задержка заглушек, с")
+    parser.add_argument("--workdir", help="каталог для FSM и логов (по умолчанию временный)")
+    return parser.parse_args()
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    result = asyncio.run(run(parse_args()))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if result["errors"] or result["playlists_created"] != result["playlists_expected"]:
+        print("ОШИБКА: часть апдейтов потеряна или обработана не по порядку")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())